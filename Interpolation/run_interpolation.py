@@ -36,46 +36,47 @@ def get_Histograms(inDir, thdm, heavy, light, m_heavy, m_light, flavor, reg, tag
 
 def runInterpolation(par_interlist, doTriangle=False, do2Param=False):
 
-    for par_inter in par_interlist:
+    idx = tools.get_idx_topave(do_fix, thdm) 
+    #all_masses   = tools.YMLparser.get_masspoints(path, thdm)[prod]
+    all_masses    = tools.no_plotsYML(inDir, thdm, year)[prod] # work around when I can't find the plots.yml
+    
+    if doTriangle:
+        # Triangulate the grid once and find the triangles of all the points in one go #
+        from twoparameter.interpolate import PointFinder
+        print ('\tLooking for triangles')
+        finder = PointFinder(list(all_masses),verbose=False)
+        triangles, found = finder.find_triangles(par_interlist)
+        print ('... done')
+
+    for n, par_inter in enumerate(par_interlist):
 
         m_heavy_inter = par_inter[0]
         m_light_inter = par_inter[1]
-        idx = tools.get_idx_topave(do_fix, thdm) 
-        
-        #all_masses   = tools.YMLparser.get_masspoints(path, thdm)[prod]
-        all_masses    = tools.no_plotsYML(inDir, thdm, year)[prod] # work around when I can't find the plots.yml
         
         if par_inter in all_masses:
             print( f'This mass you already have {par_inter}')
             continue
 
-        pdfFile   = f'test_interp_DNN_{prod}_M{heavy}_{m_heavy_inter}_M{light}_{m_light_inter}_tb_{tb}_{year}.pdf'
-        
-        C = ROOT.TCanvas('C','C',800,800)
-        C.Print(pdfFile+"[")
-
         if doTriangle:
-            # Find three points in triangle #
-            print ('\tLooking for triangle')
+            if not found[n]:
+                print( f'no triangle of the grid contains {par_inter}, it cannot be interpolated')
+                continue
             name = f'finder/test_{par_inter[0]}_{par_inter[1]}.png'
-            
-            finder  = PointFinder(list(HToZA),verbose=False)
-            triplet = finder.find_triangle(par_inter)
+            finder.point   = par_inter
+            finder.triplet = tuple(triangles[n])
             finder.draw(name)
-            print ('... done')
                 
-            par0 = tuple(triplet[0])
-            par1 = tuple(triplet[1])
-            par2 = tuple(triplet[2])
+            par0, par1, par2 = [tuple(float(m) for m in p) for p in triangles[n]]
             print ('\tTriangle edge points are :')
         else:
+            masses          = list(all_masses)
             nearest_params  = [] 
             # okay let's get 3 closet points
             # https://docs.python.org/3.8/library/math.html#math.hypot 
-            for i in range(len(all_masses)):
-                nearest = min(all_masses, key=lambda c: math.hypot(c[0]-m_heavy_inter, c[1]-m_light_inter))
+            for i in range(len(masses)):
+                nearest = min(masses, key=lambda c: math.hypot(c[0]-m_heavy_inter, c[1]-m_light_inter))
                 nearest_params.append(nearest)
-                all_masses.remove(nearest) # rm and start over
+                masses.remove(nearest) # rm and start over
             
             ## let's avoid running into extrapolation 
             params_less = []
@@ -95,6 +96,11 @@ def runInterpolation(par_interlist, doTriangle=False, do2Param=False):
                 par0 = params_less[0]
                 par1, par2 = params_greater[0:2]
         
+        pdfFile   = f'test_interp_DNN_{prod}_M{heavy}_{m_heavy_inter}_M{light}_{m_light_inter}_tb_{tb}_{year}.pdf'
+        
+        C = ROOT.TCanvas('C','C',800,800)
+        C.Print(pdfFile+"[")
+
         print ('\tClosest points are :')
         print (f' ... params 0 : {par0}')
         print (f' ... params 1 : {par1}')
@@ -234,24 +234,72 @@ class Triangle(Polygon):
 
 
 class PointFinder:
-    def __init__(self,points,verbose=False):
+    """
+        Find the three points of the grid making a triangle around a requested point
+        method :
+            - 'delaunay' : the grid is triangulated once (Delaunay), the triangle is the simplex containing the point
+                           (logarithmic search, see find_triangles for many points at once)
+            - 'distance' : among the triangles made of the N closest points (N increased until one is found), 
+                           take the one containing the point with the minimal total distance to it
+    """
+    def __init__(self,points,verbose=False,method='delaunay'):
         self.points = np.array(points)
         assert self.points.ndim == 2
         assert self.points.shape[1] == 2
+        if method not in ['delaunay','distance']:
+            raise RuntimeError(f'Unknown method {method}')
+        self.method = method
         self.triplet = None
         self.point = None
         self.verbose = verbose
+        self._delaunay = None
+
+    @property
+    def delaunay(self):
+        """ Delaunay triangulation of the grid, built at first use """
+        if self._delaunay is None:
+            from scipy.spatial import Delaunay
+            self._delaunay = Delaunay(self.points.astype(np.float64))
+        return self._delaunay
 
     def find_triangle(self,point):
         self.point = point
         try:
-            self.triplet = self._find_triangle(point) 
+            if self.method == 'delaunay':
+                self.triplet = self._find_simplex(point)
+            else:
+                self.triplet = self._find_triangle(point) 
         except Exception as e:
             self.triplet = None
             raise e
 
         return self.triplet        
 
+    def find_triangles(self,points):
+        """
+            Batch version of find_triangle with the Delaunay triangulation
+            points : [N,2] requested points
+            return : triangles [N,3,2], and a [N] mask of the points for which a triangle was found
+                     (the points outside of the grid get nan)
+        """
+        points = np.asarray(points,dtype=np.float64).reshape(-1,2)
+        simplices = self.delaunay.find_simplex(points)
+        found = simplices >= 0
+        triangles = np.full((points.shape[0],3,2),np.nan)
+        triangles[found] = self.points[self.delaunay.simplices[simplices[found]]]
+        return triangles,found
+
+    def _find_simplex(self,point):
+        if self.verbose:
+            print (f'Looking at point {point}')
+        simplex = self.delaunay.find_simplex(np.asarray(point,dtype=np.float64))
+        if simplex < 0:
+            raise RuntimeError(f'Could not find triangle for point {point}')
+        final_triplet = tuple(self.points[self.delaunay.simplices[simplex]])
+        if self.verbose:
+            print (f'Final selected triplet : {final_triplet}')
+        return final_triplet
+
     def _find_triangle(self,point):
         if self.verbose:
             print (f'Looking at point {point}')
@@ -343,6 +391,8 @@ if __name__ == '__main__':
     finder = PointFinder(masspoints)
     print (finder.find_triangle([250,70]))
     finder.draw("test_finder.png")
+    print (PointFinder(masspoints,method='distance').find_triangle([250,70]))
+    print (finder.find_triangles([[250,70],[350,150],[100,100]]))
 
     # Test of triangle and polynom #
     triangle = Triangle([ (0, 0), (10,0), (5,10) ])
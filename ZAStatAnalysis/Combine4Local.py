@@ -0,0 +1,208 @@
+import os, os.path
+import re
+import sys
+import glob
+import time
+import errno
+import signal
+import fnmatch
+import argparse
+import subprocess
+import multiprocessing
+
+from multiprocessing.pool import ThreadPool
+
+import Constants as Constants
+logger = Constants.ZAlogger(__name__)
+
+COMBINE_ARGS = re.compile(r'(?:^|\s)(-M|-m|-n|--expectedFromGrid)(?:=|\s+)(\S+)')
+
+
+def expected_outputs(script):
+    """
+    Combine outputs the script produces, from its combine commands : one regex per command,
+        higgsCombine<-n>.<-M>.mH<-m>[.<seed>][.quant<--expectedFromGrid>].root in the pushd directory
+    None when they cannot be known ( names built from shell variables )
+    """
+    dir     = os.path.dirname(os.path.abspath(script))
+    outputs = []
+    with open(script) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('pushd '):
+                dir = os.path.join(os.path.dirname(os.path.abspath(script)), line.split()[1])
+            if not line.startswith('combine '):
+                continue
+            args = dict(COMBINE_ARGS.findall(line.split('&>')[0]))
+            if '-M' not in args or '-m' not in args:
+                continue
+            name = args.get('-n', 'Test')
+            if '$' in name or '$' in args['-m']:
+                return None
+            quant = '.quant{:.3f}'.format(float(args['--expectedFromGrid'])) if '--expectedFromGrid' in args else ''
+            outputs.append((dir, re.compile(r'^higgsCombine{}\.{}\.mH{}(\.-?\d+)?{}\.root$'.format(
+                    re.escape(name), re.escape(args['-M']), re.escape('%g'%float(args['-m'])), re.escape(quant)))))
+    return outputs
+
+
+def find_scripts(cardDir, method):
+    """ Same scripts as the ones run by the generated run_combine_*.sh : find cardDir -name "*_run_<method>.sh" """
+    scripts = []
+    for dir, _, files in os.walk(cardDir):
+        scripts += [os.path.join(dir, f) for f in fnmatch.filter(files, '*_run_%s.sh'%method)]
+    return sorted(scripts)
+
+
+def done_marker(script):
+    return os.path.join(os.path.dirname(script), '.%s.done'%os.path.basename(script))
+
+
+def is_done(script, method, outputs=None):
+    """
+    A job is done when it ended successfully ( its .done marker is newer than the script ) and every combine output 
+    it produces is there and newer than the script : the outputs of all the combine commands of the script 
+    ( see expected_outputs ), or each of the comma-separated globs of outputs ( {name} is the script name 
+    without the _run_<method>.sh suffix ). The jobs without marker ( eg. run on slurm ) are done when all 
+    their outputs can be checked and are there
+    """
+    def fresh(path):
+        return os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(script)
+
+    dir = os.path.dirname(script)
+    if outputs is not None:
+        name  = os.path.basename(script)[:-len('_run_%s.sh'%method)]
+        found = [[f for f in glob.glob(os.path.join(dir, pattern.format(name=name))) if fresh(f)] for pattern in outputs.split(',')]
+        complete = all(found)
+    else:
+        expected = expected_outputs(script)
+        if expected is None or not expected:
+            # only the marker can tell
+            return fresh(done_marker(script))
+        listing  = {}
+        complete = True
+        for d, regex in expected:
+            if d not in listing:
+                listing[d] = os.listdir(d) if os.path.isdir(d) else []
+            if not any(regex.match(f) and fresh(os.path.join(d, f)) for f in listing[d]):
+                complete = False
+                break
+    if not complete:
+        return False
+    # a job run here that did not succeed has its log but no marker
+    return fresh(done_marker(script)) or not fresh(script[:-3]+'.log')
+
+
+def wait_for(p, timeout=None, interval=1.):
+    """ Exit code of the process p, None if it is still running after timeout seconds ( Popen.wait has no timeout in python 2 ) """
+    if timeout is None:
+        return p.wait()
+    end = time.time() + timeout
+    while p.poll() is None:
+        if time.time() >= end:
+            return None
+        time.sleep(min(interval, max(end - time.time(), 0.)))
+    return p.returncode
+
+
+def run_script(script, timeout=None, retries=0, link=None):
+    """
+    Run one generated combine script in its directory ( bash <script> ), the output goes to <script>.log
+    The job is killed after timeout seconds and tried again up to retries times
+    return : ( script, success, number of attempts, error message )
+    """
+    dir    = os.path.dirname(script)
+    if link is not None and not os.path.exists(os.path.join(dir, os.path.basename(link))):
+        # same as the ln -s -d of run_combine_*.sh for the fullrun2 cards
+        try:
+            os.symlink(link, os.path.join(dir, os.path.basename(link)))
+        except OSError as e:
+            if e.errno != errno.EEXIST: # else created by a job of the same directory
+                raise
+    error  = ''
+    if os.path.exists(done_marker(script)):
+        os.remove(done_marker(script))
+    for attempt in range(1, retries+2):
+        with open(script[:-3]+'.log', 'w') as log:
+            # new session, so that the whole process group can be killed at the timeout
+            p   = subprocess.Popen(['bash', os.path.basename(script)], cwd=dir, stdout=log, stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+            ret = wait_for(p, timeout)
+            if ret == 0:
+                with open(done_marker(script), 'w'):
+                    pass
+                return script, True, attempt, ''
+            elif ret is None:
+                os.killpg(p.pid, signal.SIGKILL)
+                p.wait()
+                error = 'timeout after %ss'%timeout
+            else:
+                error = 'exit code %s'%ret
+        logger.warning('%s failed ( %s ) [Attempt %s/%s]'%(os.path.basename(script), error, attempt, retries+1))
+    return script, False, retries+1, error
+
+
+def format_time(seconds):
+    m, s = divmod(int(seconds), 60)
+    h, m = divmod(m, 60)
+    return '%d:%02d:%02d'%(h, m, s)
+
+
+def LocalCombine(cardDir, method, nJobs, timeout=None, retries=0, resume=True, outputs=None, link=None, isTest=False):
+    """
+    Run the generated combine scripts of cardDir on a pool of nJobs local workers,
+    alternative to Combine4Slurm.SlurmCombine when the cluster queue is not needed
+    resume : skip the jobs that succeeded and whose outputs are all there ( see is_done )
+    return : list of the scripts that failed
+    """
+    scripts = find_scripts(cardDir, method)
+    if isTest:
+        scripts = scripts[:1]
+    todo = [s for s in scripts if not (resume and is_done(s, method, outputs))]
+    logger.info('%s combine scripts found in %s, %s already done, %s to run on %s workers'%(len(scripts), cardDir, len(scripts)-len(todo), len(todo), nJobs))
+    if not todo:
+        return []
+
+    failed   = []
+    finished = 0
+    start    = time.time()
+    pool     = ThreadPool(nJobs)
+    try:
+        for script, success, attempts, error in pool.imap_unordered(lambda s: run_script(s, timeout, retries, link), todo):
+            finished += 1
+            if not success:
+                failed.append(script)
+            elapsed = time.time() - start
+            eta     = elapsed / finished * (len(todo) - finished)
+            print('[%s/%s] %s %s | failed: %s | elapsed %s | ETA %s'%(finished, len(todo), 'done  ' if success else 'FAILED',
+                    os.path.basename(script), len(failed), format_time(elapsed), format_time(eta)))
+            sys.stdout.flush()
+    finally:
+        pool.close()
+        pool.join()
+
+    if failed:
+        logger.error('%s jobs failed, run again to retry only those :\n\t%s'%(len(failed), '\n\t'.join(failed)))
+    else:
+        logger.info('All %s jobs done in %s'%(len(todo), format_time(time.time() - start)))
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the combine scripts on a local pool of workers', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-c", "--cards"  , default=None, required=True, help="cards dir")
+    parser.add_argument("--method"       , action='store', type=str, required=True, help="method the scripts were generated for ( *_run_<method>.sh )")
+    parser.add_argument("-j", "--jobs"   , action='store', type=int, default=multiprocessing.cpu_count(), help="number of scripts run in parallel")
+    parser.add_argument("--timeout"      , action='store', type=float, default=None, help="time limit per job in seconds")
+    parser.add_argument("--retries"      , action='store', type=int, default=1, help="number of times a failed job is tried again")
+    parser.add_argument("--no-resume"    , action='store_false', dest='resume', default=True,
+                                           help="run all the jobs, even those with their outputs already there")
+    parser.add_argument("--outputs"      , action='store', type=str, default=None,
+                                           help="comma-separated globs of the outputs of a job in its directory, each must match\n"
+                                                "{name} is the script name without _run_<method>.sh\n"
+                                                "( default : the outputs of the combine commands of the script )")
+    parser.add_argument("--link"         , action='store', type=str, default=None, help="directory to link in each job directory ( fullrun2 cards )")
+    parser.add_argument("--test"         , action='store_true', dest='isTest', default=False, help="run only the first job")
+    options = parser.parse_args()
+
+    failed = LocalCombine(cardDir=options.cards, method=options.method, nJobs=options.jobs, timeout=options.timeout, retries=options.retries,
+                          resume=options.resume, outputs=options.outputs, link=options.link, isTest=options.isTest)
+    sys.exit(1 if failed else 0)
@@ -8,11 +8,13 @@ import glob
 import subprocess
 import re, hashlib
 import shutil
+import multiprocessing
 
 from math import sqrt
 from cppyy import gbl
 
 import Constants as Constants
+from ShapeCache import read_histograms
 logger = Constants.ZAlogger(__name__)
 
 decotheory     = False
@@ -23,6 +25,9 @@ splitTTbar     = False
 splitDrellYan  = False
 splitEraUL2016 = False
 rm_mix_lo_nlo_bbH_signal= True
+nWorkers       = 1
+shapeCache     = None
+histStore      = None
 
 def openFileAndGet(path, mode="read"):
     """Open ROOT file in a mode, check if open properly, and return TFile handle."""
@@ -273,6 +278,33 @@ def get_hist_from_key(keys=None, key=None):
     return None
 
 
+def _read_file_histograms(args):
+    """
+    Load the histograms of one input file for prepareFile, either directly
+    or through the shape cache. Also used as the worker in parallel mode, 
+    the histograms are detached from the file so they can be sent back to the parent process.
+    Return the histograms and the number of cache hits and misses.
+    """
+    process_file, nominal_names, cache = args
+    if cache is None:
+        return read_histograms(process_file, nominal_names), 0, 0
+    return cache.load(process_file, nominal_names)
+
+
+def list_histograms(path):
+    """
+    Return the (name, class name) of the keys in the file.
+    Taken from the histogram store index when the file is covered by it, 
+    otherwise from the ROOT file itself.
+    """
+    if histStore is not None and histStore.contains(path):
+        return [(name, histStore.className(path, name)) for name in histStore.keys(path)]
+    f = ROOT.TFile.Open(path)
+    keys = [(key.GetName(), key.GetClassName()) for key in f.GetListOfKeys()]
+    f.Close()
+    return keys
+
+
 def get_listofsystematics(files, cat, flavor=None, reg=None, multi_signal=False):
     
     if cat is not None:
@@ -285,17 +317,16 @@ def get_listofsystematics(files, cat, flavor=None, reg=None, multi_signal=False)
 
     systematics = []
     for f in files:
-        open_f = ROOT.TFile(f)
         avoid  = []
-        for key in open_f.GetListOfKeys():
-            if not 'TH1' in key.GetClassName():
+        for name, className in list_histograms(f):
+            if not 'TH1' in className:
                 continue
-            if not '__' in key.GetName():
+            if not '__' in name:
                 continue
-            if not 'down' in key.GetName(): # or up doesn't matter
+            if not 'down' in name: # or up doesn't matter
                 continue
 
-            syst = key.GetName().split('__')[1].replace('down','')
+            syst = name.split('__')[1].replace('down','')
             
             if   flavor == 'MuMu': avoid += elel + muel 
             elif flavor == 'ElEl': avoid += mumu + muel +['mu_trigger']
@@ -319,7 +350,6 @@ def get_listofsystematics(files, cat, flavor=None, reg=None, multi_signal=False)
                 if not any(x in syst for x in avoid):
                     systematics.append(syst)
         
-        open_f.Close()
     return systematics
 
 
@@ -607,6 +637,10 @@ def merge_histograms(smp=None, smpScale=None, process=None, histogram=None, dest
         # In case is needed , but this already should be done 
         # in the post-processing step in bamboo
         #logger.info('I am scaling here process %s by %s '%(process, smpScale))
+        # scale a copy : in parallel or cached mode the same histogram object is returned for
+        # each category it is mapped to, it must not be scaled again at each use
+        histogram = histogram.Clone()
+        histogram.SetDirectory(ROOT.nullptr)
         histogram.Scale(smpScale)
     
     d = destination
@@ -776,11 +810,9 @@ def prepareFile(processes_map, categories_map, input, output_filename, signal_pr
     ref_file = processes_files[tt][0]
     print("Extract histogram names from {}".format(ref_file))
 
-    f = ROOT.TFile.Open(ref_file)
-    keys = [n.GetName() for n in f.GetListOfKeys()]
+    keys = [name for name, className in list_histograms(ref_file)]
     if len(keys) == 0:
         raise Exception('There are no histograms in file %s, aborting now' % ref_file)
-    f.Close()
     print("Done.")
 
     # Create the list of histograms (nominal + systematics) for each category
@@ -859,6 +891,34 @@ def prepareFile(processes_map, categories_map, input, output_filename, signal_pr
     shapes = {}
     smpScale = None
     
+    # In parallel mode, the input files are read by a pool of workers (one file per task)
+    # and the histograms are merged below in the same order as in the serial mode,
+    # so the output file is identical.
+    # With the shape cache, the unchanged input files are read from the cache instead
+    loaded = None
+    cache_hits, cache_misses = 0, 0
+    if nWorkers > 1 or shapeCache is not None:
+        tasks = []
+        for process, process_files in processes_files.items():
+            process_specific_to_signal_hypo = process[1] if type(process) is tuple else None
+            nominal_names = set()
+            for cat in analysis_categories:
+                for category, original_histogram_name in histograms_per_cat[cat].items():
+                    if type(category) is tuple and category[1] and process_specific_to_signal_hypo:
+                        if category[1] != process_specific_to_signal_hypo:
+                            continue
+                    nominal_names.add(original_histogram_name)
+            for process_file in process_files:
+                if not process_file.split('/')[-1].startswith('__skeleton__'):
+                    tasks.append((process_file, nominal_names, shapeCache))
+        
+        if nWorkers > 1:
+            logger.info("Loading histograms from %s files using %s workers"%(len(tasks), nWorkers))
+            pool   = multiprocessing.Pool(nWorkers)
+            loaded = pool.imap(_read_file_histograms, tasks)
+        else:
+            loaded = (_read_file_histograms(task) for task in tasks)
+
     # Try to open each file once
     for process, process_files in processes_files.items():
         process_specific_to_signal_hypo = None
@@ -878,12 +938,19 @@ def prepareFile(processes_map, categories_map, input, output_filename, signal_pr
         #    systematic_process = signal_process
 
         for process_file in process_files:
-            f = ROOT.TFile.Open(process_file)
-            
             smp  = process_file.split('/')[-1]
             smpNm= smp.replace('.root', '') 
             if smp.startswith('__skeleton__'):
                 continue
+            
+            f = None
+            if loaded is not None:
+                hists, hits, misses = next(loaded)
+                cache_hits   += hits
+                cache_misses += misses
+                get_hist = hists.get
+            else:
+                f = ROOT.TFile.Open(process_file)
 
             smpScale =None
             if normalize:
@@ -923,12 +990,14 @@ def prepareFile(processes_map, categories_map, input, output_filename, signal_pr
                     xsc  = scalefactors['files'][smp]['cross-section']
                     smpScale = (xsc*lumi)/sumW
 
-            # Build a dict key name -> key for faster access
-            keys = {}
-            for key in f.GetListOfKeys():
-                # Only keep the highest cycle
-                if not key.GetName() in keys:
-                    keys[key.GetName()] = key
+            if f:
+                # Build a dict key name -> key for faster access
+                keys = {}
+                for key in f.GetListOfKeys():
+                    # Only keep the highest cycle
+                    if not key.GetName() in keys:
+                        keys[key.GetName()] = key
+                get_hist = lambda name: get_hist_from_key(keys, name)
 
             for cat in analysis_categories:
                 if not cat in final_systematics:
@@ -962,7 +1031,7 @@ def prepareFile(processes_map, categories_map, input, output_filename, signal_pr
                 
                     # Load nominal shape
                     try:
-                        hist = get_hist_from_key(keys, original_histogram_name)
+                        hist = get_hist(original_histogram_name)
                         shapes_category_process['nominal'] = merge_histograms(smp, smpScale, process, hist, shapes_category_process.get('nominal', None), lumi, normalize)
                     except:
                         raise Exception('Missing histogram %r in %r for %r. This should not happen.' % (original_histogram_name, process_file, process_with_flavor))
@@ -977,7 +1046,7 @@ def prepareFile(processes_map, categories_map, input, output_filename, signal_pr
                         has_both = True
                         for variation in ['up', 'down']:
                             key = cms_systematic + variation.capitalize()
-                            h   = get_hist_from_key(keys, original_histogram_name + '__' + systematic + variation)
+                            h   = get_hist(original_histogram_name + '__' + systematic + variation)
                             if h:
                                 try:
                                     shapes_category_process[key] = merge_histograms(smp, smpScale, process, h, shapes_category_process.get(key, None), lumi, normalize)
@@ -988,8 +1057,16 @@ def prepareFile(processes_map, categories_map, input, output_filename, signal_pr
                         if has_both:
                             final_systematics_category_process.add(cms_systematic)
 
-            f.Close()
+            if f:
+                f.Close()
         print("Done.")
+    
+    if nWorkers > 1:
+        pool.close()
+        pool.join()
+    if shapeCache is not None:
+        logger.info("Shape cache: %s hits, %s misses"%(cache_hits, cache_misses))
+        shapeCache.evict()
 
     for cat in analysis_categories:
         for category, d in final_systematics[cat].items():
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+import os, os.path
+import re
+import json
+import glob
+import shutil
+import argparse
+import numpy as np
+
+import Constants as Constants
+logger = Constants.ZAlogger(__name__)
+
+STORE_DIRNAME = '.histstore'
+
+
+class HistStore:
+    """
+        Columnar store of the histograms of a bamboo results/ directory
+        Each results file is indexed once into its own sub-directory of the store :
+            contents.npy : bin contents of all the histograms of the file, concatenated
+            sumw2.npy    : quadratic bin errors, same layout as contents
+            edges.npy    : bin edges of all the histograms ( x then y for TH2 )
+            index.json   : name -> (class, systematic, shape, offset, edges offset) and the
+                           size/mtime of the results file when it was indexed
+        The arrays keep the dtype given by NumpyHist.getFromRoot, so a histogram read from the store
+        is the same as the one converted from ROOT. They are memory-mapped : a histogram is read by
+        name in O(1) without any ROOT I/O, and the regex look-ups only run over the names in the index.
+        A results file that changed since it was indexed ( size or mtime ) is indexed again.
+        The listing side ( contains, keys, className, systematic, match ) also runs under the python 2.7
+        of CMSSW ( prepareShapesAndCards.py, with update=False : the files not indexed or changed since are
+        not covered ), indexing and get() need python 3 ( numpy_hist ) : python3 HistStore.py -i results/
+    """
+    def __init__(self, results_dir, store_dir=None, update=True):
+        """
+            results_dir : bamboo results/ directory
+            store_dir   : where the store lives ( default : results_dir/.histstore )
+            update      : index the new or changed results files now
+        """
+        self._results_dir = os.path.abspath(results_dir)
+        self._store_dir   = store_dir if store_dir is not None else os.path.join(self._results_dir, STORE_DIRNAME)
+        self._indices     = {}
+        self._arrays      = {}
+        if update:
+            if not os.path.isdir(self._store_dir):
+                os.makedirs(self._store_dir)
+            self.update()
+
+    #################################################################################################
+    #                                          indexing                                             #
+    #################################################################################################
+    def _entry(self, smp):
+        return os.path.join(self._store_dir, smp)
+
+    def _stamp(self, smp):
+        st = os.stat(os.path.join(self._results_dir, smp))
+        return {'size': st.st_size, 'mtime': st.st_mtime}
+
+    def isUpToDate(self, smp):
+        """ Check that the results file smp has been indexed since its last change """
+        index_path = os.path.join(self._entry(smp), 'index.json')
+        if not os.path.exists(index_path):
+            return False
+        with open(index_path) as f:
+            index = json.load(f)
+        return index['source'] == self._stamp(smp)
+
+    def update(self):
+        """ Index the results files that are new or changed since they were indexed """
+        for path in sorted(glob.glob(os.path.join(self._results_dir, '*.root'))):
+            smp = os.path.basename(path)
+            if smp.startswith('__skeleton__'):
+                continue
+            if not self.isUpToDate(smp):
+                self.indexFile(smp)
+
+    def indexFile(self, smp):
+        """ Read once all TH1/TH2 of the results file smp and write them in the store """
+        import ROOT
+        from numpy_hist import NumpyHist
+        path   = os.path.join(self._results_dir, smp)
+        stamp  = self._stamp(smp)
+        logger.info('indexing {}'.format(path))
+
+        hists    = {}
+        contents = []
+        sumw2    = []
+        edges    = []
+        offset   = 0
+        e_offset = 0
+        f = ROOT.TFile.Open(path)
+        if not f or f.IsZombie():
+            raise RuntimeError('Could not open file {}'.format(path))
+        for key in f.GetListOfKeys():
+            name = key.GetName()
+            # Only keep the highest cycle
+            if name in hists:
+                continue
+            if not key.GetClassName().startswith(('TH1', 'TH2')):
+                continue
+            nph = NumpyHist.getFromRoot(key.ReadObj())
+            e   = [nph.e] if nph.ndim == 1 else nph.e
+            systematic = name.split('__')[1] if '__' in name else ''
+            hists[name] = [key.GetClassName(), systematic, list(nph.dims), offset, e_offset]
+            contents.append(nph.w.ravel())
+            sumw2.append(nph.s2.ravel())
+            edges   += list(e)
+            offset   += nph.w.size
+            e_offset += sum(x.shape[0] for x in e)
+        f.Close()
+
+        # Write in a temporary directory first, the store is never left half-written
+        entry = self._entry(smp)
+        tmp   = entry + '.tmp'
+        if os.path.isdir(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        np.save(os.path.join(tmp, 'contents.npy'), np.concatenate(contents) if contents else np.zeros(0))
+        np.save(os.path.join(tmp, 'sumw2.npy'), np.concatenate(sumw2) if sumw2 else np.zeros(0))
+        np.save(os.path.join(tmp, 'edges.npy'), np.concatenate(edges) if edges else np.zeros(0))
+        with open(os.path.join(tmp, 'index.json'), 'w') as f:
+            json.dump({'source': stamp, 'hists': hists}, f)
+        if os.path.isdir(entry):
+            shutil.rmtree(entry)
+        os.rename(tmp, entry)
+        self._indices.pop(smp, None)
+        self._arrays.pop(smp, None)
+
+    #################################################################################################
+    #                                          look-ups                                             #
+    #################################################################################################
+    def contains(self, path):
+        """ Return True if path is a results file covered by this store, indexed since its last change """
+        return os.path.dirname(os.path.abspath(path)) == self._results_dir and self.isUpToDate(os.path.basename(path))
+
+    def _index(self, path):
+        smp = os.path.basename(path)
+        if smp not in self._indices:
+            if not self.isUpToDate(smp):
+                self.indexFile(smp)
+            with open(os.path.join(self._entry(smp), 'index.json')) as f:
+                self._indices[smp] = json.load(f)['hists']
+        return self._indices[smp]
+
+    def _array(self, path, what):
+        smp = os.path.basename(path)
+        arrays = self._arrays.setdefault(smp, {})
+        if what not in arrays:
+            arrays[what] = np.load(os.path.join(self._entry(smp), '{}.npy'.format(what)), mmap_mode='r')
+        return arrays[what]
+
+    def keys(self, path):
+        """ Names of all the histograms of the results file """
+        return [str(n) for n in self._index(path)] # str : the json names are unicode under python 2
+
+    def className(self, path, name):
+        """ ROOT class of the histogram, as TKey.GetClassName() """
+        return str(self._index(path)[name][0])
+
+    def systematic(self, path, name):
+        """ Systematic variation of the histogram ( '' for the nominal ) """
+        return str(self._index(path)[name][1])
+
+    def match(self, path, regex, flags=re.IGNORECASE):
+        """ Names of the histograms of the results file matching regex ( re.search ) """
+        r = re.compile(regex, flags)
+        return [str(n) for n in self._index(path) if r.search(n)]
+
+    def get(self, path, name):
+        """ Return the histogram as a NumpyHist, the contents are read-only views on the store """
+        from numpy_hist import NumpyHist
+        cls, systematic, dims, offset, e_offset = self._index(path)[name]
+        size = int(np.prod(dims))
+        w  = self._array(path, 'contents')[offset:offset+size].reshape(dims)
+        s2 = self._array(path, 'sumw2')[offset:offset+size].reshape(dims)
+        all_edges = self._array(path, 'edges')
+        if len(dims) == 1:
+            e = all_edges[e_offset:e_offset+dims[0]+1]
+        else:
+            e = [all_edges[e_offset:e_offset+dims[0]+1],
+                 all_edges[e_offset+dims[0]+1:e_offset+dims[0]+dims[1]+2]]
+        return NumpyHist(e, w, s2, name)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index a bamboo results directory into a columnar histogram store')
+    parser.add_argument('-i', '--input', action='store', required=True,
+                            help='bamboo results/ directory')
+    parser.add_argument('-o', '--output', action='store', required=False, default=None,
+                            help='store directory ( default : input/{} )'.format(STORE_DIRNAME))
+    args = parser.parse_args()
+
+    store = HistStore(args.input, args.output)
+    logger.info('{} indexed in {}'.format(args.input, store._store_dir))
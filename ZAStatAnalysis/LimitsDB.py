@@ -0,0 +1,153 @@
+#! /bin/env python
+import os, os.path
+import json
+import sqlite3
+import hashlib
+
+import Constants as Constants
+logger = Constants.ZAlogger(__name__)
+
+DB_NAME = 'limits.sqlite'
+
+HYBRIDNEW_QUANTILES = ['0.500', '0.840', '0.160', '0.975', '0.025']
+
+
+def combine_outputs(input_file, method):
+    """ All the combine output files from which the limits of input_file are extracted """
+    if method == 'hybridnew':
+        return [input_file] + [input_file[:-5]+'.quant{}.root'.format(q) for q in HYBRIDNEW_QUANTILES]
+    return [input_file]
+
+
+def checksum(input_file, method):
+    """ sha1 of the content of the combine output file(s) of one point, None if one of them is missing """
+    h = hashlib.sha1()
+    for path in combine_outputs(input_file, method):
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+class LimitsDB:
+    """
+        On-disk database of the limits collected by collectLimits.py
+        One row per combine output file ( per era ), keyed by the mass point, the method, the category
+        ( {process}_{reco}_{region}_{flavor} ), the CL, the era and the checksum of the combine output(s).
+        A combine output is only parsed again when its checksum changed, the points for which no limit
+        could be extracted are kept too ( with empty limits ) so they are not parsed again either.
+        The rows of the files that are not collected anymore are removed ( prune ). The position of each file
+        in the last collection is kept, so that the limits are returned in the same
+        order and with the same selection ( no point with expected == 0 ) as the combinedlimits_*.json files :
+            [ {'parameters': (mHeavy, mLight), 'limits': {'expected', 'observed', 'one_sigma', 'two_sigma'}}, ... ]
+    """
+    def __init__(self, path):
+        """ path : sqlite file, or directory in which limits.sqlite lives """
+        if os.path.isdir(path):
+            path = os.path.join(path, DB_NAME)
+        self.path = path
+        self._db  = sqlite3.connect(path)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS limits (
+                                file       TEXT NOT NULL,
+                                era        TEXT NOT NULL,
+                                checksum   TEXT NOT NULL,
+                                method     TEXT NOT NULL,
+                                category   TEXT NOT NULL,
+                                cl         TEXT NOT NULL,
+                                mHeavy     TEXT NOT NULL,
+                                mLight     TEXT NOT NULL,
+                                limits     TEXT,
+                                position   INTEGER NOT NULL DEFAULT 0,
+                                PRIMARY KEY (file, era) )""")
+        # databases written before the position was recorded
+        if 'position' not in [col[1] for col in self._db.execute("PRAGMA table_info(limits)")]:
+            self._db.execute("ALTER TABLE limits ADD COLUMN position INTEGER NOT NULL DEFAULT 0")
+        self._db.execute("CREATE INDEX IF NOT EXISTS limits_category ON limits (category, cl, era)")
+        self._db.commit()
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get(self, input_file, era, method, checksum):
+        """
+            Return ( found, limits ) for input_file :
+                found  : the file was already parsed with the same checksum
+                limits : the limits dict ( None if no limit could be extracted )
+        """
+        row = self._db.execute("SELECT checksum, method, limits FROM limits WHERE file=? AND era=?", (os.path.abspath(input_file), era)).fetchone()
+        if row is None or checksum is None or row[0] != checksum or row[1] != method:
+            return False, None
+        return True, (json.loads(row[2]) if row[2] is not None else None)
+
+    def put(self, input_file, era, method, checksum, category, cl, mHeavy, mLight, limits, position=0):
+        """
+            Record the limits extracted from input_file ( limits = None if none was found )
+            position : order of input_file in the collection, the order of the points in the json files
+        """
+        self._db.execute("INSERT OR REPLACE INTO limits VALUES (?,?,?,?,?,?,?,?,?,?)",
+                         (os.path.abspath(input_file), era, checksum or '', method, category, cl, mHeavy, mLight,
+                          json.dumps(limits) if limits is not None else None, position))
+
+    def prune(self, category, cl, era, method, files):
+        """
+            Remove the rows of the category that were not recorded in the last collection ( files ) : 
+            combine outputs that disappeared, are incomplete or no longer collected
+        """
+        keep  = set(os.path.abspath(f) for f in files)
+        stale = [(f,) for f, in self._db.execute("SELECT file FROM limits WHERE category=? AND cl=? AND era=? AND method=?",
+                                                  (category, cl, era, method)) if f not in keep]
+        self._db.executemany("DELETE FROM limits WHERE file=? AND era=?", [(f, era) for f, in stale])
+        return len(stale)
+
+    def commit(self):
+        self._db.commit()
+
+    def query(self, category, cl, era, method=None):
+        """
+            Limits of one category, same format, order and points as the combinedlimits_*.json files :
+            the points without limits or with expected == 0 are skipped
+        """
+        sql  = "SELECT mHeavy, mLight, limits FROM limits WHERE category=? AND cl=? AND era=? AND limits IS NOT NULL"
+        args = [category, cl, era]
+        if method is not None:
+            sql += " AND method=?"
+            args.append(method)
+        sql += " ORDER BY position, file"
+        points = []
+        for mHeavy, mLight, limits in self._db.execute(sql, args):
+            limits = json.loads(limits)
+            if limits['expected'] == 0:
+                continue
+            points.append({'parameters': [mHeavy, mLight], 'limits': limits})
+        return points
+
+
+def read_limits(jsonpath, category, cl, era, db=False):
+    """
+        Limits of one category from jsonpath ( the jsons/<poi>/<tb> directory written by collectLimits.py )
+        db : read them from the limits database instead of the combinedlimits_*.json file
+        return None if not found
+    """
+    if db:
+        path = os.path.join(jsonpath, DB_NAME)
+        if not os.path.isfile(path):
+            logger.warning('{} , requested limits database does not exist !'.format(path))
+            return None
+        with LimitsDB(path) as limitsDB:
+            limits = limitsDB.query(category, cl, era)
+        return limits if limits else None
+
+    json_f = os.path.join(jsonpath, 'combinedlimits_{}_{}_UL{}.json'.format(category, cl, era))
+    if not os.path.isfile(json_f):
+        return None
+    with open(json_f) as f:
+        return json.load(f)
@@ -21,6 +21,13 @@ from numpy_hist import NumpyHist
     The class object, which now contains the new bin edges can be applied on any ROOT histogram 
     to return a rebinned histogram
 
+    To apply the same edges to many histograms (eg all variations of all processes), the batch methods 
+    avoid one conversion per histogram :
+        ```
+            nphs = obj.batch([h1,h2,...])           # list of rebinned NumpyHist, h.fillHistogram(name) when writing
+            nw,ns2 = obj.rebinArrays(e,w,s2)        # w,s2 stacked arrays [N_hists, N_bins]
+        ```
+
     Available algorithms : 
     - Boundary  : New axis edges are provided directly as parameters (simplest method)
         example : 
@@ -140,6 +147,23 @@ from numpy_hist import NumpyHist
         of bins in linearized histogram can be quite large.
 """
 
+def _firstPassing(passing, start, stop, end):
+    """
+        First bin i in [start, stop) for which passing(start, end)[i-start] is True, None if there is none
+        passing(start, end) : condition on the bins [start, end), with the sums restarted at start
+        end : guess of the caller, the window is doubled until a bin passes so that finding all the 
+              new bins of a histogram costs about one pass over its bins
+    """
+    end = min(max(end, start + 1), stop)
+    while True:
+        passed = passing(start, end)
+        if passed.any():
+            return start + int(np.argmax(passed))
+        if end >= stop:
+            return None
+        end = min(stop, start + 2 * (end - start))
+
+
 class Rebin:
     """
         Base rebin method
@@ -159,6 +183,44 @@ class Rebin:
 
         return nph.rebin(self.ne).fillHistogram(h.GetName()+'rebin')
 
+    def rebinArrays(self,e,w,s2):
+        """
+            Apply the new bin edges to a stack of histograms sharing the same axes
+            e  : bin edges of the histograms
+            w  : stacked bin contents [N_hists, N_bins] (or [N_hists, Nx, Ny] in 2D)
+            s2 : stacked quadratic bin errors, same shape as w
+            return : rebinned contents and quadratic errors, as numpy arrays
+        """
+        if not hasattr(self,'ne'):
+            raise RuntimeError('New bin edges have not been computed, is the rebin_method() not implemented ?')
+        return NumpyHist.rebinArrays(e,w,s2,self.ne)
+
+    def batch(self,hists):
+        """
+            input : list of TH1 or NumpyHist with the same axes (eg all the variations of all the processes)
+            return : list of rebinned NumpyHist (None for the histograms with nan, as in __call__)
+                     the ROOT histograms can be produced when writing with `fillHistogram`
+        """
+        nphs = [h if isinstance(h,NumpyHist) else NumpyHist.getFromRoot(h) for h in hists]
+        valid = []
+        for i,nph in enumerate(nphs):
+            if np.isnan(nph.w).any():
+                logging.warning('Warning : nan found in hist %s'%nph.name)
+            else:
+                if len(valid) > 0:
+                    nphs[valid[0]].compareAxes(nph)
+                valid.append(i)
+        out = [None] * len(nphs)
+        if len(valid) == 0:
+            return out
+        e = nphs[valid[0]].e
+        nw,ns2 = self.rebinArrays(e,
+                                  np.stack([nphs[i].w for i in valid]),
+                                  np.stack([nphs[i].s2 for i in valid]))
+        for j,i in enumerate(valid):
+            out[i] = NumpyHist(self.ne,nw[j],ns2[j],nphs[i].name)
+        return out
+
     @staticmethod
     def _processHist(h):
         """
@@ -196,6 +258,58 @@ class Rebin:
 
         return nph 
 
+    def _scanFactor(self,get_edges,nbins,check_epsilon=False):
+        """
+            Threshold scan shared by Threshold and Threshold2
+            get_edges(factor) : bin edges obtained with the thresholds scaled by factor
+            The factor is lowered from 1 by steps of epsilon (refined close to 0, or when the number of bins 
+            jumps above nbins), the last binning with nbins bins before getting too many bins is kept
+            check_epsilon : stop the refinement when epsilon reaches its minimum (Threshold2)
+            return : the binning found (None if not) and the last edges tried
+        """
+        cache = {}
+        def edges(factor):
+            if factor not in cache:
+                cache[factor] = get_edges(factor)
+            return cache[factor]
+
+        factor = 1.
+        epsilon = 0.01
+        epsilon_min = epsilon * 1e-9
+        found = None
+
+        while factor > 0.: # factor loop #
+            ne = edges(factor)
+            logging.debug(f'\tTrying factor {factor} (epsilon = {epsilon}), number of bins = {len(ne)}')
+            if ne.shape[0] <= nbins + 1: # Not too far
+                # if perfect number -> record it #
+                if ne.shape[0] == nbins + 1:
+                    found = ne
+                # Iteration #
+                if factor - epsilon > 0 or epsilon < epsilon_min:
+                    factor -= epsilon
+                else:
+                    epsilon /= 10
+                # Even if we found the correct number of bins, we want to continue, 
+                # maybe first bin is not populated as much as it could be 
+            else: #ne.shape[0] > nbins + 1 ->  # Too far
+                if found is None and (not check_epsilon or epsilon > epsilon_min):
+                    # Not converged, maybe we passed over the good threshold
+                    # Go back one step, and divide epsilon 
+                    factor += epsilon
+                    epsilon /= 10
+                    # Can't find the perfect point between too many and two few bins, just merge the first bins until it matches #
+                    if epsilon < epsilon_min:
+                        excess_bins = ne.shape[0]-(nbins+1)
+                        assert excess_bins > 0
+                        found = copy(ne[excess_bins:])
+                        found[0] = ne[0]
+                        logging.debug(f"Cannot find the sweet spot, will merge the first bins : {ne} [{ne.shape[0]} bins]  -> {found} [{found.shape[0]} bins]")
+                        break
+                else:
+                    # the binning has been found, will not get better
+                    break
+        return found,ne
 
 
 class Quantile(Rebin):
@@ -296,57 +410,26 @@ class Threshold(Rebin):
         if nph.w.shape[0] < thresh.shape[0]:
             raise RuntimeError("Fewer bins than thresholds")
 
+        def get_edges(factor):
+            thresh_test = thresh * factor * nph.w.sum() / thresh.max() 
+            # Get idx #
+            idx = self.rebin_method(thresh  = thresh_test,
+                                    val     = nph.w, 
+                                    var     = nph.s2,
+                                    extra   = extra_ws,
+                                    rsut    = rsut)
+            if len(idx) > 0 and nph.w[0 : idx[0]].sum() < nph.w[idx[0] : (idx[1] if len(idx) > 1 else None)].sum(): # merge two first bins in case rising in content
+                idx = idx[1:]     
+            # Get bin edges #
+            return np.unique(np.r_[nph.e[0], nph.e[idx] , nph.e[-1]])
+
         # Threshold scan #
         logging.debug("Starting scan for Threshold")
         nbins = thresh.shape[0]
         rsut_trials = 1
         rsut_trials_max = 10
         while rsut_trials <= rsut_trials_max: # Rsut loop 
-            factor = 1.
-            epsilon = 0.01
-            epsilon_min = epsilon * 1e-9
-            self.ne = None
-            while factor > 0.: # factor loop #
-                thresh_test = thresh * factor * nph.w.sum() / thresh.max() 
-                # Get idx #
-                idx = self.rebin_method(thresh  = thresh_test,
-                                        val     = nph.w, 
-                                        var     = nph.s2,
-                                        extra   = extra_ws,
-                                        rsut    = rsut)
-                if len(idx) > 0 and nph.w[0 : idx[0]].sum() < nph.w[idx[0] : (idx[1] if len(idx) > 1 else None)].sum(): # merge two first bins in case rising in content
-                    idx = idx[1:]     
-                # Get bin edges #
-                ne = np.unique(np.r_[nph.e[0], nph.e[idx] , nph.e[-1]])
-                logging.debug(f'\tTrying factor {factor} (epsilon = {epsilon}), number of bins = {len(ne)}')
-                if ne.shape[0] <= nbins + 1: # Not too far
-                    # if perfect number -> record it #
-                    if ne.shape[0] == nbins + 1:
-                        self.ne = ne
-                    # Iteration #
-                    if factor - epsilon > 0 or epsilon < epsilon_min:
-                        factor -= epsilon
-                    else:
-                        epsilon /= 10
-                    # Even if we found the correct number of bins, we want to continue, 
-                    # maybe first bin is not populated as much as it could be 
-                else: #self.ne.shape[0] > nbins + 1 ->  # Too far
-                    if self.ne is None:
-                        # Not converged, maybe we passed over the good threshold
-                        # Go back one step, and divide epsilon 
-                        factor += epsilon
-                        epsilon /= 10
-                        # Can't find the perfect point between too many and two few bins, just merge the first bins until it matches #
-                        if epsilon < epsilon_min:
-                            excess_bins = ne.shape[0]-(nbins+1)
-                            assert excess_bins > 0
-                            self.ne = copy(ne[excess_bins:])
-                            self.ne[0] = ne[0]
-                            logging.debug(f"Cannot find the sweet spot, will merge the first bins : {ne} [{ne.shape[0]} bins]  -> {self.ne} [{self.ne.shape[0]} bins]")
-                            break
-                    else:
-                        # self.ne has been found, will not get better
-                        break
+            self.ne,ne = self._scanFactor(get_edges,nbins)
             if self.ne is None: # Still not found 
                 self.ne = ne
             if self.ne.shape[0] != nbins +1:
@@ -369,15 +452,16 @@ class Threshold(Rebin):
             var    : variance of each bin
             extra  : additional contributions to be kept above threshold
             rsut   : relative stat. unc. threshold
+            
+            Each new bin is found with cumulative sums restarted at the current position, as in a loop over 
+            the bins, on a window of bins that starts where the running total of the histogram reaches the 
+            threshold and is doubled until the bin is found (see _firstPassing) : the result is the same as the 
+            loop, for about one pass over the histogram
         """
         assert thresh.shape[0] < val.shape[0]     
         assert np.all(thresh >= 0)     
         assert rsut >= 0.0 
 
-        sum_val = 0
-        sum_var = 0
-        sum_extra = np.zeros_like(extra[0])
-
         val = val[::-1]
         var = var[::-1]
         extra = extra[::-1]
@@ -386,19 +470,27 @@ class Threshold(Rebin):
         lt = len(thresh)
         idx = np.zeros(lt, dtype=np.intp)
         tidx = -1
-        for i in range(la):
-            if tidx < -lt:
-                break
-            sum_val += val[i]
-            sum_var += var[i]
-            sum_extra += extra[i]
+        start = 0
+        # the running total can only locate the bins when it increases
+        total = np.cumsum(val) if np.all(val >= 0) else None
+
+        def passing(start, end):
+            sum_val = np.cumsum(val[start:end])
+            sum_var = np.cumsum(var[start:end])
+            sum_extra = np.cumsum(extra[start:end], axis=0)
             unc = np.sqrt(sum_var)
-
-            if (sum_val - unc) >= thresh[tidx] and np.all(sum_extra) and np.abs((unc / sum_val)) <= rsut:
+            return ((sum_val - unc) >= thresh[tidx]) & np.all(sum_extra, axis=1) & (np.abs(unc / sum_val) <= rsut)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            while start < la and tidx >= -lt:
+                end = start + 1
+                if total is not None: # sum_val - unc >= thresh needs sum_val >= thresh
+                    end = np.searchsorted(total, (total[start-1] if start > 0 else 0.) + thresh[tidx]) + 1
+                i = _firstPassing(passing, start, la, end)
+                if i is None:
+                    break
                 idx[tidx] = la - 1 - i
-                sum_val = 0.0
-                sum_var = 0.0
-                sum_extra[:] = 0.0
+                start = i + 1
                 tidx -= 1
 
         return idx[1 + tidx :]     
@@ -455,57 +547,26 @@ class Threshold2(Rebin):
         # Need to inverse because rebin_method goes from left to right
         data = data[:,::-1]
 
+        def get_edges(factor):
+            thresh_test = thresh * factor * ws.sum() / thresh.max() 
+            idx = self.rebin_method(thresh  = thresh_test,
+                                    data    = data,
+                                    fallback=fallback)
+            # Invert back the bin indexes #
+            idx = data.shape[1] - 1 - idx[::-1]
+            # fuse left-most two bins if they are rising in content #
+            if len(idx) > 0 and totval[0 : idx[0]].sum() < totval[idx[0] : (idx[1] if len(idx) > 1 else None)].sum():
+                idx = idx[1:]
+            # Make binning #
+            return np.unique(np.r_[e[0], e[idx] , e[-1]])
+
         # Threshold scan #
         logging.debug("Starting scan for Threshold2")
         nbins = thresh.shape[0]
         variance_trials = 1
         variance_trials_max = 10
         while variance_trials < variance_trials_max:
-            factor = 1.
-            epsilon = 0.01
-            epsilon_min = epsilon * 1e-9
-            self.ne = None
-            while factor > 0.:
-                thresh_test = thresh * factor * ws.sum() / thresh.max() 
-                idx = self.rebin_method(thresh  = thresh_test,
-                                        data    = data,
-                                        fallback=fallback)
-                # Invert back the bin indexes #
-                idx = data.shape[1] - 1 - idx[::-1]
-                # fuse left-most two bins if they are rising in content #
-                if len(idx) > 0 and totval[0 : idx[0]].sum() < totval[idx[0] : (idx[1] if len(idx) > 1 else None)].sum():
-                    idx = idx[1:]
-                # Make binning #
-                ne = np.unique(np.r_[e[0], e[idx] , e[-1]])
-                logging.debug(f'\tTrying factor {factor} (epsilon = {epsilon}), number of bins = {len(ne)}')
-                if ne.shape[0] <= nbins + 1: # Not too far
-                    # if perfect number -> record it #
-                    if ne.shape[0] == nbins + 1:
-                        self.ne = ne
-                    # Iteration #
-                    if factor - epsilon > 0 or epsilon < epsilon_min:
-                        factor -= epsilon 
-                    else:
-                        epsilon /= 10
-                    # Even if we found the correct number of bins, we want to continue, 
-                    # maybe first bin is not populated as much as it could be 
-                else: #self.ne.shape[0] > nbins + 1 ->  # Too far
-                    if self.ne is None and epsilon > epsilon_min:
-                        # Not converged, maybe we passed over the good threshold
-                        # Go back one step, and divide epsilon 
-                        factor += epsilon
-                        epsilon /= 10
-                        # Can't find the perfect point between too many and two few bins, just merge the first bins until it matches #
-                        if epsilon < epsilon_min:
-                            excess_bins = ne.shape[0]-(nbins+1)
-                            assert excess_bins > 0
-                            self.ne = copy(ne[excess_bins:])
-                            self.ne[0] = ne[0]
-                            logging.debug(f"Cannot find the sweet spot, will merge the first bins : {ne} [{ne.shape[0]} bins]  -> {self.ne} [{self.ne.shape[0]} bins]")
-                            break
-                    else:
-                        # self.ne has been found, will not get better
-                        break
+            self.ne,ne = self._scanFactor(get_edges,nbins,check_epsilon=True)
             if self.ne is None: # Still not found 
                 self.ne = ne
             if self.ne.shape[0] != nbins +1:
@@ -535,6 +596,11 @@ class Threshold2(Rebin):
         fallback: floaty[P]
 
         note: bins are built "from left to right"
+        
+        Each new bin is found with cumulative sums over the bins restarted at the current position, on a window 
+        of bins that starts where the running total reaches the threshold and is doubled until the bin is found 
+        (see _firstPassing). The sums over the processes are done on contiguous rows, in the same order as np.sum 
+        on a single bin, so the result is the same as a loop over the bins
         """
         assert thresh.ndim == 1
         assert data.ndim == 2
@@ -542,23 +608,36 @@ class Threshold2(Rebin):
         assert thresh.shape[0] > 0
         assert data.shape[0] == fallback.shape[0]
 
-        acc_val = np.zeros(data.shape[:1])
-        acc_var = np.zeros(data.shape[:1])
+        values    = data["value"]
+        variances = data["variance"]
         idx = np.zeros(thresh.shape, dtype=np.intp)
         idx_num = 0
-        for bin_curr in range(data.shape[1]):
-            acc_val += data["value"][:, bin_curr]
-            acc_var += data["variance"][:, bin_curr]
-            tot_val = np.sum(acc_val)
-            tot_var = np.sum(np.where(acc_var, acc_var, fallback))
-            if tot_val - np.sqrt(tot_var) > thresh[idx_num]:
-                idx[idx_num] = bin_curr
-                idx_num += 1
-                if len(thresh) > idx_num:
-                    acc_val[:] = 0
-                    acc_var[:] = 0
-                else:
-                    break
+        start = 0
+        nb = data.shape[1]
+        # the running total can only locate the bins when it increases
+        total = np.cumsum(values.sum(axis=0)) if np.all(values >= 0) else None
+
+        def passing(start, end):
+            # [bins, processes]
+            acc_val = np.ascontiguousarray(np.cumsum(values[:, start:end], axis=1, dtype=np.float64).T)
+            acc_var = np.ascontiguousarray(np.cumsum(variances[:, start:end], axis=1, dtype=np.float64).T)
+            tot_val = np.sum(acc_val, axis=1)
+            tot_var = np.sum(np.where(acc_var, acc_var, fallback), axis=1)
+            return tot_val - np.sqrt(tot_var) > thresh[idx_num]
+
+        while start < nb:
+            end = start + 1
+            if total is not None: # tot_val - sqrt(tot_var) > thresh needs tot_val > thresh
+                end = np.searchsorted(total, (total[start-1] if start > 0 else 0.) + thresh[idx_num]) + 1
+            bin_curr = _firstPassing(passing, start, nb, end)
+            if bin_curr is None:
+                break
+            idx[idx_num] = bin_curr
+            idx_num += 1
+            if len(thresh) > idx_num:
+                start = bin_curr + 1
+            else:
+                break
         return idx[:idx_num]
 
 
@@ -0,0 +1,172 @@
+import os, os.path
+import glob
+import errno
+import json
+import fcntl
+import shutil
+import hashlib
+import contextlib
+import ROOT
+
+import Constants as Constants
+logger = Constants.ZAlogger(__name__)
+
+
+def read_histograms(path, nominal_names):
+    """
+    Open one input file and return the histograms whose nominal name is in nominal_names,
+    i.e. the nominal shapes together with all their systematic variations ( nominal__systup/down ).
+    The histograms are detached from the file.
+    """
+    hists = {}
+    f = ROOT.TFile.Open(path)
+    for key in f.GetListOfKeys():
+        name = key.GetName()
+        # Only keep the highest cycle
+        if name in hists:
+            continue
+        if not name.split('__')[0] in nominal_names:
+            continue
+        h = key.ReadObj()
+        h.SetDirectory(ROOT.nullptr)
+        hists[name] = h
+    f.Close()
+    return hists
+
+
+@contextlib.contextmanager
+def entry_lock(entry, exclusive=False, blocking=True):
+    """
+    flock on the lock file of a cache entry ( entry.lock ) : shared while an entry is read,
+    exclusive while it is written or evicted. Yields False when blocking=False and the lock is taken.
+    """
+    with open(entry + '.lock', 'a') as lock:
+        flags = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        try:
+            fcntl.flock(lock, flags if blocking else flags | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            if blocking or e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class ShapeCache:
+    """
+        Content-addressed cache of the shapes read from the bamboo ( or rebinned ) results files,
+        shared between several prepareShapesAndCards.py invocations.
+        Each input file is mapped to one ROOT file in the cache directory, named after a hash of
+        its path, size and modification time : a new bamboo run or a new rebinning of the input
+        gives a new entry, while the unchanged inputs are read back from the cache.
+        Inside an entry the histograms are stored under their original names, and the list of
+        nominal histograms already cached ( with all their variations ) is kept in a TNamed.
+        The cached shapes are not scaled, the normalisation is applied when the shapes are merged.
+        An entry is only written through a temporary file renamed over it, under an exclusive lock,
+        so that concurrent runs ( or workers ) never see a partial entry, and entries that are being
+        read are not evicted.
+    """
+    def __init__(self, path, max_size=None):
+        """
+            path     : cache directory
+            max_size : maximum size of the cache in MB, the least recently used entries
+                       are evicted above it ( None = no limit )
+        """
+        self.path     = path
+        self.max_size = max_size
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def entry(self, input_file):
+        """ Return the path of the cache entry of input_file """
+        st = os.stat(input_file)
+        h  = hashlib.sha1()
+        h.update('{}:{}:{}'.format(os.path.abspath(input_file), st.st_size, st.st_mtime).encode('utf-8'))
+        return os.path.join(self.path, h.hexdigest() + '.root')
+
+    def load(self, input_file, nominal_names):
+        """
+            Return ( hists, hits, misses ) :
+                hists  : same as read_histograms(input_file, nominal_names)
+                hits   : number of histograms read from the cache
+                misses : number of histograms read from input_file ( and added to the cache )
+        """
+        entry  = self.entry(input_file)
+        with entry_lock(entry):
+            hists, cached = self._read(entry, nominal_names)
+
+        hits    = len(hists)
+        missing = set(nominal_names) - cached
+        if not missing:
+            return hists, hits, 0
+
+        new_hists = read_histograms(input_file, missing)
+        hists.update(new_hists)
+
+        with entry_lock(entry, exclusive=True):
+            # another process may have completed the entry in the meantime
+            _, cached = self._read(entry, ())
+            tmp = '{}.{}.tmp'.format(entry, os.getpid())
+            if cached:
+                shutil.copyfile(entry, tmp)
+            f = ROOT.TFile.Open(tmp, 'update' if cached else 'recreate')
+            f.cd()
+            for name, h in new_hists.items():
+                if not name.split('__')[0] in cached:
+                    h.Write(name)
+            index = ROOT.TNamed('nominals', json.dumps(sorted(cached | missing)))
+            index.Write('nominals', ROOT.TObject.kOverwrite)
+            f.Close()
+            # atomic on POSIX, the tmp file is in the same directory as the entry
+            os.rename(tmp, entry)
+        return hists, hits, len(new_hists)
+
+    def _read(self, entry, nominal_names):
+        """ ( histograms of nominal_names, set of cached nominals ) of an entry, the caller holds its lock """
+        hists  = {}
+        cached = set()
+        if not os.path.exists(entry):
+            return hists, cached
+        f = ROOT.TFile.Open(entry)
+        if f and not f.IsZombie():
+            index = f.Get('nominals')
+            if index:
+                cached = set(json.loads(index.GetTitle()))
+            for key in f.GetListOfKeys():
+                name = key.GetName()
+                if name == 'nominals' or name in hists:
+                    continue
+                if not name.split('__')[0] in nominal_names:
+                    continue
+                h = key.ReadObj()
+                h.SetDirectory(ROOT.nullptr)
+                hists[name] = h
+            f.Close()
+        else:
+            # broken entry, will be rewritten
+            return {}, set()
+        # keep track of the last access for the eviction
+        os.utime(entry, None)
+        return hists, cached
+
+    def evict(self):
+        """ Remove the least recently used entries until the cache fits in max_size """
+        if not self.max_size:
+            return
+        entries = sorted(glob.glob(os.path.join(self.path, '*.root')), key=os.path.getmtime)
+        total   = sum(os.path.getsize(e) for e in entries)
+        removed = 0
+        while entries and total > self.max_size*1024.**2:
+            oldest = entries.pop(0)
+            # entries being read or written by another process are kept
+            with entry_lock(oldest, exclusive=True, blocking=False) as locked:
+                if not locked or not os.path.exists(oldest):
+                    continue
+                total -= os.path.getsize(oldest)
+                os.remove(oldest)
+            removed += 1
+        if removed:
+            logger.info("Shape cache: evicted %s entries, %.1f MB left in %s"%(removed, total/1024.**2, self.path))
@@ -35,6 +35,7 @@ if version.parse(mpl.__version__) >= version.parse('2.0.0'):
     mpl.rcParams['lines.scale_dashes']    = False
 
 import Constants as Constants
+from LimitsDB import read_limits
 import utils.CMSStyle as CMSStyle
 
 
@@ -198,13 +199,11 @@ def PlotMultipleUpperLimits(cl, m0, m1, catagories, jsonpath, thdm):
             for era in [2016, 2017, 2018, 'fullrun2']:
                 
                 th_lmax += 2.5
-                js_path = os.path.join(jsonpath, 'combinedlimits_{}_{}_{}_UL{}.json'.format(cat, flav, cl, era))
-                if not os.path.isfile(js_path):
+                limits_ = read_limits(jsonpath, '{}_{}'.format(cat, flav), cl, str(era), db=options.db)
+                if limits_ is None:
                     continue
                 
-                print( js_path )
-                with open(js_path) as f:
-                    limits['{}-{}-{}-{}'.format(prod, region, flav, era)] = json.load(f)
+                limits['{}-{}-{}-{}'.format(prod, region, flav, era)] = limits_
     if not limits:
         print('no limits is found !')
         exit()
@@ -440,15 +439,11 @@ def Plot1D_ScanLimits(cl, jsonpath, signal_grid, thdm, do_PLot=False):
             flavors_limits = {}
             for flav in flavors:
                 limits = flavors_limits.setdefault(flav, {})
-                json_f = os.path.join(jsonpath, 'combinedlimits_{}_{}_{}_UL{}.json'.format(cat, flav, cl, options.era)) 
+                limits_ = read_limits(jsonpath, '{}_{}'.format(cat, flav), cl, options.era, db=options.db)
                 
-                if not os.path.isfile(json_f):
-                    print('%s , requested json file does not exist !'%json_f)
+                if limits_ is None:
+                    print('combinedlimits_{}_{}_{}_UL{} , requested limits do not exist !'.format(cat, flav, cl, options.era))
                     continue
-
-                with open(json_f) as f:
-                    print('working on ::', json_f )
-                    limits_ = json.load(f)
                 
                 for l in limits_:
                     limits[tuple(l['parameters'])] = l['limits']
@@ -956,6 +951,9 @@ if __name__ == '__main__':
     parser.add_argument('--_2POIs_r', action='store_true', dest='_2POIs_r', required=False, default=False,
                                         help='This will merge both signal in 1 histogeram and normalise accoridngly, tanbeta will be required')
 
+    parser.add_argument('--db', action='store_true', dest='db', required=False, default=False,
+                                        help='Read the limits from the database written by collectLimits.py ( limits.sqlite ) instead of the json files')
+
     options = parser.parse_args()
     
     poi_dir, tb_dir, cl = Constants.locate_outputs('asymptotic', options._2POIs_r, options.tanbeta, options.expectSignal)    
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# Micro-benchmark of the ROOT <-> numpy conversions of hist_interface
+# usage : python benchmark_hist_interface.py [--bins 50 100 1000 10000] [--repeat 100]
+import argparse
+import timeit
+import numpy as np
+import ROOT
+ROOT.gROOT.SetBatch(True)
+
+from hist_interface import PythonInterface, CppInterface, ArrayInterface
+
+
+def make_histogram(nbins, name):
+    h = ROOT.TH1D(name, name, nbins, 0., 1.)
+    h.Sumw2()
+    h.FillRandom('gaus', 10*nbins)
+    return h
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark getContent1D/fillHistogram1D of the histogram interfaces')
+    parser.add_argument('--bins', nargs='+', type=int, default=[50, 100, 1000, 10000], help='number of bins to test')
+    parser.add_argument('--repeat', type=int, default=100, help='number of calls per measurement')
+    args = parser.parse_args()
+
+    interfaces = [('python', PythonInterface), ('cpp', CppInterface), ('array', ArrayInterface)]
+
+    print(f"{'bins':>8} {'interface':>10} {'get [us]':>12} {'fill [us]':>12}")
+    for nbins in args.bins:
+        h = make_histogram(nbins, f'h_{nbins}')
+        for name, interface in interfaces:
+            e, w, s = interface.getContent1D(h)
+            if interface is ArrayInterface:
+                # s is the quadratic error, check against the bin by bin conversion
+                ref_e, ref_w, ref_s = PythonInterface.getContent1D(h)
+                assert np.allclose(w, ref_w) and np.allclose(np.sqrt(s), ref_s) and np.allclose(e, ref_e)
+            t_get  = timeit.timeit(lambda: interface.getContent1D(h), number=args.repeat) / args.repeat
+            t_fill = timeit.timeit(lambda: interface.fillHistogram1D(e, w, s, f'f_{name}_{nbins}'), number=args.repeat) / args.repeat
+            print(f"{nbins:>8} {name:>10} {t_get*1e6:>12.1f} {t_fill*1e6:>12.1f}")
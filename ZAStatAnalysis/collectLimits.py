@@ -18,6 +18,8 @@ DEVNULL = open(os.devnull, 'wb')
 import Constants as Constants
 logger = Constants.ZAlogger(__name__)
 
+from LimitsDB import LimitsDB, checksum
+
 
 def transform_param(p):
     return float(p.replace("p", "."))
@@ -271,12 +273,22 @@ if __name__ == '__main__':
                     help=' Is this S+B or B-Only fit? ')
     parser.add_argument('-r', '--rescale-to-za-br', action='store_true', dest='rescale_to_za_br',
                     help='If flagged True, limits in HToZA mode will be x to BR( Z -> ll) x BR(A -> bb ) x (H -> ZA)')
+    parser.add_argument('--rescan', action='store_true', required=False, default=False,
+                    help='Parse again all the combine outputs, even those already in the limits database ( jsons/<poi>/<tb>/limits.sqlite )')
 
     options = parser.parse_args()
     
     
     poi_dir, tb_dir, CL_dir = Constants.locate_outputs(options.method, options._2POIs_r, options.tanbeta, options.expectSignal)
     
+    limits_pathOut = os.path.join(options.inputs, '{}-limits'.format(options.method), options.mode, 'jsons', poi_dir, tb_dir)
+    if not os.path.exists(limits_pathOut):
+        os.makedirs(limits_pathOut)
+    # only the new or changed combine outputs are parsed, the others are read back from the database
+    limitsDB = LimitsDB(limits_pathOut)
+    nParsed  = 0
+    nCached  = 0
+    
     for thdm in ['HToZA', 'AToZH']:
 
         #print("Extracting %s limits..."%thdm)
@@ -315,7 +327,8 @@ if __name__ == '__main__':
                         
                         latex_k = beautify(process, reco, reg, flavor)
                         limits[('{}_{}_{}_{}'.format(process, reco, reg, flavor), latex_k)] = []
-                        for f in limits_path:
+                        collected = []
+                        for position, f in enumerate(limits_path):
                             root     =  f.split('/')[-1]
 
                             mHeavy, mLight   =  string_to_mass(f.split('/')[-2])
@@ -323,7 +336,17 @@ if __name__ == '__main__':
                             if not root.startswith('higgsCombine{}To2L2B_{}_{}_{}_{}_{}_'.format(thdm, prod, reco, reg, flavor, options.mode)):
                                 continue
                             
-                            point_limits = getLimitsFromFile(f, options.method)
+                            category = '{}_{}_{}_{}'.format(process, reco, reg, flavor)
+                            f_sum    = checksum(f, options.method)
+                            found, point_limits = limitsDB.get(f, options.era, options.method, f_sum)
+                            if found and not options.rescan:
+                                nCached += 1
+                            else:
+                                point_limits = getLimitsFromFile(f, options.method)
+                                nParsed += 1
+                            if f_sum is not None: # also for the cached points : their position in the json may have changed
+                                limitsDB.put(f, options.era, options.method, f_sum, category, CL_dir, mHeavy, mLight, point_limits, position)
+                                collected.append(f)
                             #print ( 'working on::', f)
                             #print ( 'working on -- M%s, M%s:'%(heavy, light), mHeavy, mLight , 'template:', options.mode, 'flavor:', flavor)
                         
@@ -343,10 +366,10 @@ if __name__ == '__main__':
                                 'parameters': (mHeavy, mLight),
                                 'limits'    : point_limits
                                 })
+                        # same points in the database as in the json
+                        limitsDB.prune('{}_{}_{}_{}'.format(process, reco, reg, flavor), CL_dir, options.era, options.method, collected)
         
-        limits_pathOut = os.path.join(options.inputs, '{}-limits'.format(options.method), options.mode, 'jsons', poi_dir, tb_dir)
-        if not os.path.exists(limits_pathOut):
-            os.makedirs(limits_pathOut)
+        limitsDB.commit()
         
         for k, v in limits.items():
             if not v:
@@ -363,3 +386,5 @@ if __name__ == '__main__':
         for (m_heavy, m_light) in [(240.0, 130.0), (700.0, 200.0), (750.0, 610.0), (500.0, 250.0), (800.0, 140.0), (200.0, 125.0), (510.0, 130.0), (780.0, 680.0)]:
             WriteLatexTableComparasion(limits, limits_pathOut, CL_dir, m_heavy, m_light, options.tanbeta, thdm, options.era, rescale_to_za_br=options.rescale_to_za_br, _2POI=options._2POIs_r, unblind=False)
 
+    limitsDB.close()
+    logger.info('%s combine outputs parsed, %s read from the limits database %s'%(nParsed, nCached, limitsDB.path))
@@ -1,6 +1,5 @@
 #!/bin/env python
 import os, os.path, sys
-import json
 import argparse
 import numpy as np
 import matplotlib as mpl
@@ -37,6 +36,7 @@ if version.parse(mpl.__version__) >= version.parse('2.0.0'):
 
 import utils.CMSStyle as CMSStyle
 import Constants as Constants
+from LimitsDB import read_limits
 logger = Constants.ZAlogger(__name__)
 
 def scatter_mH_vs_mA():
@@ -250,6 +250,8 @@ if __name__ == "__main__":
                 help='This will merge both signal in 1 histogeram and normalise accoridngly, tanbeta will be required')
     parser.add_argument('--expectSignal', action='store', required=False, type=int, default=1, choices=[0, 1],
                 help=' Is this S+B or B-Only fit? ')
+    parser.add_argument('--db', action='store_true', dest='db', required=False, default=False,
+                help='Read the limits from the database written by collectLimits.py ( limits.sqlite ) instead of the json files')
 
     options = parser.parse_args()
     
@@ -313,10 +315,8 @@ if __name__ == "__main__":
             process = "gg-fusion" if "ggH" in jsFname else "b-associated production"
             tb      = '1.5' if 'ggH' in jsFname else '20.'
             
-            if not os.path.isfile(jsF):
+            all_limits = read_limits(jsonpath, '{}_{}'.format(cat, flav), cl, options.era, db=options.db)
+            if all_limits is None:
                 continue
             
-            with open(jsF) as f:
-                all_limits = json.load(f)
-            
             scatter_mH_vs_mA()
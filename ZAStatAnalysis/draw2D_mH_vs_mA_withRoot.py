@@ -6,6 +6,7 @@ ROOT.gROOT.SetBatch(True)
 from collections import OrderedDict
 import numpy as np
 import Constants as Constants
+from LimitsDB import read_limits
 import utils.CMSStyle as CMSStyle
 
 logger = Constants.ZAlogger(__name__)
@@ -22,6 +23,8 @@ parser.add_argument('--expectSignal', action='store', required=False, type=int,
     help=' Is this S+B or B-Only fit? ')
 parser.add_argument('-r', '--rescale-to-za-br', action='store_true', dest='rescale_to_za_br',
     help='If flagged True, limits in HToZA mode will be x to BR( Z -> ll) x BR(A -> bb ) x (H -> ZA)')
+parser.add_argument('--db', action='store_true', dest='db', required=False, default=False,
+    help='Read the limits from the database written by collectLimits.py ( limits.sqlite ) instead of the json files')
 
 
 options = parser.parse_args()
@@ -148,12 +151,10 @@ for plot in plots:
                 process = "gg-fusion" if "ggH" in jsFname else "b-associated production"
                 tb      = '1.5' if 'ggH' in jsFname else '20.'
                 
-                if not os.path.isfile(jsF):
+                all_limits = read_limits(jsonpath, '{}_{}'.format(cat, flav), cl, options.era, db=options.db)
+                if all_limits is None:
                     continue
                 
-                with open(jsF) as f:
-                    all_limits = json.load(f)
-                
                 logger.info('=============='*10)
                 logger.info('Working on {} plot ... '.format(plot))
                 print( jsF )
@@ -1,9 +1,11 @@
 // orignal author : Florian Bury
+#include <vector>
+
 template <typename T>
-float* getContentFromTH1(const T& h)
+std::vector<double> getContentFromTH1(const T& h)
 {
     int Nx = h.GetNbinsX();
-    float* content = new float[3*Nx+1];
+    std::vector<double> content(3*Nx+1);
         // [0:Nx] -> bin content (len = Nx)
         // [Nx:2*Nx] -> bin error (len = Nx)
         // [2*Nx:3*Nx+1] -> bin edges (len = Nx+1)
@@ -19,11 +21,11 @@ float* getContentFromTH1(const T& h)
 }
 
 template <typename T>
-float* getContentFromTH2(const T& h)
+std::vector<double> getContentFromTH2(const T& h)
 {
     int Nx = h.GetNbinsX();
     int Ny = h.GetNbinsY();
-    float* content = new float[2*Nx*Ny+Nx+Ny+2];
+    std::vector<double> content(2*Nx*Ny+Nx+Ny+2);
         // [0:Nx*Ny] -> bin content (len = Nx*Ny) : rows = y values, columns = x values
         // [Nx*Ny:2*Nx*Ny] -> bin error (len = Nx*Ny)
         // [2*Nx*Ny:2*Nx*Ny+Nx+Ny+2] -> bin edges (len = Nx+Ny+2)
@@ -74,8 +76,8 @@ TH2F fillTH2(const float* xedges, const float* yedges, const float* values, cons
     {
         for (int y = 0 ; y < Ny ; y++)
         {
-            h.SetBinContent(x+1,y+1,values[y+x*Nx]);
-            h.SetBinError(x+1,y+1,errors[y+x*Nx]);
+            h.SetBinContent(x+1,y+1,values[y+x*Ny]);
+            h.SetBinError(x+1,y+1,errors[y+x*Ny]);
         }
     }    
     return h;
@@ -88,8 +90,8 @@ TH2D fillTH2(const double* xedges, const double* yedges, const double* values, c
     {
         for (int y = 0 ; y < Ny ; y++)
         {
-            h.SetBinContent(x+1,y+1,values[y+x*Nx]);
-            h.SetBinError(x+1,y+1,errors[y+x*Nx]);
+            h.SetBinContent(x+1,y+1,values[y+x*Ny]);
+            h.SetBinError(x+1,y+1,errors[y+x*Ny]);
         }
     }    
     return h;
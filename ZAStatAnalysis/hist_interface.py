@@ -65,8 +65,7 @@ class CppInterface:
         assert isinstance(h,ROOT.TH1)
         Nx = h.GetNbinsX() 
         content = ROOT.getContentFromTH1(h)
-        content.reshape((3*Nx+1,))
-        arr = np.frombuffer(content, dtype=np.float32, count=3*Nx+1)
+        arr = np.frombuffer(content.data(), dtype=np.float64, count=3*Nx+1).copy()
         w = arr[:Nx]
         s = arr[Nx:2*Nx]
         e = arr[2*Nx:].round(5)
@@ -78,8 +77,7 @@ class CppInterface:
         content = ROOT.getContentFromTH2(h)
         Nx = h.GetNbinsX()
         Ny = h.GetNbinsY()
-        content.reshape((2*Nx*Ny+Nx+Ny+2,)) 
-        arr = np.frombuffer(content, dtype=np.float32, count=2*Nx*Ny+Nx+Ny+2)
+        arr = np.frombuffer(content.data(), dtype=np.float64, count=2*Nx*Ny+Nx+Ny+2).copy()
         w = arr[:Nx*Ny].reshape(Nx,Ny)
         s = arr[Nx*Ny:2*Nx*Ny].reshape(Nx,Ny)
         e = arr[2*Nx*Ny:]
@@ -99,3 +97,90 @@ class CppInterface:
         s = s.astype(w.dtype)
         return ROOT.fillTH2(e[0],e[1],w.flatten(),s.flatten(),w.shape[0],w.shape[1],name)
 
+
+
+class ArrayInterface:
+    """
+        Bulk conversion based on the internal arrays of the histograms ( TH1::GetArray and TH1::GetSumw2 ),
+        for TH1F/TH1D/TH2F/TH2D, without any loop over the bins.
+        The contents are returned in float64 together with the quadratic errors (s2) : 
+        if the histogram has no sumw2 structure, s2 is the bin content as for TH1::GetBinError.
+        With copy=False the float64 contents of TH1D/TH2D are views on the histogram memory, 
+        they are only valid as long as the histogram is alive.
+    """
+    _dtypes = {'F': np.float32, 'D': np.float64}
+
+    @classmethod
+    def _view(self,h,ncells):
+        dtype = self._dtypes.get(h.ClassName()[3], None)
+        if dtype is None:
+            raise NotImplementedError(f'Unknown histogram type {h.ClassName()}')
+        return np.frombuffer(h.GetArray(), dtype=dtype, count=ncells)
+
+    @classmethod
+    def _sumw2(self,h,content):
+        if h.GetSumw2N() == 0:
+            return np.abs(content)
+        return np.frombuffer(h.GetSumw2().GetArray(), dtype=np.float64, count=h.GetSumw2N())
+
+    @classmethod
+    def _edges(self,axis):
+        if axis.GetXbins().GetSize() > 0:
+            return np.frombuffer(axis.GetXbins().GetArray(), dtype=np.float64, count=axis.GetNbins()+1).copy()
+        return np.linspace(axis.GetXmin(),axis.GetXmax(),axis.GetNbins()+1)
+
+    @classmethod
+    def getContent1D(self,h,copy=True):
+        assert isinstance(h,ROOT.TH1)
+        Nx = h.GetNbinsX()
+        content = self._view(h,Nx+2)
+        sumw2   = self._sumw2(h,content)
+        w  = content[1:-1].astype(np.float64,copy=copy)
+        s2 = sumw2[1:-1].astype(np.float64,copy=copy)
+        e  = self._edges(h.GetXaxis()).round(5)
+        return e,w,s2
+
+    @classmethod
+    def getContent2D(self,h,copy=True):
+        assert isinstance(h,ROOT.TH2)
+        Nx = h.GetNbinsX()
+        Ny = h.GetNbinsY()
+        # global bin = x + (Nx+2) * y 
+        content = self._view(h,(Nx+2)*(Ny+2))
+        sumw2   = self._sumw2(h,content)
+        w  = content.reshape(Ny+2,Nx+2)[1:-1,1:-1].T.astype(np.float64,copy=copy)
+        s2 = sumw2.reshape(Ny+2,Nx+2)[1:-1,1:-1].T.astype(np.float64,copy=copy)
+        e  = [self._edges(h.GetXaxis()),self._edges(h.GetYaxis())]
+        return e,w,s2
+
+    @classmethod
+    def _fill(self,h,w,s2):
+        content = np.zeros(h.GetNcells())
+        sumw2   = np.zeros(h.GetNcells())
+        if w.ndim == 1:
+            content[1:-1] = w
+            sumw2[1:-1]   = s2
+        else:
+            Nx,Ny = w.shape
+            content.reshape(Ny+2,Nx+2)[1:-1,1:-1] = w.T
+            sumw2.reshape(Ny+2,Nx+2)[1:-1,1:-1]   = s2.T
+        h.SetContent(content)
+        h.Sumw2()
+        h.GetSumw2().Set(h.GetNcells(),sumw2)
+        # Same number of entries as when filled with SetBinContent bin by bin
+        h.SetEntries(w.size)
+        return h
+
+    @classmethod
+    def fillHistogram1D(self,e,w,s2,name=""):
+        e = np.ascontiguousarray(e,dtype=np.float64)
+        h = ROOT.TH1D(name,name,e.shape[0]-1,e)
+        return self._fill(h,w,s2)
+
+    @classmethod
+    def fillHistogram2D(self,e,w,s2,name=""):
+        assert len(e) == 2
+        ex = np.ascontiguousarray(e[0],dtype=np.float64)
+        ey = np.ascontiguousarray(e[1],dtype=np.float64)
+        h = ROOT.TH2D(name,name,ex.shape[0]-1,ex,ey.shape[0]-1,ey)
+        return self._fill(h,w,s2)
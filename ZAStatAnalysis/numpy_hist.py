@@ -1,10 +1,10 @@
 # orignal author : Florian Bury
 import sys
-from copy import copy,deepcopy
+from copy import deepcopy
 import numpy as np
 import logging
 
-from hist_interface import PythonInterface, CppInterface
+from hist_interface import ArrayInterface
 
 get_half = False
 
@@ -111,31 +111,33 @@ class NumpyHist:
     #################################################################################################
 
     @classmethod
-    def getFromRoot(cls,h):
+    def getFromRoot(cls,h,copy_arrays=True):
         """
             From TH1/TH2 extract : 
-                e : edges including lower and upper 
-                w : content (GetBinContent)
-                s : errors  (GetBinError)
-            return class object from (e,w,s)
-            Internally use the C++ helpers to speed up the data flow
+                e  : edges including lower and upper 
+                w  : content (GetBinContent)
+                s2 : quadratic errors (GetSumw2)
+            return class object from (e,w,s2)
+            Internally read the histogram arrays in bulk, in float64
+            copy_arrays = False : for TH1D/TH2D, w and s2 are views on the histogram memory (no copy),
+                                  only valid as long as h is alive
         """
         # Cannot use isinstance because TH2 inherits from TH1 #
         name = h.GetName()
         if h.__class__.__name__.startswith('TH1'):
-            e,w,s = CppInterface.getContent1D(h)
+            e,w,s2 = ArrayInterface.getContent1D(h,copy_arrays)
         elif h.__class__.__name__.startswith('TH2'):
-            e,w,s = CppInterface.getContent2D(h)
+            e,w,s2 = ArrayInterface.getContent2D(h,copy_arrays)
         else:
             raise NotImplementedError(f'Unknown histogram type {h.__class__.__name__}')
-        return cls(e,w,s**2,name)
+        return cls(e,w,s2,name)
 
     def fillHistogram(self,name=None):
         """
             Inputs : 
             name : name to be used in the TH* instantiation (default = '')
-            return : TH1/TH2 based on the dimension
-            Internally use the C++ helpers to speed up the data flow
+            return : TH1D/TH2D based on the dimension
+            Internally fill the histogram arrays in bulk
         """
         if name is None:
             if self._name is None:
@@ -143,9 +145,9 @@ class NumpyHist:
             else:
                 name = self._name
         if self.ndim == 1:
-            return CppInterface.fillHistogram1D(self.e,self.w,self.s,name)
+            return ArrayInterface.fillHistogram1D(self.e,self.w,self.s2,name)
         elif self.ndim == 2:
-            return CppInterface.fillHistogram2D(self.e,self.w,self.s,name)
+            return ArrayInterface.fillHistogram2D(self.e,self.w,self.s2,name)
         else:
             raise NotImplementedError(f'Dimension {self.ndim} has not been coded')
 
@@ -304,6 +306,56 @@ class NumpyHist:
         # Return #
         return NumpyHist(ne,nw,ns2,self._name)
 
+    @staticmethod
+    def _groupAxis(e,ne):
+        """
+            From the old and new edges of an axis, return the slice of old bins falling inside 
+            the new axis and the start of each new bin within it (for np.add.reduceat)
+        """
+        NumpyHist.compareRebinAxes(e,ne)
+        x = (e[1:]+e[:-1])/2
+        idx = np.digitize(x,ne) - 1
+        inside = np.nonzero((idx >= 0) & (idx < ne.shape[0]-1))[0]
+        sl = slice(inside[0],inside[-1]+1) if inside.shape[0] > 0 else slice(0,0)
+        starts = np.searchsorted(idx[sl],np.arange(ne.shape[0]-1))
+        return sl,starts
+
+    @staticmethod
+    def rebinArrays(e,w,s2,ne):
+        """
+            Rebin a stack of histograms sharing the same axes in one go
+            e  : bin edges [N+1] (or [ex,ey] in 2D)
+            w  : stacked bin contents [H,N] (or [H,Nx,Ny] in 2D)
+            s2 : stacked quadratic bin errors, same shape as w
+            ne : new bin edges, same format as e
+            return : new contents and quadratic errors [H,N'] (or [H,Nx',Ny'])
+        """
+        w  = np.asarray(w)
+        s2 = np.asarray(s2)
+        if w.shape != s2.shape:
+            raise RuntimeError(f'Content and error shapes do not match : {w.shape} != {s2.shape}')
+        if w.ndim == 2:
+            axes = [(1,e,ne)]
+        elif w.ndim == 3:
+            axes = [(1,e[0],ne[0]),(2,e[1],ne[1])]
+        else:
+            raise NotImplementedError
+        nw,ns2 = w,s2
+        for axis,ei,nei in axes:
+            sl,starts = NumpyHist._groupAxis(ei,nei)
+            if starts.shape[0] == 0:
+                raise RuntimeError('New axis has no bin')
+            index = [slice(None)] * nw.ndim
+            index[axis] = sl
+            nw  = np.add.reduceat(nw[tuple(index)],starts,axis=axis)
+            ns2 = np.add.reduceat(ns2[tuple(index)],starts,axis=axis)
+        # Safety checks #
+        if not get_half:
+            for i in range(w.shape[0]):
+                NumpyHist._checkTotal(w[i],nw[i],'content')
+                NumpyHist._checkTotal(s2[i],ns2[i],'quadratic error')
+        return nw,ns2
+
     def projectionX(self):
         """
             From a 2D histogram, return the projection in the X axis 
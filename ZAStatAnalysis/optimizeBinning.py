@@ -8,12 +8,14 @@ import itertools
 import math
 import shutil
 import subprocess
+import multiprocessing
 import root_numpy
 
 import numpy_hist as numpy_hist
 
 #from rootpy.plotting import Hist
 from numpy_hist import NumpyHist
+from HistStore import HistStore
 from json import JSONEncoder
 from collections import defaultdict
 from hepstats.modeling.bayesian_blocks import bayesian_blocks, Prior
@@ -413,6 +415,142 @@ def rebinCustom(hist, binning, name, verbose=False):
     return newHist, sumOfWeightsGenerated
 
 
+def runJobs(worker, tasks, nJobs=1, preload=None):
+    """
+    Run worker over the tasks, in a pool of nJobs processes if nJobs > 1
+    The results are returned in the order of the tasks, so the binnings are merged as in the serial mode
+    preload : called in the parent before the pool is created ( eg. optimizer.preload_era_histograms ),
+              the workers are forked so what it reads is shared read-only with them instead of read by each of them
+    """
+    if nJobs <= 1 or len(tasks) <= 1:
+        return [worker(task) for task in tasks]
+    if preload is not None:
+        preload()
+    logger.info(f'Running {len(tasks)} binning optimisations using {nJobs} workers')
+    pool = multiprocessing.get_context('fork').Pool(min(nJobs, len(tasks)))
+    try:
+        results = list(pool.imap(worker, tasks, chunksize=1))
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+def toysChannelHistograms(tdir, histNm):
+    """ Names of the histograms of a toys channel that are binned : the signal and the B-only toys ( no signal for MuEl ) """
+    names = []
+    for key in tdir.GetListOfKeys():
+        name     = key.GetName()
+        isSignal = name.startswith('gg') or name.startswith('bb')
+        if not (isSignal or 'data' in name):
+            continue
+        if isSignal and any( x in histNm for x in ['MuEl', 'ElMu'] ):
+            continue
+        names.append(name)
+    return names
+
+
+def optimizeToysChannel(task):
+    """
+    Bayesian blocks binning of the signal and B-only toys of one channel of a toys shapes file
+    return : ( histogram name, process, binnings entry )
+    """
+    rf, smpNm, process, channel, mode, plotsDIR, prior, logy, fix_reco_format = task
+    inFile    = HT.openFileAndGet(rf)
+    oldHist   = {}
+    newHist   = {} 
+    newEdges  = {}
+    oldEdges  = {}
+    FinalBins = {}
+    oldBinErrors  = {}
+    oldBinContent = {}
+
+    mass   = channel.replace(f'{mode}_', '')
+    histNm = optimizer.get_histNm_orig(mode, smpNm, mass, info=False, fix_reco_format=fix_reco_format)
+    entry  = {}
+    
+    for name in toysChannelHistograms(inFile.Get(channel), histNm):
+        
+        isSignal  = False
+        isData    = False
+
+        if name.startswith('gg') or name.startswith('bb'): isSignal=True
+        if 'data' in name: isData=True 
+
+        k = 'S' if isSignal else 'B'
+        
+        oldHist[k] = inFile.Get(channel).Get(name)
+        
+        if not oldHist[k]:
+            logger.error(f'could not find object: inFile.Get({channel}).Get({name}) -- return null pointer!')
+        print( f'- working on : {name}' ) 
+        
+        label    = mass if isSignal else 'B-Only toy data'
+        datatype = "toys_signal" if isSignal else key.GetName()
+       
+        np_hist = NumpyHist.getFromRoot(oldHist[k])
+        oldBinContent[k] = np_hist.w
+        oldBinErrors[k]  = np_hist.s
+        oldEdges[k]      = np_hist.e
+       
+        newHist[k], newEdges[k], FinalBins[k] = BayesianBlocks( root_file         = rf,
+                                                                old_hist          = oldHist[k],
+                                                                mass              = mass, 
+                                                                name              = smpNm,
+                                                                channel           = channel,
+                                                                output            = plotsDIR, 
+                                                                prior             = prior, 
+                                                                datatype          = datatype, 
+                                                                label             = label,
+                                                                logy              = logy, 
+                                                                isSignal          = isSignal, 
+                                                                doplot            = True,
+                                                                dofind_bestPrior  = False,
+                                                                include_overflow  = False)
+
+    newEdges['B'] = newEdges['B'].astype(float).round(2).tolist()
+    
+    entry.update({'B': [MarkedList(newEdges['B']), MarkedList(FinalBins['B']) ] } )
+    
+    if not any ( x in histNm for x in ['MuEl', 'ElMu'] ):
+        newEdges['S'] = newEdges['S'].astype(float).round(2).tolist()
+        binning  = optimizer.hybride_binning( BOnly = [newEdges['B'], FinalBins['B']], 
+                                              SOnly = [newEdges['S'], FinalBins['S']] )
+        entry.update(
+                {   'S'      : [MarkedList(newEdges['S']), MarkedList(FinalBins['S']) ],
+                    'hybride': [MarkedList(binning[0]), MarkedList(binning[1])],
+                    # deprecated: 'BB_hybride_good_stat': [MarkedList(newEdges_with_thres_cut), MarkedList(newBins_with_thres_cut)],
+                })
+
+    inFile.Close()
+    return histNm, process, entry
+
+
+def optimizeAsimovHistogram(task):
+    """
+    Bayesian blocks binning of one histogram of the asimov dataset ( sum of backgrounds ) or of one signal
+    return : ( new edges, final bins )
+    """
+    k, process, rf, histNm, mass, plotsDIR, prior, datatype, label, logy, isSignal = task
+    inFile = HT.openFileAndGet(rf)
+    newHist, newEdges, FinalBins = BayesianBlocks(  root_file         = rf, 
+                                                    old_hist          = inFile.Get(histNm), 
+                                                    mass              = mass, 
+                                                    name              = histNm,
+                                                    channel           = None, 
+                                                    output            = plotsDIR, 
+                                                    prior             = prior, 
+                                                    datatype          = datatype, 
+                                                    label             = label,
+                                                    logy              = logy, 
+                                                    isSignal          = isSignal, 
+                                                    doplot            = True,
+                                                    dofind_bestPrior  = False,
+                                                    include_overflow  = False)
+    inFile.Close()
+    return newEdges, FinalBins
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Collection of functions to get the best binning')
     parser.add_argument('-i', '--input', help='input file, either toys data or bamboo output files', required=True)
@@ -448,6 +586,12 @@ if __name__ == "__main__":
     parser.add_argument('--scenario', action='store', choices= ['hybride', 'S', 'B'], required=False, 
                             help='')
     parser.add_argument('--unblind', action='store_true', default=True, help="If set to True will produced histogram for data too")
+    parser.add_argument('--histstore', action='store_true', default=False, 
+                            help='read the histograms from the columnar store of the input directory ( see HistStore.py )\n'
+                                 'instead of scanning the ROOT files, the store is ( re- )built for the new or changed files\n')
+    parser.add_argument('-j', '--jobs', action='store', type=int, default=1, 
+                            help='Number of workers used to run the bayesian blocks optimisation of the toys/asimov\n'
+                                 'histograms in parallel ( 1 : serial mode ), the json output is the same as in serial mode\n')
 
     args = parser.parse_args()
     
@@ -471,6 +615,8 @@ if __name__ == "__main__":
     fix_reco_format  = False
     
     numpy_hist.get_half = get_half
+    
+    store = HistStore(args.input) if args.histstore and args.job == 'local' else None
 
     if args.job =='local': list_inputs = glob.glob(os.path.join(args.input, '*.root'))
     else: list_inputs = [args.input] # will give one root file at the time with slurm_job id 
@@ -543,6 +689,8 @@ if __name__ == "__main__":
     binnings = optimizer.get_sortedfiles(binnings, inputs, args.era)
     
     if args.toys:
+        tasks   = []
+        histNms = defaultdict(dict) # rf -> channel -> histograms binned, read again in the per-era files
         for rf in inputs:
             smpNm    = rf.split('/')[-1].split('_shapes')[0]
             process  = smpNm.split('_')[1] + '_' + smpNm.split('_')[2]
@@ -554,104 +702,23 @@ if __name__ == "__main__":
                     continue
                 channels.add(cat)
             channels = list(channels)
-            print ("Detected channels: ", channels , smpNm)
-             
             for channel in channels:
-                oldHist   = {}
-                newHist   = {} 
-                newEdges  = {}
-                oldEdges  = {}
-                oldNbins  = {}
-                FinalBins = {}
-                newBinErrors  = {}
-                oldBinErrors  = {}
-                oldBinContent = {}
-
-                mass   = channel.replace(f'{args.mode}_', '')
-                histNm = optimizer.get_histNm_orig(args.mode, smpNm, mass, info=False, fix_reco_format=fix_reco_format)
-                
-                if not histNm in binnings['histograms'].keys():
-                    binnings['histograms'][histNm] = {}
-                if not process in binnings['histograms'][histNm].keys():
-                    binnings['histograms'][histNm].update({process: {}})
-                
-                for key in inFile.Get(channel).GetListOfKeys():
-                    
-                    isSignal  = False
-                    isData    = False
-
-                    if key.GetName().startswith('gg') or key.GetName().startswith('bb'): isSignal=True
-                    if 'data' in key.GetName(): isData=True 
-
-                    k = 'S' if isSignal else ('B' if isData else(key.GetName()))
-                    if not (isData or isSignal):
-                        continue
-                    if isSignal and any( x in histNm for x in ['MuEl', 'ElMu'] ):
-                        continue
-                     
-                    oldHist[k] = inFile.Get(channel).Get(key.GetName())
-                    
-                    if not oldHist[k]:
-                        logger.error('could not find object: inFile.Get({channel}).Get({key.GetName()}) -- return null pointer!')
-                    print( f'- working on : {key.GetName()}' ) 
-                    
-                    label    = mass if isSignal else 'B-Only toy data'
-                    datatype = "toys_signal" if isSignal else key.GetName()
-                   
-                    np_hist = NumpyHist.getFromRoot(oldHist[k])
-                    oldBinContent[k] = np_hist.w
-                    oldBinErrors[k]  = np_hist.s
-                    oldEdges[k]      = np_hist.e
-                   
-                    newHist[k], newEdges[k], FinalBins[k] = BayesianBlocks( root_file         = rf,
-                                                                            old_hist          = oldHist[k],
-                                                                            mass              = mass, 
-                                                                            name              = smpNm,
-                                                                            channel           = channel,
-                                                                            output            = plotsDIR, 
-                                                                            prior             = args.prior, 
-                                                                            datatype          = datatype, 
-                                                                            label             = label,
-                                                                            logy              = args.logy, 
-                                                                            isSignal          = isSignal, 
-                                                                            doplot            = True,
-                                                                            dofind_bestPrior  = False,
-                                                                            include_overflow  = False)
-            
-                newEdges['B'] = newEdges['B'].astype(float).round(2).tolist()
-                
-                hybridebinning_dict = {'B': newEdges['B'] }
-                
-                binnings['histograms'][optimizer.get_histNm_orig(args.mode, smpNm, mass, info=False, fix_reco_format=fix_reco_format)][process].update(
-                           {'B': [MarkedList(newEdges['B']), MarkedList(FinalBins['B']) ] } )
-                
-                if not any ( x in histNm for x in ['MuEl', 'ElMu'] ):
-                    newEdges['S'] = newEdges['S'].astype(float).round(2).tolist()
-                    binning  = optimizer.hybride_binning( BOnly = [newEdges['B'], FinalBins['B']], 
-                                                          SOnly = [newEdges['S'], FinalBins['S']] )
-
-                
-                    hybridebinning_dict.update( {'S': newEdges['S'],
-                                                 'hybride': binning[0] } )
-                   # not in use !! 
-                   # newEdges_with_thres_cut, newBins_with_thres_cut = BayesianBlocksHybrid(
-                   #                 oldHist, 
-                   #                 name                  = 'hybride_bininngS+B_bayesian_toys' + '_' + smpNm, 
-                   #                 output                = plotsDIR, 
-                   #                 label                 = label,
-                   #                 newEdges              = hybridebinning_dict, 
-                   #                 include_overflow      = False, 
-                   #                 logy                  = args.logy)
-                    binnings['histograms'][optimizer.get_histNm_orig(args.mode, smpNm, mass, info=False, fix_reco_format=fix_reco_format)][process].update(
-                            {   'S'      : [MarkedList(newEdges['S']), MarkedList(FinalBins['S']) ],
-                                'hybride': [MarkedList(binning[0]), MarkedList(binning[1])],
-                                # deprecated: 'BB_hybride_good_stat': [MarkedList(newEdges_with_thres_cut), MarkedList(newBins_with_thres_cut)],
-                            })
-
+                histNm = optimizer.get_histNm_orig(args.mode, smpNm, channel.replace(f'{args.mode}_', ''), info=False, fix_reco_format=fix_reco_format)
+                histNms[rf][channel] = toysChannelHistograms(inFile.Get(channel), histNm)
             inFile.Close()
+            print ("Detected channels: ", channels , smpNm)
+            for channel in channels:
+                tasks.append((rf, smpNm, process, channel, args.mode, plotsDIR, args.prior, args.logy, fix_reco_format))
+        
+        def preload():
+            optimizer.preload_era_histograms(histNms)
+        
+        for histNm, process, entry in runJobs(optimizeToysChannel, tasks, args.jobs, preload):
+            binnings['histograms'].setdefault(histNm, {}).setdefault(process, {}).update(entry)
     
     elif args.asimov:
         
+        tasks = []
         for k, rf_list in inputs.items():
             isSignal = False
             
@@ -685,33 +752,27 @@ if __name__ == "__main__":
                     if 'resolved' in histNm and 'OSSF' in histNm:
                         continue
 
-                    binnings['histograms'][histNm] = {}
-                    if not process in binnings['histograms'][histNm].keys():
-                        binnings['histograms'][histNm].update({process: {}})
-                    
                     mass   = histNm.split(process+'_')[-1].split('__')[0]
                     label  = mass if isSignal else 'B-Only Asimov data'
-                    newHist, newEdges, FinalBins = BayesianBlocks(  root_file         = rf, 
-                                                                    old_hist          = inFile.Get(histNm), 
-                                                                    mass              = mass, 
-                                                                    name              = histNm,
-                                                                    channel           = None, 
-                                                                    output            = plotsDIR, 
-                                                                    prior             = args.prior, 
-                                                                    datatype          = datatype, 
-                                                                    label             = label,
-                                                                    logy              = args.logy, 
-                                                                    isSignal          = isSignal, 
-                                                                    doplot            = True,
-                                                                    dofind_bestPrior  = False,
-                                                                    include_overflow  = False)
-                    if k == 'B':
-                        binnings['histograms'][histNm][process]['B'] = {'B': [MarkedList(newEdges), MarkedList(FinalBins) ] }
-                    if not any ( x in histNm for x in ['MuEl', 'ElMu'] ):
-                        binnings['histograms'][histNm][process].update(
-                                {   'S' : [MarkedList(newEdges), MarkedList(FinalBins) ],
-                                })
+                    tasks.append((k, process, rf, histNm, mass, plotsDIR, args.prior, datatype, label, args.logy, isSignal))
                 inFile.Close()
+        
+        def preload():
+            histNms = defaultdict(lambda: {None: []})
+            for k, process, rf, histNm, *_ in tasks:
+                histNms[rf][None].append(histNm)
+            optimizer.preload_era_histograms(histNms)
+        
+        for (k, process, rf, histNm, *_), (newEdges, FinalBins) in zip(tasks, runJobs(optimizeAsimovHistogram, tasks, args.jobs, preload)):
+            binnings['histograms'][histNm] = {}
+            if not process in binnings['histograms'][histNm].keys():
+                binnings['histograms'][histNm].update({process: {}})
+            if k == 'B':
+                binnings['histograms'][histNm][process]['B'] = {'B': [MarkedList(newEdges), MarkedList(FinalBins) ] }
+            if not any ( x in histNm for x in ['MuEl', 'ElMu'] ):
+                binnings['histograms'][histNm][process].update(
+                        {   'S' : [MarkedList(newEdges), MarkedList(FinalBins) ],
+                        })
     
     else: 
         # this step will do the rebinning on bamboo output using the rebining already saved in the json template
@@ -763,39 +824,45 @@ if __name__ == "__main__":
                 if not smpNm in Observation.keys():
                     Observation[smpNm] = {}
 
-                for key in inFile.GetListOfKeys():
+                fromStore = store is not None and store.contains(rf)
+                keyNames  = store.keys(rf) if fromStore else [key.GetName() for key in inFile.GetListOfKeys()]
+                for keyName in keyNames:
                     isSys  = False
                     if args.mode == 'dnn':  
-                        if not key.GetName().startswith('DNN'):
+                        if not keyName.startswith('DNN'):
                             continue
                     
-                    if '__' in key.GetName(): isSys=True
+                    if '__' in keyName: isSys=True
                     if not args.sys and isSys: 
                         continue
                    
                     if args.rebin=='bayesian':
                         # after all conditions above , now the binning template 
                         # need to be found for these histogram ( taken from json file)
-                        if not any( key.GetName().startswith(x) for x in data['histograms'].keys()): 
+                        if not any( keyName.startswith(x) for x in data['histograms'].keys()): 
                             continue
                     
-                    params = optimizer.get_histNm_orig(args.mode, key.GetName(), mass=None, info=True, fix_reco_format=fix_reco_format)[1]
-                    hist   = inFile.Get(key.GetName())
-                    if not (hist and hist.InheritsFrom("TH1")):
-                        continue
+                    params = optimizer.get_histNm_orig(args.mode, keyName, mass=None, info=True, fix_reco_format=fix_reco_format)[1]
+                    if fromStore and args.rebin == 'bayesian':
+                        # read from the histogram store, no ROOT I/O 
+                        oldHist = None
+                    else:
+                        hist   = inFile.Get(keyName)
+                        if not (hist and hist.InheritsFrom("TH1")):
+                            continue
                     
-                    oldHist = inFile.Get(key.GetName())
+                        oldHist = inFile.Get(keyName)
                     
                     if not isSys:
-                        Observation[smpNm][key.GetName()]= {'sumTotal': None, 'sumPass': None}
+                        Observation[smpNm][keyName]= {'sumTotal': None, 'sumPass': None}
                         
-                        if not key.GetName() in binnings['histograms'].keys():
-                            binnings['histograms'][key.GetName()] = {}
-                        if not process in binnings['histograms'][key.GetName()].keys():
-                            binnings['histograms'][key.GetName()].update({process: []})
+                        if not keyName in binnings['histograms'].keys():
+                            binnings['histograms'][keyName] = {}
+                        if not process in binnings['histograms'][keyName].keys():
+                            binnings['histograms'][keyName].update({process: []})
 
-                    print( f' working on : {key.GetName()}' ) 
-                    name = key.GetName() +'_rebin'
+                    print( f' working on : {keyName}' ) 
+                    name = keyName +'_rebin'
                     #===================================================== 
                     
                     if args.rebin == 'custom':
@@ -820,7 +887,7 @@ if __name__ == "__main__":
                     
                     elif args.rebin == 'bayesian':
                         
-                        look_for_hist = key.GetName().split('__')[0]
+                        look_for_hist = keyName.split('__')[0]
                         
                         if not process in data['histograms'][look_for_hist].keys():
                             continue
@@ -876,7 +943,7 @@ if __name__ == "__main__":
                             else:
                                 binning  = data['histograms'][look_for_hist][process][args.scenario]
 
-                        nph_old = NumpyHist.getFromRoot(oldHist)
+                        nph_old = store.get(rf, keyName) if oldHist is None else NumpyHist.getFromRoot(oldHist)
                         
                         """
                             Please do not use this option if you are producing rebinned histogram for Combine
@@ -891,7 +958,7 @@ if __name__ == "__main__":
                             newHist = nph_new.fillHistogram(oldHist.GetName())
                         """ 
                         
-                        newHist = nph_old.rebin(np.array(binning[0])).fillHistogram(oldHist.GetName()) 
+                        newHist = nph_old.rebin(np.array(binning[0])).fillHistogram(nph_old.name) 
                         nph_new = NumpyHist.getFromRoot(newHist)
                         
                         if not get_half:
@@ -900,8 +967,8 @@ if __name__ == "__main__":
                                               f"new = {nph_new.w.sum():.5e}, old = {nph_old.w.sum():.5e}")
                        
                     if not isSys:
-                        Observation[smpNm][key.GetName()]['sumPass'] = newHist.GetEntries()
-                        binnings['histograms'][key.GetName()][process].append([MarkedList(binning[0]), MarkedList(binning[1])])
+                        Observation[smpNm][keyName]['sumPass'] = newHist.GetEntries()
+                        binnings['histograms'][keyName][process].append([MarkedList(binning[0]), MarkedList(binning[1])])
                     
                     #print(np.sqrt(sum(list(newHist.GetSumw2())))/newHist.Integral())
                     outFile.cd()
@@ -281,18 +281,64 @@ def no_zero_binContents(nph, newEdges, crossNm):
         return np.array(newEdges)
 
 
+# histograms of the per-era files, read once per process
+# ( optimizeBinning.py -j preloads them in the parent with preload_era_histograms, the forked workers share them read-only )
+_eraHistograms = {}
+_eras = ['UL16', 'UL17', 'UL18', 'UL16preVFP', 'UL16postVFP']
+
+def _era_directory(inFile, channel):
+    return inFile.Get(channel) if channel is not None else inFile
+
+
+def get_era_histogram(rf, channel, histNm):
+    """ Return the NumpyHist of channel/histNm in rf, reading the file only the first time """
+    k = (rf, channel, histNm)
+    if k not in _eraHistograms:
+        inFile = HT.openFileAndGet(rf)
+        _eraHistograms[k] = NumpyHist.getFromRoot(_era_directory(inFile, channel).Get(histNm))
+        inFile.Close()
+    return _eraHistograms[k]
+
+
+def preload_era_histograms(histNms):
+    """
+    Read in one go the histograms of the per-era files that no_bins_empty_background_across_year will use
+    histNms : { rf : { channel : [ histogram names ] } } ( channel None : top directory of the file )
+    each per-era file is opened once for all its channels, only the listed histograms are read
+    """
+    perEra = defaultdict(lambda: defaultdict(set))
+    for rf, channels in histNms.items():
+        for era in _eras:
+            for channel, names in channels.items():
+                perEra[rf.replace('ULfullrun2', era)][channel].update(names)
+    for rf_per_era, channels in perEra.items():
+        if not os.path.exists(rf_per_era):
+            continue
+        inFile = HT.openFileAndGet(rf_per_era)
+        for channel, names in channels.items():
+            tdir = _era_directory(inFile, channel)
+            if not tdir:
+                continue
+            for histNm in names:
+                k = (rf_per_era, channel, histNm)
+                if k in _eraHistograms:
+                    continue
+                hist = tdir.Get(histNm)
+                if hist and hist.InheritsFrom('TH1'):
+                    _eraHistograms[k] = NumpyHist.getFromRoot(hist)
+        inFile.Close()
+
+
 def no_bins_empty_background_across_year(rf, histNm, newEdges, channel, crossNm):
     correctedEdges = newEdges
     logger.info(f'ULfullrun2 binning: {crossNm}, {correctedEdges}')
     if correctedEdges.tolist()== [0.,1.]:
         return correctedEdges
-    for era in ['UL16', 'UL17', 'UL18', 'UL16preVFP', 'UL16postVFP']:
+    for era in _eras:
         rf_per_era = rf.replace('ULfullrun2', era)
         if not os.path.exists(rf_per_era):
             continue
-        inFile   = HT.openFileAndGet(rf_per_era)
-        hist     = inFile.Get(channel).Get(histNm)
-        nph = NumpyHist.getFromRoot(hist)
+        nph = get_era_histogram(rf_per_era, channel, histNm)
         correctedEdges = no_zero_binContents(nph, correctedEdges, crossNm)
         logger.info(f'{era} binning: {crossNm}, {correctedEdges}')
     return correctedEdges
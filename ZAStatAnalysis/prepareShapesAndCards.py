@@ -21,6 +21,7 @@ from collections import defaultdict
 #import numpy as np
 
 import Harvester as H
+from ShapeCache import ShapeCache
 import Constants as Constants
 import CombineHarvester.CombineTools.ch as ch
 
@@ -701,6 +702,9 @@ sbatch_memPerCPU={sbatch_memPerCPU}
 # for slurm submission instead!
 {c2}python Combine4Slurm.py -c {output} -o {slurm_dir}/${{WorkEra}} --method ${{combine_method}} --time ${{sbatch_time}} --mem-per-cpu ${{sbatch_memPerCPU}}
 
+# or to run the scripts on a local pool of workers instead ( timeouts, retries, skips the jobs already done )!
+#python Combine4Local.py -c {output} --method {method} -j $(nproc) {link}
+
 """.format(output           = output.replace('work_'+ H.EraFromPOG(era), '$WorkEra'),
            WorkEra          = 'work_' + H.EraFromPOG(era),
            slurm_dir        = output.split('work__UL')[0],
@@ -711,7 +715,9 @@ sbatch_memPerCPU={sbatch_memPerCPU}
            c1               = '#' if submit_to_slurm  else '',
            c2               = ''  if submit_to_slurm  else '#',
            symbol           = symbolic_path.split('/')[-1],
-           symbolic_path    = symbolic_path
+           symbolic_path    = symbolic_path,
+           method           = method,
+           link             = '--link %s'%symbolic_path if H.EraFromPOG(era) == '_ULfullrun2' else ''
            )
    
     print( '\tThe generated script to run limits can be found in : %s/' %output)
@@ -1721,6 +1727,16 @@ if __name__ == '__main__':
                                                         'The seed for the toy generation can be modified with the option -s (use -s -1 for a random seed). \n'
                                                         'The output file will contain one entry in the tree for each of these toys.\n')
     
+    parser.add_argument('--shapes-cache',       action='store', dest='shapes_cache', required=False, default=None,
+                                                help='Directory of the shapes cache shared between invocations, only the input files that changed since\n'
+                                                     'the last run are read again ( default : no cache )')
+    parser.add_argument('--shapes-cache-size',  action='store', dest='shapes_cache_size', required=False, type=float, default=None,
+                                                help='Maximum size of the shapes cache in MB, the least recently used entries are evicted above it')
+    parser.add_argument('--histstore',          action='store_true', dest='histstore', required=False, default=False,
+                                                help='List the histograms from the columnar store of the input directory ( indexed with python3 HistStore.py -i input )\n'
+                                                     'instead of scanning the keys of the ROOT files')
+    parser.add_argument('-j', '--jobs',         action='store', dest='jobs', required=False, type=int, default=1,
+                                                help='Number of workers used to load and merge the input histograms in parallel ( 1 : serial mode )')
     parser.add_argument('-v', '--verbose',      action='store', required=False, type=int, default=0, 
                                                 help='For debugging purposes , you may consider this argument !')
     
@@ -1732,6 +1748,13 @@ if __name__ == '__main__':
     H.splitTTbar     = options.splitTTbar
     H.splitDrellYan  = options.splitDrellYan 
     H.rm_mix_lo_nlo_bbH_signal = options.rm_mix_lo_nlo_bbH_signal
+    H.nWorkers       = options.jobs
+    if options.histstore:
+        from HistStore import HistStore
+        # listing only : the store is indexed with python3 HistStore.py, the files not covered are read with ROOT
+        H.histStore = HistStore(options.input, update=False)
+    if options.shapes_cache:
+        H.shapeCache = ShapeCache(options.shapes_cache, options.shapes_cache_size)
 
     if not os.path.isdir(options.output):
         os.makedirs(options.output)
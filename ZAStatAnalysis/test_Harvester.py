@@ -0,0 +1,45 @@
+import pytest
+
+ROOT = pytest.importorskip('ROOT')
+
+from Harvester import merge_histograms, get_hist_from_key, _read_file_histograms
+
+
+def merge_categories(get_hist, categories, smpScale):
+    """ Same lookups as prepareFile : one histogram name mapped to several categories ( --mode mllbb / mbb ) """
+    shapes = {}
+    for category in categories:
+        for name in ['h', 'h__jesup']:
+            shapes[(category, name)] = merge_histograms('smp', smpScale, 'ggH', get_hist(name), shapes.get((category, name)), 1., True)
+    return shapes
+
+
+def test_serial_same_as_parallel(tmp_path):
+    """ the shapes merged from the histograms read once ( parallel / cache ) are the ones merged from a fresh read per lookup ( serial ) """
+    path = str(tmp_path / 'smp.root')
+    f = ROOT.TFile.Open(path, 'recreate')
+    for name, content in [('h', 2.), ('h__jesup', 3.)]:
+        h = ROOT.TH1F(name, name, 4, 0., 4.)
+        for i in range(1, 5):
+            h.SetBinContent(i, content*i)
+            h.SetBinError(i, 0.1*i)
+        h.Write()
+    f.Close()
+    categories = ['MH-{}_MA-{}'.format(mH, mA) for mH, mA in [(500, 200), (650, 50), (800, 400)]]
+
+    f = ROOT.TFile.Open(path)
+    keys = dict((key.GetName(), key) for key in f.GetListOfKeys())
+    serial = merge_categories(lambda name: get_hist_from_key(keys, name), categories, 0.5)
+
+    hists, _, _ = _read_file_histograms((path, set(['h']), None))
+    parallel = merge_categories(hists.get, categories, 0.5)
+
+    assert sorted(serial.keys()) == sorted(parallel.keys())
+    for key, h in serial.items():
+        for i in range(1, 5):
+            assert parallel[key].GetBinContent(i) == pytest.approx(h.GetBinContent(i))
+            assert parallel[key].GetBinError(i) == pytest.approx(h.GetBinError(i))
+        assert h.GetBinContent(1) == pytest.approx(0.5*(2. if key[1] == 'h' else 3.))
+    # the histograms read once are left unscaled
+    assert hists['h'].GetBinContent(1) == pytest.approx(2.)
+    f.Close()
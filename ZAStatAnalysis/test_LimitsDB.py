@@ -0,0 +1,75 @@
+import os
+import json
+import random
+
+from LimitsDB import LimitsDB, DB_NAME, read_limits
+
+
+def limits_of(expected):
+    return {'expected': expected, 'observed': expected*1.1, 'one_sigma': [expected*0.8, expected*1.2], 'two_sigma': [expected*0.6, expected*1.4]}
+
+
+def test_db_same_as_json(tmp_path):
+    """ read_limits gives the same points, in the same order, from the database and from the json written by collectLimits.py """
+    category, cl, era, method = 'ggH_nb2_resolved_OSSF', 'CLs', '2017', 'asymptotic'
+    random.seed(42)
+    points = [('{}'.format(mH), '{}'.format(mA)) for mH in range(200, 1000, 50) for mA in range(50, mH-90, 100)]
+    # glob order of collectLimits.py, not the alphabetical order of the files
+    random.shuffle(points)
+
+    json_points = []
+    with LimitsDB(str(tmp_path)) as limitsDB:
+        for position, (mH, mA) in enumerate(points):
+            f = str(tmp_path / 'MH-{}_MA-{}'.format(mH, mA) / 'higgsCombine.AsymptoticLimits.mH125.root')
+            r = random.random()
+            point_limits = None if r < 0.1 else limits_of(0. if r < 0.2 else r)
+            limitsDB.put(f, era, method, 'sha1-{}'.format(position), category, cl, mH, mA, point_limits, position)
+            # selection of collectLimits.py
+            if point_limits is None or point_limits['expected'] == 0:
+                continue
+            json_points.append({'parameters': (mH, mA), 'limits': point_limits})
+
+    with open(os.path.join(str(tmp_path), 'combinedlimits_{}_{}_UL{}.json'.format(category, cl, era)), 'w') as jf:
+        json.dump(json_points, jf, indent=4)
+
+    assert os.path.isfile(os.path.join(str(tmp_path), DB_NAME))
+    from_json = read_limits(str(tmp_path), category, cl, era, db=False)
+    from_db   = read_limits(str(tmp_path), category, cl, era, db=True)
+    assert len(from_json) < len(points)
+    assert from_db == from_json
+
+
+def collect(path, points, category, cl, era, method):
+    """ Same steps as collectLimits.py for one category : record and prune the database, write the json """
+    json_points = []
+    collected   = []
+    with LimitsDB(path) as limitsDB:
+        for position, (mH, mA, point_limits) in enumerate(points):
+            f = os.path.join(path, 'MH-{}_MA-{}'.format(mH, mA), 'higgsCombine{}.AsymptoticLimits.mH125.root'.format(category))
+            limitsDB.put(f, era, method, 'sha1-{}-{}'.format(mH, mA), category, cl, mH, mA, point_limits, position)
+            collected.append(f)
+            if point_limits is None or point_limits['expected'] == 0:
+                continue
+            json_points.append({'parameters': (mH, mA), 'limits': point_limits})
+        limitsDB.prune(category, cl, era, method, collected)
+    with open(os.path.join(path, 'combinedlimits_{}_{}_UL{}.json'.format(category, cl, era)), 'w') as jf:
+        json.dump(json_points, jf, indent=4)
+
+
+def test_db_forgets_removed_points(tmp_path):
+    """ a point whose combine output disappeared between two collections is no longer returned by the database """
+    category, cl, era, method = 'ggH_nb2_resolved_OSSF', 'CLs', '2017', 'asymptotic'
+    other = 'bbH_nb2_resolved_OSSF'
+    points = [('{}'.format(mH), '{}'.format(mA), limits_of(mH/1000.)) for mH, mA in [(500, 200), (650, 50), (800, 400), (1000, 500)]]
+    collect(str(tmp_path), points, category, cl, era, method)
+    collect(str(tmp_path), points[:1], other, cl, era, method)
+    assert len(read_limits(str(tmp_path), category, cl, era, db=True)) == len(points)
+
+    # second collection : ( 650, 50 ) is gone
+    collect(str(tmp_path), points[:1]+points[2:], category, cl, era, method)
+    from_json = read_limits(str(tmp_path), category, cl, era, db=False)
+    from_db   = read_limits(str(tmp_path), category, cl, era, db=True)
+    assert len(from_json) == len(points) - 1
+    assert from_db == from_json
+    # the other categories are left untouched
+    assert read_limits(str(tmp_path), other, cl, era, db=True) == read_limits(str(tmp_path), other, cl, era, db=False)
@@ -6,44 +6,79 @@ import numpy as np
 
 from bamboo.root import gbl as ROOT
 
-def getEnvelopeHistograms(nominal, variations):
+def envelopeArrays(nominal, variations, method="minmax"):
     """
-    Compute envelope histograms create by all variations histograms. The envelop is simply the maximum
-    and minimum deviations from nominal for each bin of the distribution
-    Arguments:
-    nominal: The nominal histogram
-    variations: a list of histograms to compute the envelop from
+    Up and down arrays of the envelope of the variations, in one numpy pass over all the cells
+    nominal   : array (n_cells,) of the nominal bin contents
+    variations: array (n_var, n_cells), one variation per row (see stackHistArrays)
+    method    : "minmax"  : maximum and minimum over the variations (QCD scale)
+                "hessian" : nominal +/- sqrt( sum of the squared deviations from nominal ) (Hessian PDF set)
+                "mc"      : nominal +/- standard deviation of the replicas (MC PDF set)
+    For the hessian and mc methods the down variation is clipped at 0
     """
-    if len(variations) < 2:
-        raise TypeError("At least two variations histograms must be provided")
+    variations = np.asarray(variations, dtype=np.float64)
+    if method == "minmax":
+        return variations.max(axis=0), variations.min(axis=0)
+    if method == "hessian":
+        sigma = np.sqrt(((variations - nominal)**2).sum(axis=0))
+    elif method == "mc":
+        sigma = variations.std(axis=0, ddof=1)
+    else:
+        raise ValueError("Unknown envelope method {}, choose one of minmax, hessian or mc".format(method))
+    return nominal + sigma, np.clip(nominal - sigma, 0., None)
+
 
-    # Use GetNcells() so that it works also for 2D histograms
+def stackHistArrays(nominal, variations):
+    """Bin contents of nominal (n_cells,) and of the variations stacked in one (n_var, n_cells) array"""
     n_bins = nominal.GetNcells()
     for v in variations:
         if v.GetNcells() != n_bins:
             raise RuntimeError("Variation histograms do not have the same binning as the nominal histogram")
+    nom = getHistArrays(nominal)[0]
+    stacked = np.empty((len(variations), n_bins))
+    for i, v in enumerate(variations):
+        stacked[i] = getHistArrays(v)[0]
+    return nom, stacked
+
+
+def histFromArray(template, values, name, reset=False):
+    """Clone of template named name with the bin contents values, reset : also clear the errors of template"""
+    hist = template.Clone(name)
+    hist.SetDirectory(ROOT.nullptr)
+    if reset:
+        hist.Reset()
+    hist.SetContent(np.ascontiguousarray(values, dtype=np.float64))
+    return hist
 
-    up = nominal.Clone()
-    up.SetDirectory(ROOT.nullptr)
-    up.Reset()
 
-    down = nominal.Clone()
-    down.SetDirectory(ROOT.nullptr)
-    down.Reset()
+def getEnvelopeHistogramsFromArrays(nominal, variations, method="minmax", names=None, reset=False):
+    """Envelope (up, down) histograms of the variations (TH1 list), names : (up name, down name)"""
+    if len(variations) < 2:
+        raise TypeError("At least two variations histograms must be provided")
+    nom, stacked = stackHistArrays(nominal, variations)
+    up, down = envelopeArrays(nom, stacked, method)
+    names = names or (nominal.GetName(), nominal.GetName())
+    return histFromArray(nominal, up, names[0], reset), histFromArray(nominal, down, names[1], reset)
+
 
-    for i in range(0, n_bins):
-        minimum = float("inf")
-        maximum = float("-inf")
+def getEnvelopeHistograms(nominal, variations):
+    """
+    Compute envelope histograms create by all variations histograms. The envelop is simply the maximum
+    and minimum deviations from nominal for each bin of the distribution
+    Arguments:
+    nominal: The nominal histogram
+    variations: a list of histograms to compute the envelop from
+    """
+    return getEnvelopeHistogramsFromArrays(nominal, variations, "minmax", reset=True)
 
-        for v in variations:
-            c = v.GetBinContent(i)
-            minimum = min(minimum, c)
-            maximum = max(maximum, c)
 
-        up.SetBinContent(i, maximum)
-        down.SetBinContent(i, minimum)
+def writeHistograms(path, hists):
+    """Write all the histograms {name: hist} in the file path at once (replacing the existing ones)"""
+    tf = openFileAndGet(path, "update")
+    for name, hist in hists.items():
+        tf.WriteTObject(hist, name, "Overwrite")
+    tf.Close()
 
-    return (up, down)
 
 class FileCache(object):
     """Hold a set of TFile's open. If a new file is requested, it os opened and returned. If it is already known, it is cd()'d to and returned."""
@@ -170,6 +205,41 @@ def randomiseHistMCStats(hist):
     return newHist
 
 
+def _viewToArray(view, n):
+    """Copy n values of a C array (TArray::GetArray()) to a float64 numpy array"""
+    view.reshape((n,))
+    return np.array(view, dtype=np.float64)
+
+
+def getHistArrays(hist):
+    """
+    Return (contents, sumw2) of hist as numpy arrays of GetNcells() entries (under/overflow included)
+    For a histogram filled without weights, sumw2 is the bin content
+    """
+    n = hist.GetNcells()
+    contents = _viewToArray(hist.GetArray(), n)
+    if hist.GetSumw2N() > 0:
+        sumw2 = _viewToArray(hist.GetSumw2().GetArray(), n)
+    else:
+        sumw2 = contents.copy()
+    return contents, sumw2
+
+
+def setHistArrays(hist, contents, sumw2, entries=None):
+    """Set the bin contents and sum of squared weights of hist from numpy arrays (as returned by getHistArrays)"""
+    n = hist.GetNcells()
+    if contents.shape[0] != n or sumw2.shape[0] != n:
+        raise RuntimeError("Arrays of {} cells for histogram {} of {} cells".format(contents.shape[0], hist.GetName(), n))
+    if hist.GetSumw2N() == 0:
+        hist.Sumw2()
+    hist.SetContent(np.ascontiguousarray(contents, dtype=np.float64))
+    hist.GetSumw2().Set(n, np.ascontiguousarray(sumw2, dtype=np.float64))
+    hist.ResetStats()
+    if entries is not None:
+        hist.SetEntries(entries)
+    return hist
+
+
 def addHists(histList, newName):
     """Add histograms in list `histList` together, return histogram with name `newName`"""
     myIt = iter(histList)
@@ -41,7 +41,33 @@ def analyze_inputs_outputs(graph):
     return (inputs, outputs)
 
 
-def KerasToTensorflowModel(path_to_all=None, job= None, path_to_json= None, path_to_h5= None, prefix= None, name=None, outdir=None):
+def GridModel(keras_model, masses, mass_inputs=('mH', 'mA')):
+    """
+    Wraps the parametric model to evaluate one event at all the mass points in a single call
+    masses : list of (mH, mA), the mass grid is a constant of the graph
+    The inputs are the ones of the model without mH and mA (same order), the event is repeated over the grid 
+    and the model evaluated on the batch of len(masses) rows, the output is flattened to (1, len(masses)*nodes) :
+    the score of node j at the mass point i is out[i*nodes+j]
+    """
+    M       = len(masses)
+    grid    = tf.constant(masses, dtype=tf.float32)                # (M, 2)
+    nodes   = keras_model.outputs[0].shape[-1]
+    inputs  = {n: tf.keras.Input(shape=(1,), name=n) for n in keras_model.input_names if n not in mass_inputs}
+    ref     = list(inputs.values())[0]
+    repeat  = tf.keras.layers.Lambda(lambda x: tf.reshape(tf.tile(x, [1, M]), [-1, 1]))   # row k*M+i = event k
+    columns = []
+    for n in keras_model.input_names:
+        if n in mass_inputs:
+            i = mass_inputs.index(n)
+            columns.append(tf.keras.layers.Lambda(lambda x, i=i: tf.tile(grid[:, i:i+1], [tf.shape(x)[0], 1]), name=f'grid_{n}')(ref))
+        else:
+            columns.append(repeat(inputs[n]))
+    out = keras_model(columns)
+    out = tf.keras.layers.Lambda(lambda x: tf.reshape(x, [-1, M*nodes]), name='out')(out)
+    return tf.keras.Model(inputs=list(inputs.values()), outputs=out), nodes
+
+
+def KerasToTensorflowModel(path_to_all=None, job= None, path_to_json= None, path_to_h5= None, prefix= None, name=None, outdir=None, grid=None):
 
     if path_to_all is not None:
         outdir = os.path.join(path_to_all,'keras_tf_onnx_models/')
@@ -63,6 +89,16 @@ def KerasToTensorflowModel(path_to_all=None, job= None, path_to_json= None, path
     keras_model  = model_from_json(keras_model_json, custom_objects={name:getattr(Operations,name) for name in dir(Operations) if name.startswith('op')})
     keras_model.load_weights(path_to_h5)
     
+    if grid is not None:
+        # grid : json list of (mH, mA), saved again next to the model with the number of nodes to find the scores back
+        with open(grid) as f:
+            masses = [tuple(float(m) for m in point) for point in json.load(f)]
+        keras_model, nodes = GridModel(keras_model, masses)
+        suffix += '_grid'
+        with open(os.path.join(outdir, suffix+'.json'), 'w') as f:
+            json.dump({'masses': masses, 'nodes': nodes}, f)
+        logger.info(f'Model evaluated on {len(masses)} mass points per call, grid saved in {os.path.join(outdir, suffix+".json")}')
+    
     if job =='k2onnx':
         try: 
             import keras2onnx
@@ -146,6 +182,7 @@ if __name__ == '__main__':
     # If needed you can still pass .json and .h5 files instead of the full path  with --path ! 
     parser.add_argument('--json',required=False, type=str,help='The json model file you wish to convert to .pb')
     parser.add_argument('--h5',required=False, type=str,help='The h5 model model weights file you wish to convert to .pb **do not use _full.h5**')
+    parser.add_argument('--grid', required=False, default=None, type=str, help='json list of (mH, mA) : export a model evaluating each event at all these mass points in one call (<model>_grid.pb/.onnx + <model>_grid.json)')
     parser.add_argument('--name', required=False, default='best_model', help='The name of the resulting output graph will be given ad {name}.pb for TF and {name}.onnx for ONNX- default("best_model.pb and best_model.onnx")')
     args = parser.parse_args()
 
@@ -160,4 +197,5 @@ if __name__ == '__main__':
                            path_to_h5       = args.h5,
                            prefix           = 'k2TF' if args.job == 'k2tf' else 'k2onnx',
                            name             = args.name,
-                           outdir           = args.outdir)
+                           outdir           = args.outdir,
+                           grid             = args.grid)
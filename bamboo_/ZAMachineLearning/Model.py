@@ -30,7 +30,8 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2' # removes annoying warning
 
 import Operations
 import parameters
-from data_generator import DataGenerator
+from data_generator import DataGenerator, ShardGenerator
+from parameterize_classifier import LazyParametrization
 
 import IPython
 tf_version = tf.__version__.split('.')
@@ -56,6 +57,39 @@ class LossHistory(tf.keras.callbacks.Callback):
         self.epochs['lr'].append(tf.keras.backend.eval(self.model.optimizer.lr))
         self.pre_batch = self.batches['batch'][-1] 
 
+class PruneScan(tf.keras.callbacks.Callback):
+    """
+    Stops the training of a scan permutation that is clearly worse than the best one found so far
+    best      : multiprocessing.Value shared by all the workers of the local scan, lowest val_loss seen
+    threshold : the training is stopped if val_loss > best*(1+threshold) ...
+    warmup    : ... after this number of epochs
+    """
+    def __init__(self, best, threshold, warmup):
+        super(PruneScan,self).__init__()
+        self.best      = best
+        self.threshold = threshold
+        self.warmup    = warmup
+        self.pruned    = False
+
+    def on_epoch_end(self, epoch, logs={}):
+        val_loss = logs.get('val_loss')
+        if val_loss is None:
+            return
+        with self.best.get_lock():
+            if val_loss < self.best.value:
+                self.best.value = val_loss
+            best = self.best.value
+        if epoch+1 >= self.warmup and val_loss > best*(1+self.threshold):
+            logging.info('Pruned at epoch %d : val_loss = %0.5f, best of the scan = %0.5f'%(epoch+1,val_loss,best))
+            self.pruned = True
+            self.model.stop_training = True
+
+# Additional callbacks of the training, set by the workers of the local scan (see local_scan.py) #
+extra_callbacks = []
+
+# (training, validation) DF of the parameterized classifier, set by HyperModel.HyperScan when parameters.parametrize is set #
+parametrized_sets = None
+
 def PlotHistory(history,params):
     """ Takes history from Keras training and makes loss plots (batch and epoch) and learning rate plots """
     #----- Figure -----#
@@ -208,7 +242,7 @@ def NeuralNetModel(x_train,y_train,x_val,y_val,params):
     #                    write_graph=True, 
     #                    write_grads=True, 
     #                    write_images=True)
-    Callback_list = [loss_history,early_stopping,reduceLR]
+    Callback_list = [loss_history,early_stopping,reduceLR]+extra_callbacks
 
     # Compile #
     if 'resume' not in params:  # Normal learning 
@@ -230,18 +264,27 @@ def NeuralNetModel(x_train,y_train,x_val,y_val,params):
                            tf.keras.metrics.Precision(),
                            tf.keras.metrics.Recall()])
     model.summary()
-    fit_inputs = np.hsplit(x_train,x_train.shape[1])
-    fit_val    = (np.hsplit(x_val,x_val.shape[1]),y_val,w_val)
     
     # Fit #
-    history = model.fit(x               = fit_inputs,
-                        y               = y_train,
-                        sample_weight   = w_train,
-                        epochs          = params['epochs'],
-                        batch_size      = params['batch_size'],
-                        verbose         = 1,
-                        validation_data = fit_val,
-                        callbacks       = Callback_list)
+    if parametrized_sets is not None:
+        # Batches with one mass point per background event, drawn again at each epoch #
+        df_train, df_val = parametrized_sets
+        history = model.fit(x               = LazyParametrization(df_train,parameters.parametrize,params['batch_size']),
+                            epochs          = params['epochs'],
+                            verbose         = 1,
+                            validation_data = LazyParametrization(df_val,parameters.parametrize,params['batch_size'],shuffle=False,seed=0),
+                            callbacks       = Callback_list)
+    else:
+        fit_inputs = np.hsplit(x_train,x_train.shape[1])
+        fit_val    = (np.hsplit(x_val,x_val.shape[1]),y_val,w_val)
+        history = model.fit(x               = fit_inputs,
+                            y               = y_train,
+                            sample_weight   = w_train,
+                            epochs          = params['epochs'],
+                            batch_size      = params['batch_size'],
+                            verbose         = 1,
+                            validation_data = fit_val,
+                            callbacks       = Callback_list)
     # Plot history #
     PlotHistory(loss_history,params)
 
@@ -328,7 +371,7 @@ def NeuralNetGeneratorModel(x_train,y_train,x_val,y_val,params):
 #                        write_grads=True, 
 #                        write_images=True)
 #    Callback_list = [loss_history,early_stopping,reduceLR,board]
-    Callback_list = [loss_history,early_stopping,reduceLR]
+    Callback_list = [loss_history,early_stopping,reduceLR]+extra_callbacks
 
     # Compile #
     if 'resume' not in params:  # Normal learning 
@@ -352,23 +395,35 @@ def NeuralNetGeneratorModel(x_train,y_train,x_val,y_val,params):
     model.summary()
 
     # Generator #
-    training_generator   = DataGenerator( path       = parameters.config,
-                                          inputs     = parameters.inputs,
-                                          outputs    = parameters.outputs,
-                                          cut        = parameters.cut,
-                                          weight     = parameters.weight,
-                                          batch_size = params['batch_size'],
-                                          state_set  = 'training',
-                                          model_idx  = params['model_idx'] if parameters.crossvalidation else None)
-    
-    validation_generator = DataGenerator( path       = parameters.config,
-                                          inputs     = parameters.inputs,
-                                          outputs    = parameters.outputs,
-                                          cut        = parameters.cut,
-                                          weight     = parameters.weight,
-                                          batch_size = params['batch_size'],
-                                          state_set  = 'validation',
-                                          model_idx  = params['model_idx'] if parameters.crossvalidation else None)
+    if parameters.generator_shards:
+        training_generator   = ShardGenerator(inputs     = parameters.inputs,
+                                              outputs    = parameters.outputs,
+                                              batch_size = params['batch_size'],
+                                              state_set  = 'training')
+        validation_generator = ShardGenerator(inputs     = parameters.inputs,
+                                              outputs    = parameters.outputs,
+                                              batch_size = params['batch_size'],
+                                              state_set  = 'validation')
+    else:
+        training_generator   = DataGenerator( path       = parameters.config,
+                                              inputs     = parameters.inputs,
+                                              outputs    = parameters.outputs,
+                                              cut        = parameters.cut,
+                                              weight     = parameters.weight,
+                                              batch_size = params['batch_size'],
+                                              state_set  = 'training',
+                                              model_idx  = params['model_idx'] if parameters.crossvalidation else None,
+                                              prefetch   = parameters.generator_prefetch)
+        
+        validation_generator = DataGenerator( path       = parameters.config,
+                                              inputs     = parameters.inputs,
+                                              outputs    = parameters.outputs,
+                                              cut        = parameters.cut,
+                                              weight     = parameters.weight,
+                                              batch_size = params['batch_size'],
+                                              state_set  = 'validation',
+                                              model_idx  = params['model_idx'] if parameters.crossvalidation else None,
+                                              prefetch   = parameters.generator_prefetch)
 
     # Some verbose logging #
     logging.info("Will use %d workers"%parameters.workers)
@@ -32,7 +32,7 @@ import Model
 from split_training import DictSplit
 from plot_scans import PlotScans
 from preprocessing import PreprocessLayer
-from data_generator import DataGenerator
+from data_generator import DataGenerator, ShardGenerator
 from generate_mask import GenerateSliceIndices, GenerateSliceMask
 
 class HyperModel:
@@ -56,34 +56,42 @@ class HyperModel:
             for name in self.list_outputs:
                 logging.info('..... %s'%name)
 
-    def HyperScan(self,data,task,model_idx=None,generator=False,resume=False):
+    def HyperScan(self,data,task,model_idx=None,generator=False,resume=False,arrays=None):
         """
         Performs the scan for hyperparameters
         If task is specified, will load a pickle dict splitted from the whole set of parameters
         Data is a pandas dataframe containing all the event informations (inputs, outputs and unused variables)
+        arrays : (x_train, y_train, x_val, y_val) already split, used instead of data (local scan, see local_scan.py)
         The column to be selected are given in list_inputs, list_outputs as lists of strings
         Reference : /home/ucl/cp3/fbury/.local/lib/python3.6/site-packages/talos/scan/Scan.py
         """
         logging.info(' Starting scan '.center(80,'-'))
             
         # Records #
-        if not generator:
+        if not generator and arrays is not None:
+            self.x_train, self.y_train, self.x_val, self.y_val = arrays
+            logging.info("Training set   : %d"%self.x_train.shape[0])
+            logging.info("Evaluation set : %d"%self.x_val.shape[0])
+        elif not generator:
             x = data[[param.replace('$','') for param in parameters.inputs]].values
             y = data[self.list_outputs+['learning_weight']].values
             # Data splitting #
             if model_idx is None:
                 size = parameters.training_ratio/(parameters.training_ratio+parameters.evaluation_ratio)
-                self.x_train, self.x_val, self.y_train, self.y_val = train_test_split(x,y,train_size=size)
+                train_sel, eval_sel = train_test_split(np.arange(x.shape[0]),train_size=size)
 
             else: # Cross validation : take the training and evaluation set based on the mask
                 # model_idx == index of mask on which model will be applied (aka, not trained nor evaluated)
                 _, eval_idx, train_idx = GenerateSliceIndices(model_idx) #, GenerateSliceMask
-                eval_mask  = GenerateSliceMask(eval_idx,data['mask'])
-                train_mask = GenerateSliceMask(train_idx,data['mask'])
-                self.x_val   = x[eval_mask]
-                self.y_val   = y[eval_mask]
-                self.x_train = x[train_mask]
-                self.y_train = y[train_mask]
+                eval_sel  = GenerateSliceMask(eval_idx,data['mask'])
+                train_sel = GenerateSliceMask(train_idx,data['mask'])
+            self.x_val   = x[eval_sel]
+            self.y_val   = y[eval_sel]
+            self.x_train = x[train_sel]
+            self.y_train = y[train_sel]
+            if parameters.parametrize is not None:
+                # The model is trained on the batches of the parameterized classifier built from the DF (see Model.NeuralNetModel) #
+                Model.parametrized_sets = (data.iloc[np.asarray(train_sel)],data.iloc[np.asarray(eval_sel)])
             logging.info("Training set   : %d"%self.x_train.shape[0])
             logging.info("Evaluation set : %d"%self.x_val.shape[0])
         else:
@@ -141,6 +149,7 @@ class HyperModel:
             if model_idx is not None:
                 name += '_crossval%d'%model_idx
             self.name_model = name+'_'+self.task.replace('.pkl','')
+            no = self.task.replace('.pkl','') # jobs running at the same time must not share the talos log
         
         #print (self.x_train)
         #print (self.x_train.shape)
@@ -191,15 +200,21 @@ class HyperModel:
                 model_eval.compile(optimizer=Adam(),loss={'OUT':parameters.p['loss_function'][0]},metrics=['accuracy'])
                 
                 # Evaluate model #
-                evaluation_generator = DataGenerator(path       = parameters.sampleList_full,
-                                                     TTree      = parameters.TTree, 
-                                                     inputs     = parameters.inputs,
-                                                     outputs    = parameters.outputs,
-                                                     cut        = parameters.cut,
-                                                     weight     = parameters.weight, 
-                                                     batch_size = parameters.p['batch_size'][0],
-                                                     state_set  = 'evaluation',
-                                                     model_idx  = model_idx if parameters.crossvalidation else None)
+                if parameters.generator_shards:
+                    evaluation_generator = ShardGenerator(inputs     = parameters.inputs,
+                                                          outputs    = parameters.outputs,
+                                                          batch_size = parameters.p['batch_size'][0],
+                                                          state_set  = 'evaluation')
+                else:
+                    evaluation_generator = DataGenerator(path       = parameters.sampleList_full,
+                                                         TTree      = parameters.TTree, 
+                                                         inputs     = parameters.inputs,
+                                                         outputs    = parameters.outputs,
+                                                         cut        = parameters.cut,
+                                                         weight     = parameters.weight, 
+                                                         batch_size = parameters.p['batch_size'][0],
+                                                         state_set  = 'evaluation',
+                                                         model_idx  = model_idx if parameters.crossvalidation else None)
                 eval_metric = model_eval.evaluate_generator(generator             = evaluation_generator,
                                                             workers               = parameters.workers,
                                                             use_multiprocessing   = True)
@@ -331,27 +346,30 @@ class HyperModel:
             logging.info('Starting plots')
             PlotScans(data=r.data,path=path_plot,tag='')
 
-    def HyperRestore(self,inputs,verbose=0,generator=False):
+    def HyperLoad(self):
         """
-        Retrieve a zip containing the best model, parameters, x and y data, ... and restores it
-        Produces an output from the input numpy array
+        Retrieve a zip containing the best model, parameters, x and y data, ... and return the restored keras model
         Reference :
             /home/ucl/cp3/fbury/.local/lib/python3.6/site-packages/talos/commands/restore.py
         """
         logging.info(('Using model %s.zip '%(self.name).center(80,'-')))
         # Restore model #
-        loaded = False
-        while not loaded:
+        while True:
             try:
                 print( os.path.join(parameters.path_model, self.name+'.zip') )
                 a = Restore(os.path.join(parameters.path_model, self.name+'.zip'),custom_objects=self.custom_objects)
-                loaded = True
+                return a.model
             except Exception as e:
                 logging.warning('Could not load model due to "%s", will try again in 3s'%e)
                 time.sleep(3)
-       
+
+    def HyperRestore(self,inputs,verbose=0,generator=False):
+        """
+        Restores the best model (see HyperLoad) and produces an output from the input numpy array
+        """
+        model    = self.HyperLoad()
         inputsLL = inputs[[param.replace('$','') for param in parameters.inputs]].astype(np.float32).values
-        outputs  = a.model.predict(np.hsplit(inputsLL,inputsLL.shape[1]),batch_size=parameters.output_batch_size,verbose=verbose)
+        outputs  = model.predict(np.hsplit(inputsLL,inputsLL.shape[1]),batch_size=parameters.output_batch_size,verbose=verbose)
 #       outputs  = a.model.predict_generator(output_generator,
 #                                            workers=parameters.workers,
 #                                            max_queue_size=2*parameters.workers,
@@ -8,6 +8,7 @@ import os
 import sys
 import pprint
 import copy
+import json
 import pickle
 import argparse
 #import psutil
@@ -63,6 +64,8 @@ def get_options():
         help='Wether to resubmit failed jobs given the name you give during submission ( must giev the same output)')
     b.add_argument('-debug','--debug', action='store_true', required=False, default=False,
         help='Debug mode of the slurm submission, does everything except submit the jobs')
+    b.add_argument('-local','--local', action='store', required=False, type=int, default=0,
+        help='Run the scan (--scan) on this number of local processes instead of slurm jobs, one parameter set per job (permutations already done are skipped)')
     #=========================================================================
     # Repot and Produce Outputs: This do csv concatenation and get the best model : workdir/model/*.csv
     #                            Further used for : Analyzing or producing outputs of the given model 
@@ -74,6 +77,10 @@ def get_options():
         help='Loads the provided model name (without .zip and type, it will find them)') 
     c.add_argument('-k','--key', action='store', required=False, nargs='+', type=str, default=[], 
         help='Applies the provided model (do not forget -k) on the list of keys from parameters.TTree') 
+    c.add_argument('--grid', action='store', required=False, type=str, default='',
+        help='With --report : json file with the list of mass points [[mH, mA], ...] at which the parametric model is evaluated for each event of the test set') 
+    c.add_argument('--backend', action='store', required=False, type=str, default=None, choices=['keras','onnx'],
+        help='Inference backend used to produce the outputs (default : parameters.inference_backend)') 
     #=========================================================================
     # Physics arguments #
     #=========================================================================
@@ -92,8 +99,14 @@ def get_options():
         help='Show DEGUG logging')
     f.add_argument('--GPU', action='store_true', required=False, default=False,
         help='GPU requires to execute some commandes before')
+    f.add_argument('--monitor', action='store_true', required=False, default=False,
+        help='Monitor the CPU, memory, I/O and generator usage during the scan, the time series is saved next to the models')
     f.add_argument('--cache', action='store_true', required=False, default=False,
         help='Will use the cache')
+    f.add_argument('--compile', action='store_true', required=False, default=False,
+        help='Write the weighted, shuffled and split data in memory-mappable shards (parameters.shards_path)')
+    f.add_argument('--shards', action='store_true', required=False, default=False,
+        help='Will load the data from the shards written with --compile')
     f.add_argument('--interactive', action='store_true', required=False, default=False,
         help='Interactive mode to check the dataframe')
     
@@ -115,6 +128,10 @@ def get_options():
     if opt.split!=0 and (opt.report or opt.key!='' or opt.scan!=''):
         logging.warning('Since you have specified a split, all the other arguments will be skipped')
     
+    if opt.grid!='' and not opt.report:
+        logging.critical('--grid is used with --report, on the test set of the best model')
+        sys.exit(1)
+    
     if opt.report and (opt.key!='' or opt.scan!=''):
         logging.warning('Since you have specified a scan report, all the other arguments will be skipped')
     
@@ -180,6 +197,7 @@ def main():
     from concatenate_csv import ConcatenateCSV
     from threadGPU import utilizationGPU
     from input_plots import InputPlots
+    from shards import CompileDataset, ShardDataset, SplitTrainingSet
     import parameters
 
     logging.info("="*94)
@@ -263,7 +281,7 @@ def main():
         path_output = os.path.join(opt.outputs,opt.model)
         if not os.path.exists(path_output):
             os.mkdir(path_output)
-        inst_out = ProduceOutput(model=path_output, generator=opt.generator)
+        inst_out = ProduceOutput(model=path_output, generator=opt.generator, backend=opt.backend)
         # Loop over output keys #
         for key in opt.key:
             # Create subdir #
@@ -285,7 +303,14 @@ def main():
 
     # Input path #
     logging.info('Starting tree importation')
-    if opt.cache:
+    if opt.shards:
+        logging.info(' --- loading from the compiled dataset')
+        dataset = ShardDataset(parameters.shards_path)
+        if not dataset.isUpToDate():
+            logging.warning(f'Input files changed since the dataset in {parameters.shards_path} was compiled, run again with --compile')
+        train_all = dataset.dataframe(['training','validation','evaluation'])
+        test_all  = dataset.dataframe('output')
+    elif opt.cache:
         logging.info(' --- trying to load from cache')
         if not os.path.exists(parameters.train_cache):
             raise RuntimeError(f'File not found: {parameters.train_cache}')
@@ -516,6 +541,11 @@ def main():
         
         logging.info('... Test set saved     : %s'%parameters.test_cache)
 
+    if opt.compile:
+        logging.info('Compiling the dataset in %s'%parameters.shards_path)
+        splits = SplitTrainingSet(train_all)
+        splits['output'] = test_all
+        CompileDataset(parameters.shards_path, splits)
 
     logging.info("Sample size to be seen by network : %d"%train_all.shape[0])
     if parameters.crossvalidation:
@@ -532,7 +562,21 @@ def main():
         # Start the GPU monitoring thread #
         thread = utilizationGPU(print_time = 900, print_current = False, time_step=0.01)
         thread.start()
-    if opt.scan != '':
+    if opt.monitor:
+        # Start the CPU, memory and I/O monitoring thread #
+        from threadCPU import utilizationCPU
+        from data_generator import generator_stats
+        thread_cpu = utilizationCPU(print_time = 900, time_step = 1., probes = [generator_stats.probe])
+        thread_cpu.start()
+    if opt.scan != '' and opt.local != 0:
+        from local_scan import LocalScan
+        LocalScan(name         = opt.scan,
+                  data         = train_all,
+                  list_inputs  = list_inputs,
+                  list_outputs = list_outputs,
+                  n_jobs       = opt.local,
+                  generator    = opt.generator)
+    elif opt.scan != '':
         instance = HyperModel(opt.scan,list_inputs,list_outputs)
         instance.HyperScan(data      = train_all,
                            task      = opt.task,
@@ -544,6 +588,11 @@ def main():
         # Closing monitor thread #
         thread.stopLoop()
         thread.join()
+    if opt.monitor:
+        # Closing monitor thread and saving the time series #
+        thread_cpu.stopLoop()
+        thread_cpu.join()
+        thread_cpu.save(os.path.join(parameters.path_model,'resources_%s.csv'%(opt.scan if opt.scan != '' else 'run')))
     
     if opt.report:
         # Make path #
@@ -553,13 +602,23 @@ def main():
         # Instance of output class #
         inst_out = ProduceOutput(model       = [modelzipNm],
                                  generator   = opt.generator,
-                                 list_inputs = list_inputs)
+                                 list_inputs = list_inputs,
+                                 backend     = opt.backend)
         # Use it on test samples #
         logging.info('  Processing test output sample  '.center(80,'*'))
         if parameters.crossvalidation: # in cross validation the testing set in inside the training DF
             inst_out.OutputFromTraining(data=train_all,path_output=path_output, crossval_use_training=True)
         else:
             inst_out.OutputFromTraining(data=test_all,path_output=path_output, crossval_use_training=False)
+        # Parametric model on the mass grid #
+        if opt.grid != '':
+            with open(opt.grid) as handle:
+                masses = np.asarray(json.load(handle),dtype=np.float32).reshape(-1,2)
+            logging.info(('  Processing test output sample on %d mass points  '%masses.shape[0]).center(80,'*'))
+            inst_out.OutputGrid(data        = train_all if parameters.crossvalidation else test_all,
+                                masses      = masses,
+                                path_output = path_output,
+                                output_name = 'grid_output.root')
              
 if __name__ == "__main__":
     main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# Micro-benchmark of the batch assembly of DataGenerator.__getitem__ (from the DF of a batch to the network arrays)
+# usage : python benchmark_data_generator.py [--batch 256 1024 4096 16384] [--inputs 20] [--repeat 50]
+import argparse
+import timeit
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import LabelEncoder, OneHotEncoder
+
+from data_generator import BatchArrays
+
+
+def make_batch(N, inputs, outputs):
+    data = pd.DataFrame({var: np.random.normal(size=N) for var in inputs})
+    data['tag']          = np.random.choice(outputs, size=N)
+    data['era']          = np.random.choice(['2016', '2017', '2018'], size=N)
+    data['event_weight'] = np.random.exponential(size=N)
+    return data
+
+
+def legacy_batch(data, inputs, outputs):
+    """ Batch assembly with the pandas apply and the encoders fitted on each batch """
+    data = data.copy()
+    weight_per_tag = {tag:data[data['tag']==tag]['event_weight'].sum() for tag in pd.unique(data['tag'])}
+    weight_scale   = data['tag'].apply(lambda row: weight_per_tag[row])
+    data['learning_weight'] = data['event_weight']*data.shape[0]/weight_scale
+    label_encoder  = LabelEncoder()
+    onehot_encoder = OneHotEncoder(sparse_output=False) if 'sparse_output' in OneHotEncoder().get_params() else OneHotEncoder(sparse=False)
+    label_encoder.fit(outputs)
+    integers  = label_encoder.transform(data['tag']).reshape(-1, 1)
+    onehotobj = onehot_encoder.fit(np.arange(len(outputs)).reshape(-1, 1))
+    onehot    = onehotobj.transform(integers)
+    cat  = pd.DataFrame(onehot,columns=label_encoder.classes_,index=data.index)
+    data = pd.concat([data,cat],axis=1)
+    data_input  = np.hsplit(data[inputs].astype(np.float32).values,len(inputs))
+    data_output = data[outputs].astype(np.float32).values
+    data_weight = data["learning_weight"].astype(np.float32).values
+    return data_input,data_output,data_weight
+
+
+def numpy_batch(data, inputs, outputs):
+    data_input,data_output,learning_weight = BatchArrays(data,inputs,outputs)
+    return data_input,data_output,learning_weight.astype(np.float32)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the batch assembly of DataGenerator')
+    parser.add_argument('--batch', nargs='+', type=int, default=[256, 1024, 4096, 16384], help='batch sizes to test')
+    parser.add_argument('--inputs', type=int, default=20, help='number of input variables')
+    parser.add_argument('--repeat', type=int, default=50, help='number of batches per measurement')
+    args = parser.parse_args()
+
+    inputs  = [f'var{i}' for i in range(args.inputs)]
+    outputs = ['DY', 'TT', 'ZA']
+
+    print(f"{'batch':>8} {'legacy [batch/s]':>18} {'numpy [batch/s]':>18} {'speed-up':>10}")
+    for N in args.batch:
+        data = make_batch(N, inputs, outputs)
+        # Same arrays from both #
+        ref, new = legacy_batch(data, inputs, outputs), numpy_batch(data, inputs, outputs)
+        assert all(np.array_equal(r, n) for r, n in zip(ref[0], new[0]))
+        assert np.array_equal(ref[1], new[1]) and np.allclose(ref[2], new[2], rtol=1e-6)
+        assert all(x.flags['C_CONTIGUOUS'] for x in new[0])
+        t_legacy = timeit.timeit(lambda: legacy_batch(data, inputs, outputs), number=args.repeat) / args.repeat
+        t_numpy  = timeit.timeit(lambda: numpy_batch(data, inputs, outputs), number=args.repeat) / args.repeat
+        print(f"{N:>8} {1./t_legacy:>18.1f} {1./t_numpy:>18.1f} {t_legacy/t_numpy:>10.1f}")
@@ -10,6 +10,10 @@ import collections
 import random
 import yaml
 import enlighten
+import time
+import threading
+import functools
+import multiprocessing
 import ROOT
 
 import numpy as np
@@ -17,16 +21,100 @@ import pandas as pd
 import tensorflow as tf
 
 from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
 from root_numpy import root2array, rec2array
 from prettytable import PrettyTable
-from sklearn.preprocessing import LabelEncoder, OneHotEncoder
 
 import parameters
-from import_tree import LoopOverTrees
+from import_tree import LoopOverTrees, FilePool
+from shards import ShardDataset
 from generate_mask import GenerateSampleMasks, GenerateSliceIndices
 
+class GeneratorStats:
+    """
+    Counters of the batches served by the generators, in shared memory so that the keras worker processes (forked)
+    fill the same ones, read by the monitoring thread (threadCPU.utilizationCPU with probes=[generator_stats.probe])
+    """
+    def __init__(self):
+        self._values = multiprocessing.Array('d',3) # batches, time waited for them, prefetched batches ready when requested
+        self._last   = (0.,0.,0.)
+
+    def record(self,wait,depth):
+        with self._values.get_lock():
+            self._values[0] += 1
+            self._values[1] += wait
+            self._values[2] += depth
+
+    def probe(self,process=None):
+        """ Batches served since the last call, with their average waiting time (s) and prefetch queue depth """
+        with self._values.get_lock():
+            values = tuple(self._values)
+        n = values[0]-self._last[0]
+        record = {'batches'      : n,
+                  'batch_wait_s' : (values[1]-self._last[1])/n if n > 0 else 0.,
+                  'queue_depth'  : (values[2]-self._last[2])/n if n > 0 else 0.}
+        self._last = values
+        return record
+
+generator_stats = GeneratorStats()
+
+SampleInfo = collections.namedtuple('SampleInfo', ['sample', 'era', 'key', 'tag', 'xsec', 'event_weight_sum'])
+
+@functools.lru_cache(maxsize=None)
+def SampleMetadata(input_dir, list_files):
+    """
+    Return dict file path -> SampleInfo (sample name, era, key and node tag in parameters.samples_dict_run2UL,
+    cross section and event weight sum), built once and shared by all the generators
+    (training, validation and evaluation sets, cross validation folds)
+    """
+    # sample name -> (era, key), first match as when looking through the sample dict #
+    lookup = {}
+    for era,keyDict in parameters.samples_dict_run2UL.items():
+        for key,list_samples in keyDict.items():
+            for sample in list_samples:
+                lookup.setdefault(sample,(era,key))
+    index = {}
+    for samplepath in list_files:
+        sample = samplepath.replace(input_dir,'') 
+        if sample.startswith("/"):
+            sample = sample[1:]
+        if sample not in lookup:
+            raise RuntimeError('Could not find sample %s in sampleDict'%sample)
+        era,key = lookup[sample]
+        tag     = max([node for node in parameters.nodes if node in key], key=len) # Find longest node match (eg if one node name is included in another)
+        sample_name      = os.path.basename(sample)
+        xsec             = parameters.xsec_dict.get(era,{}).get(sample_name)
+        event_weight_sum = parameters.event_weight_sum_dict.get(era,{}).get(sample_name)
+        index[samplepath] = SampleInfo(sample, era, key, tag, xsec, event_weight_sum)
+    return index
+
+def BatchArrays(data, inputs, outputs):
+    """
+    Arrays fed to the network from the DF of a batch, with numpy only
+    inputs  : names of the input variables
+    outputs : names of the nodes, the tag of each event is one-hot encoded on them
+    return  : list of contiguous float32 (N,1) arrays (one per input), float32 one-hot targets (N,len(outputs)),
+              learning weights (event weights equalised so that the weights of each tag sum to N)
+    """
+    N     = data.shape[0]
+    codes = pd.Categorical(data['tag'],categories=outputs).codes
+    if (codes < 0).any():
+        raise ValueError("Tags %s not in the outputs %s"%(list(pd.unique(data['tag'][codes < 0])),outputs))
+    # weight Equalization #
+    event_weight    = data['event_weight'].to_numpy(dtype=np.float64)
+    weight_per_tag  = np.bincount(codes,weights=event_weight,minlength=len(outputs))
+    learning_weight = event_weight*N/weight_per_tag[codes]
+    # Add target #
+    onehot = np.zeros((N,len(outputs)),dtype=np.float32)
+    onehot[np.arange(N),codes] = 1.
+    # One contiguous row per input #
+    data_input = np.empty((len(inputs),N),dtype=np.float32)
+    for i,var in enumerate(inputs):
+        data_input[i] = data[var].to_numpy()
+    return [x.reshape(-1,1) for x in data_input],onehot,learning_weight
+
 class DataGenerator(tf.keras.utils.Sequence):
-    def __init__(self, path=None, TTree=None, inputs=None, outputs=None, other=None, weight=None, cut='', batch_size=32, state_set='', model_idx=None):
+    def __init__(self, path=None, TTree=None, inputs=None, outputs=None, other=None, weight=None, cut='', batch_size=32, state_set='', model_idx=None, prefetch=0):
         self.path       = path                          # Path to root file : can be single file, list or dir (in which case will take all files inside)
         self.TTree      = TTree                         # List of keys to fetch when looking to the inputs root files
         self.inputs     = inputs                        # List of strings of the variables as inputs
@@ -35,6 +123,7 @@ class DataGenerator(tf.keras.utils.Sequence):
         self.weight     = weight                        # string for the branch containing the weight
         self.batch_size = batch_size                    # Batch size
         self.model_idx  = model_idx                     # model Idx for cross validation
+        self.prefetch   = prefetch                      # Number of batches read in advance on background threads (0 : read when requested)
         self.variables  = self.inputs + self.outputs    # List of all variables to be taken from root trees
         
         if other is not None and isinstance(other,list):
@@ -79,10 +168,40 @@ class DataGenerator(tf.keras.utils.Sequence):
         logging.info("Starting importation for %s set"%self.state_set)
 
         self.get_indices()
+        self.sample_info = SampleMetadata(self.input_dir, tuple(self.indices.keys()))
         self.get_fractions()
         self.n          = 0
         self.max        = self.__len__() # Must be after get_indices because that's where self.n_batches is defined
 
+        # Files kept open for the whole epoch and batches read in advance #
+        self.file_pool  = FilePool()
+        self._pid       = None
+        self._initPrefetch()
+
+    def _initPrefetch(self):
+        """ Prefetching state, one per process (keras workers with use_multiprocessing are forked) """
+        self._pid        = os.getpid()
+        self._executor   = ThreadPoolExecutor(max_workers=1) if self.prefetch > 0 else None
+        self._prefetched = {}
+        self._last_index = None
+        self._stride     = None                         # step between the batches requested in this process
+        self._misses     = 0                            # requests that did not follow the stride in a row
+        self._lock       = threading.Lock()
+        if self._executor is not None:
+            # the prefetching thread and the consumer read the files at the same time
+            ROOT.EnableThreadSafety()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ['_executor', '_prefetched', '_lock']:
+            state.pop(key, None)
+        state['_pid'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._initPrefetch()
+
     def get_indices(self):
         self.batch_sample = dict() 
         self.indices      = dict()
@@ -190,26 +309,10 @@ class DataGenerator(tf.keras.utils.Sequence):
             tag_count[i] = {node:0 for node in parameters.nodes}
             era_count[i] = {era:0 for era in parameters.eras}
             for samplepath in indices_sample.keys():
-                sample = samplepath.replace(self.input_dir,'') 
-                if sample.startswith("/"):
-                    sample = sample[1:]
-                keySelect   = None
-                eraSelect   = None
-                sample_dict = parameters.samples_dict_run2UL
-                for era,keyDict in sample_dict.items():
-                    for key,list_samples in keyDict.items():
-                        if sample in list_samples:
-                            keySelect = key
-                            eraSelect = era
-                            break
-                    if keySelect is not None:
-                        break
-                if keySelect is None:
-                    raise RuntimeError('Could not find sample %s in yaml file'%sample)
-                tag = max([node for node in parameters.nodes if node in keySelect], key=len)
+                info = self.sample_info[samplepath]
                 cont = len([i for i,m in zip(indices_sample[samplepath],masks_sample[samplepath]) if m])
-                tag_count[i][tag] += cont
-                era_count[i][eraSelect] += cont
+                tag_count[i][info.tag] += cont
+                era_count[i][info.era] += cont
 
             for s, ind in indices_sample.items(): 
                 indices_sample[s] = (min(ind),max(ind))
@@ -235,8 +338,56 @@ class DataGenerator(tf.keras.utils.Sequence):
         for line in pt_era.get_string().split('\n'):
             logging.info(line)
 
-    def __getitem__(self,index,additional_columns=False): # gets the batch for the supplied index
-        # return a tuple (numpy array of image, numpy array of labels) or None at epoch end
+    def _getBatchData(self,index):
+        """
+            Return the events of batch index, from the prefetched batches if it was read in advance
+            The prefetching follows the indices requested in this process : when they come with a regular step
+            (1 when the batches are requested in order, the number of workers for keras workers fed in turn),
+            the next `prefetch` ones along this step are read on a background thread
+            When the order is not regular (keras shuffling, workers fed as they get free), prefetching is 
+            switched off for this process, with a message
+        """
+        t0 = time.time()
+        if self._pid != os.getpid():
+            self._initPrefetch()
+        with self._lock:
+            depth  = sum(f.done() for f in self._prefetched.values())
+            future = self._prefetched.pop(index, None)
+            if self._last_index is not None:
+                step = (index - self._last_index) % self.n_batches
+                regular = step == self._stride
+                self._stride = step
+                self._misses = 0 if regular else self._misses + 1
+            else:
+                regular = False
+            self._last_index = index
+            if self._executor is not None and regular and self._stride > 0:
+                for k in range(1, self.prefetch+1):
+                    nxt = (index + k*self._stride) % self.n_batches
+                    if nxt != index and nxt not in self._prefetched:
+                        self._prefetched[nxt] = self._executor.submit(self._loadBatch, nxt)
+            # Forget the batches read in advance that were skipped #
+            for old in [i for i in self._prefetched.keys() if not self._ahead(index, i)]:
+                self._prefetched.pop(old).cancel()
+            if self._executor is not None and self._misses > 2*self.prefetch + 2:
+                logging.info(f"Batches requested out of order in process {os.getpid()} (last step {self._stride}), no prefetching in this process")
+                for f in self._prefetched.values():
+                    f.cancel()
+                self._prefetched = {}
+                self._executor.shutdown(wait=False)
+                self._executor = None
+        data = future.result() if future is not None else self._loadBatch(index)
+        generator_stats.record(time.time()-t0,depth)
+        return data
+
+    def _ahead(self,index,other):
+        """ Whether batch other is among the next `prefetch` ones after index along the stride of this process """
+        if not self._stride:
+            return False
+        return any((index + k*self._stride) % self.n_batches == other for k in range(1, self.prefetch+1))
+
+    def _loadBatch(self,index):
+        """ Read the events of batch index from the (kept open) input files """
         logging.debug("-"*80)
         logging.debug("New batch importation = index %d"%index)
 
@@ -247,28 +398,10 @@ class DataGenerator(tf.keras.utils.Sequence):
         eras    = []
         tags    = []
         for samplepath,ind in self.indices_per_batch[index].items():
-            sample = samplepath.replace(self.input_dir,'') 
-            if sample.startswith("/"):
-                sample = sample[1:]
-            keySelect = None
-            eraSelect = None
-            sample_dict = parameters.samples_dict_run2UL
-            for era,keyDict in sample_dict.items():
-                for key,list_samples in keyDict.items():
-                    if sample in list_samples:
-                        keySelect = key
-                        eraSelect = era
-                        break
-                if keySelect is not None:
-                    break
-            if eraSelect is None:
-                raise RuntimeError('Could not find the era in sampleDict for sample %s'%sample)
-            if keySelect is None:
-                raise RuntimeError('Could not find the key in sampleDict for sample %s'%sample)
-            eras.append(eraSelect)
-            tmp_nodes = [node for node in parameters.nodes if node in keySelect]
-            tags.append(max([node for node in parameters.nodes if node in keySelect], key=len)) # Find longest node match (eg if one node name is included in another)
-            samples.append(sample)
+            info = self.sample_info[samplepath]
+            eras.append(info.era)
+            tags.append(info.tag)
+            samples.append(info.sample)
             masks.append(self.masks_per_batch[index][samplepath])
             start.append(ind[0])
             stop.append(ind[1]+1) # Python stop and start 
@@ -280,50 +413,37 @@ class DataGenerator(tf.keras.utils.Sequence):
                               weight                    = self.weight,
                               cut                       = self.cut,
                               era                       = eras,
-                              luminosity                = parameters.lumidict[era],
+                              luminosity                = parameters.lumidict[eras[-1]],
                               xsec_dict                 = parameters.xsec_dict,
                               event_weight_sum_dict     = parameters.event_weight_sum_dict,
-                              additional_columns        = {'tag':node,'era':eras},
+                              additional_columns        = {'tag':tags,'era':eras},
                               tree_name                 = parameters.tree_name,
                               TTree                     = self.TTree, 
                               paramFun                  = None,
-                              start                     = None,
-                              stop                      = None)
+                              start                     = start,  # only the entries of the batch
+                              stop                      = stop,
+                              file_pool                 = self.file_pool)
         
         mask = [m for m in chain.from_iterable(masks)]
         data = data[mask]
         data = data.sample(frac=1).reset_index(drop=True) # Randomize
         assert data.shape[0] == self.batch_size
+        return data
 
-        # weight Equalization #
-        weight_per_tag = {tag:data[data['tag']==tag]['event_weight'].sum() for tag in pd.unique(data['tag'])}
-        weight_scale   = data['tag'].apply(lambda row: weight_per_tag[row])
-        data['learning_weight'] = data['event_weight']*data.shape[0]/weight_scale
+    def __getitem__(self,index,additional_columns=False): # gets the batch for the supplied index
+        # return a tuple (numpy array of image, numpy array of labels) or None at epoch end
+        data = self._getBatchData(index)
 
         inputs  = [var.replace('$','') for var in self.inputs]
         outputs = [var.replace('$','') for var in self.outputs]
-
-        # Add target #
-        label_encoder  = LabelEncoder()
-        onehot_encoder = OneHotEncoder(sparse=False)
-        label_encoder.fit(outputs)
-        # From strings to labels #
-        integers = label_encoder.transform(data['tag']).reshape(-1, 1)
-        # From labels to strings #
-        onehotobj = onehot_encoder.fit(np.arange(len(outputs)).reshape(-1, 1))
-        onehot    = onehotobj.transform(integers)
-        # From arrays to pd DF #
-        cat = pd.DataFrame(onehot,columns=label_encoder.classes_,index=data.index)
-        # Add to full #
-        data = pd.concat([data,cat],axis=1)
+        data_input,data_output,learning_weight = BatchArrays(data,inputs,outputs)
 
         if not additional_columns:
-            data_input  = np.hsplit(data[inputs].astype(np.float32).values,len(inputs))
-            data_output = data[outputs].astype(np.float32).values
-            data_weight = data["learning_weight"].astype(np.float32).values
-            return data_input,data_output,data_weight
+            return data_input,data_output,learning_weight.astype(np.float32)
         else:
-            return data
+            data['learning_weight'] = learning_weight
+            cat = pd.DataFrame(data_output,columns=outputs,index=data.index)
+            return pd.concat([data,cat],axis=1)
 
     def __len__(self): # gets the number of batches
         # return the number of batches in this epoch (do not change in the middle of an epoch)
@@ -339,3 +459,49 @@ class DataGenerator(tf.keras.utils.Sequence):
         result = self.__getitem__(self.n)
         self.n += 1
         return result
+
+
+class ShardGenerator(tf.keras.utils.Sequence):
+    """
+    Same batches as DataGenerator but read from the dataset compiled with ZAMachineLearning.py --compile (see shards.py)
+    The events are already weighted, shuffled and split, a batch is a slice of the memory-mapped columns
+    """
+    def __init__(self, path=None, inputs=None, outputs=None, batch_size=32, state_set=''):
+        self.dataset    = ShardDataset(path if path is not None else parameters.shards_path)
+        self.inputs     = [var.replace('$','') for var in inputs]
+        self.outputs    = [var.replace('$','') for var in outputs]
+        self.batch_size = batch_size
+        self.state_set  = state_set
+        if self.state_set not in ['training', 'validation', 'evaluation', 'output']:
+            raise RuntimeError(f"Generator state *{self.state_set}* not supported, available options :[training, validation, evaluation, output]")
+        if parameters.crossvalidation:
+            raise NotImplementedError("The compiled dataset is not split in slices for the cross validation")
+
+        self.n_tot = self.dataset.size(self.state_set)
+        if self.n_tot<self.batch_size:
+            raise RuntimeError("Fewer events than required batch size for generator")
+        self.n_batches = self.n_tot//self.batch_size
+        self.n         = 0
+        logging.info("Will use %d batches of %d events from %s (%d events will be lost for truncation purposes)"%(self.n_batches,self.batch_size,self.dataset.path,self.n_tot%self.batch_size))
+
+    def __getitem__(self,index):
+        t0   = time.time()
+        cols = self.dataset.slice(self.state_set, index*self.batch_size, (index+1)*self.batch_size, self.inputs+self.outputs+['learning_weight'])
+        data_input  = [cols[var].astype(np.float32,copy=False).reshape(-1,1) for var in self.inputs]
+        data_output = np.stack([cols[var] for var in self.outputs],axis=1).astype(np.float32,copy=False)
+        data_weight = cols['learning_weight'].astype(np.float32,copy=False)
+        generator_stats.record(time.time()-t0,0)
+        return data_input,data_output,data_weight
+
+    def __len__(self):
+        return self.n_batches
+
+    def on_epoch_end(self):
+        pass
+
+    def __next__(self):
+        if self.n >= self.n_batches:
+           self.n = 0
+        result = self.__getitem__(self.n)
+        self.n += 1
+        return result
@@ -7,6 +7,7 @@ import re
 import collections
 import copy
 import array
+import threading
 
 import numpy as np
 import pandas as pd
@@ -17,9 +18,48 @@ from ROOT import TChain, TFile, TTree
 import parameters
 
 
-def Tree2Pandas(input_file, variables, era=None, weight=None, cut=None, xsec=None, event_weight_sum=None, luminosity=None, paramFun=None, tree_name=None, t=None, start=None, stop=None, additional_columns={}):
+class FilePool:
+    """
+    Keeps the ROOT files opened once for the whole process, instead of one TFile.Open per read
+    Each thread gets its own handles ( a TTree cannot be read from two threads ), so that the reads of
+    different threads ( eg. the prefetching thread of DataGenerator ) run concurrently, only the lookup of
+    the handle is done holding `lock`. The files are reopened in a new process (fork of the keras workers
+    or after unpickling)
+    """
+    def __init__(self):
+        self._pid   = None
+        self._files = {}
+        self.lock   = threading.Lock()
+
+    def __getstate__(self):
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def get(self, path):
+        """ Return the TFile of path opened by this thread """
+        key = (threading.get_ident(), path)
+        with self.lock:
+            if self._pid != os.getpid():
+                self._files = {}
+                self._pid   = os.getpid()
+            if key not in self._files:
+                self._files[key] = TFile.Open(path)
+            return self._files[key]
+
+    def close(self):
+        with self.lock:
+            if self._pid == os.getpid():
+                for f in self._files.values():
+                    f.Close()
+            self._files = {}
+
+
+def Tree2Pandas(input_file, variables, era=None, weight=None, cut=None, xsec=None, event_weight_sum=None, luminosity=None, paramFun=None, tree_name=None, t=None, start=None, stop=None, additional_columns={}, file_pool=None):
     """
     Convert a ROOT TTree to a pandas DF
+    file_pool : FilePool from which to take the opened file (the file is then left open)
     """
     smpNm = os.path.basename(input_file)
     
@@ -40,7 +80,7 @@ def Tree2Pandas(input_file, variables, era=None, weight=None, cut=None, xsec=Non
         print ("File %s does not exist"%input_file)
         return None
     
-    file_handle = TFile.Open(input_file)
+    file_handle = TFile.Open(input_file) if file_pool is None else file_pool.get(input_file)
     if not file_handle.GetListOfKeys().Contains(t):
         logging.debug(f"\t\tCould not find TTree {t} key for sample: {smpNm}")
         return None
@@ -120,13 +160,15 @@ def Tree2Pandas(input_file, variables, era=None, weight=None, cut=None, xsec=Non
         nf = stop if stop is not None else N
         logging.debug(f"Reading from {ni} to {nf} in input tree (over {N} entries)")
     
-    file_handle.Close()
+    if file_pool is None:
+        file_handle.Close()
     return df
 
 
-def LoopOverTrees(input_dir, variables, list_sample=None, weight=None, cut=None, era=None, luminosity=None, xsec_dict=None, event_weight_sum_dict=None, additional_columns={}, tree_name=None, TTree=None, paramFun=None, start=None, stop=None):
+def LoopOverTrees(input_dir, variables, list_sample=None, weight=None, cut=None, era=None, luminosity=None, xsec_dict=None, event_weight_sum_dict=None, additional_columns={}, tree_name=None, TTree=None, paramFun=None, start=None, stop=None, file_pool=None):
     """
     Loop over ROOT trees inside input_dir and process them using Tree2Pandas.
+    file_pool : FilePool keeping the files open between calls (see Tree2Pandas)
     """
     # Check if directory #
     if not os.path.exists(input_dir):
@@ -164,18 +206,17 @@ def LoopOverTrees(input_dir, variables, list_sample=None, weight=None, cut=None,
         sample_name = os.path.basename(sample)
 
         # Eras
-        if isinstance(era,list):
-            era = eras
+        smp_era = era[i] if isinstance(era,list) else era
         
         # Cross section #
         xsec = None
-        if xsec_dict is not None and sample_name in xsec_dict[era].keys():
-            xsec = xsec_dict[era][sample_name]
+        if xsec_dict is not None and sample_name in xsec_dict[smp_era].keys():
+            xsec = xsec_dict[smp_era][sample_name]
         
         # Event weight sum #
         event_weight_sum = None
-        if event_weight_sum_dict is not None and sample_name in event_weight_sum_dict[era].keys():
-            event_weight_sum = event_weight_sum_dict[era][sample_name]
+        if event_weight_sum_dict is not None and sample_name in event_weight_sum_dict[smp_era].keys():
+            event_weight_sum = event_weight_sum_dict[smp_era][sample_name]
         
         # Start #
         ni = None
@@ -196,7 +237,7 @@ def LoopOverTrees(input_dir, variables, list_sample=None, weight=None, cut=None,
             # Get the data as pandas df #
             df = Tree2Pandas(input_file                 = sample,
                              variables                  = variables,
-                             era                        = era,
+                             era                        = smp_era,
                              weight                     = weight,
                              cut                        = cut,
                              xsec                       = xsec,
@@ -206,7 +247,8 @@ def LoopOverTrees(input_dir, variables, list_sample=None, weight=None, cut=None,
                              t                          = key_,
                              paramFun                   = paramFun,
                              start                      = ni,
-                             stop                       = nf)
+                             stop                       = nf,
+                             file_pool                  = file_pool)
             if df is None:
                 continue
             
@@ -0,0 +1,119 @@
+import os
+import time
+import logging
+import numpy as np
+
+import parameters
+
+
+class InferenceEngine:
+    """
+    Evaluates a trained model, loaded once, on large batches of parameters.output_batch_size events on the CPU
+    backend : 'keras' : tensorflow with n_threads threads (0 : all cores)
+              'onnx'  : the model is exported once to ONNX with tf2onnx (next to the model zip) and run with onnxruntime
+    The inputs are float32 arrays (N, number of inputs) with the columns ordered as parameters.inputs
+    The number of evaluations and the time spent are kept to report the events/sec
+    """
+    def __init__(self, model, backend=None, batch_size=None, n_threads=None, onnx_path=None):
+        self.name       = model
+        self.backend    = backend if backend is not None else parameters.inference_backend
+        self.batch_size = batch_size if batch_size is not None else parameters.output_batch_size
+        self.n_threads  = n_threads if n_threads is not None else parameters.inference_threads
+        self.onnx_path  = onnx_path if onnx_path is not None else os.path.join(parameters.path_model, model+'.onnx')
+        self.n_events   = 0
+        self.time       = 0.
+        if self.backend == 'keras':
+            self.model = self._loadKeras()
+        elif self.backend == 'onnx':
+            if not os.path.exists(self.onnx_path):
+                self.ExportONNX(self._loadKeras(), self.onnx_path)
+            self._loadONNX()
+        else:
+            raise RuntimeError(f'Inference backend {self.backend} not supported, available options : [keras, onnx]')
+
+    def _loadKeras(self):
+        import tensorflow as tf
+        n_threads = self.n_threads or os.cpu_count()
+        try:
+            tf.config.threading.set_intra_op_parallelism_threads(n_threads)
+            tf.config.threading.set_inter_op_parallelism_threads(2)
+        except RuntimeError: # tensorflow already initialized, keeps its settings
+            logging.warning('Could not set the number of tensorflow threads (already initialized)')
+        from NeuralNet import HyperModel
+        return HyperModel(self.name).HyperLoad()
+
+    @staticmethod
+    def ExportONNX(model, path):
+        """ Export the keras model to ONNX in path """
+        try:
+            import tf2onnx
+        except ImportError:
+            raise ImportError('The onnx backend needs tf2onnx to export the model : pip install tf2onnx onnxruntime')
+        tf2onnx.convert.from_keras(model, output_path=path)
+        logging.info('Model exported to %s'%path)
+
+    def _loadONNX(self):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError('The onnx backend needs onnxruntime : pip install onnxruntime')
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = self.n_threads or 0 # 0 : onnxruntime default, all cores
+        self.session     = onnxruntime.InferenceSession(self.onnx_path, sess_options=options, providers=['CPUExecutionProvider'])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        logging.info('Using ONNX model %s'%self.onnx_path)
+
+    def _predictBatch(self, x):
+        # The model has one input per variable #
+        if self.backend == 'onnx':
+            return self.session.run(None, {name: np.ascontiguousarray(x[:,i:i+1]) for i,name in enumerate(self.input_names)})[0]
+        return np.asarray(self.model.predict_on_batch(np.hsplit(x,x.shape[1])))
+
+    def _count(self, n, t):
+        self.n_events += n
+        self.time     += t
+
+    @property
+    def rate(self):
+        """ Evaluations per second so far """
+        return self.n_events/self.time if self.time > 0 else 0.
+
+    def report(self):
+        logging.info('Inference (%s) of %s : %d evaluations in %0.1fs -> %0.0f events/sec'%(self.backend,self.name,self.n_events,self.time,self.rate))
+
+    def predict(self, x):
+        """ Outputs (N, number of outputs) of the model for the events x (N, number of inputs) """
+        x   = np.asarray(x,dtype=np.float32)
+        out = None
+        for start in range(0, x.shape[0], self.batch_size):
+            t0 = time.time()
+            y  = self._predictBatch(x[start:start+self.batch_size])
+            if out is None:
+                out = np.empty((x.shape[0],y.shape[1]),dtype=np.float32)
+            out[start:start+y.shape[0]] = y
+            self._count(y.shape[0],time.time()-t0)
+        return out if out is not None else np.zeros((0,len(parameters.outputs)),dtype=np.float32)
+
+    def iterGrid(self, x, masses, mass_inputs):
+        """
+        Evaluate the parametric model for each event of x at each mass point, without building the full grid
+        masses      : array (M, 2) of the mass points (mH, mA)
+        mass_inputs : indices of the mH and mA columns in the inputs
+        Each batch holds batch_size//M events at all the mass points
+        yields (start, stop, outputs) with outputs (stop-start, M, number of outputs) for the events [start,stop)
+        """
+        x      = np.asarray(x,dtype=np.float32)
+        masses = np.asarray(masses,dtype=np.float32)
+        M      = masses.shape[0]
+        chunk  = max(self.batch_size//M,1)
+        for start in range(0, x.shape[0], chunk):
+            t0     = time.time()
+            events = x[start:start+chunk]
+            n      = events.shape[0]
+            grid   = np.repeat(events,M,axis=0) # row k = event k//M at the mass point k%M
+            grid[:,mass_inputs[0]] = np.tile(masses[:,0],n)
+            grid[:,mass_inputs[1]] = np.tile(masses[:,1],n)
+            y = self._predictBatch(grid)
+            self._count(n*M,time.time()-t0)
+            yield start, start+n, y.reshape(n,M,-1)
+        self.report()
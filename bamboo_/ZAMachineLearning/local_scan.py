@@ -0,0 +1,144 @@
+import os
+import sys
+import glob
+import time
+import shutil
+import logging
+import traceback
+import multiprocessing
+
+import numpy as np
+from sklearn.model_selection import train_test_split
+
+import parameters
+from split_training import DictSplit
+
+# Same directory as the outputs of the slurm jobs, so that ConcatenateCSV and --report work the same way #
+def OutputDir():
+    return os.path.join(parameters.path_out,'slurm','output')
+
+def ArraysDir():
+    return os.path.join(parameters.path_out,'local_scan')
+
+ARRAYS = ['x_train','y_train','x_val','y_val']
+
+def SaveArrays(data, list_outputs):
+    """
+    Split the training DF once (same way as HyperModel.HyperScan) and save the arrays as .npy
+    The workers memory-map them : the data is read-only and shared between all of them through the page cache
+    """
+    x = data[[param.replace('$','') for param in parameters.inputs]].values
+    y = data[list_outputs+['learning_weight']].values
+    size = parameters.training_ratio/(parameters.training_ratio+parameters.evaluation_ratio)
+    x_train, x_val, y_train, y_val = train_test_split(x,y,train_size=size)
+    if not os.path.isdir(ArraysDir()):
+        os.makedirs(ArraysDir())
+    for name,arr in zip(ARRAYS,[x_train,y_train,x_val,y_val]):
+        np.save(os.path.join(ArraysDir(),name+'.npy'),np.ascontiguousarray(arr))
+    logging.info("Training set   : %d"%x_train.shape[0])
+    logging.info("Evaluation set : %d"%x_val.shape[0])
+
+def IsDone(name, task):
+    """ A permutation is done when the job produced both its csv and its zip """
+    name_model = name+'_'+task.replace('.pkl','')
+    return all(os.path.exists(os.path.join(OutputDir(),name_model+ext)) for ext in ['.csv','.zip'])
+
+# Worker state, set once per process by _initWorker #
+_worker = {}
+
+def _initWorker(n_threads, best, generator):
+    # Thread limits before tensorflow starts its runtime #
+    for var in ['OMP_NUM_THREADS','TF_NUM_INTRAOP_THREADS']:
+        os.environ[var] = str(n_threads)
+    os.environ['TF_NUM_INTEROP_THREADS'] = '1'
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(n_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    _worker['best']   = best
+    _worker['arrays'] = None if generator else tuple(np.load(os.path.join(ArraysDir(),name+'.npy'),mmap_mode='r') for name in ARRAYS)
+
+def _runTask(args):
+    """ Scan of one permutation (split dict), same as a slurm job : return (task, success, val_loss, pruned, error) """
+    name, task, list_inputs, list_outputs, generator = args
+    import Model
+    from NeuralNet import HyperModel
+    prune = None
+    if parameters.prune_warmup is not None:
+        prune = Model.PruneScan(_worker['best'],parameters.prune_threshold,parameters.prune_warmup)
+        Model.extra_callbacks = [prune]
+    try:
+        # the jobs write their csv and zip in the working directory #
+        os.chdir(OutputDir())
+        name_model = name+'_'+task.replace('.pkl','')
+        if os.path.isdir(name_model): # left over by a job that was killed
+            shutil.rmtree(name_model)
+        instance = HyperModel(name,list_inputs,list_outputs)
+        instance.HyperScan(data      = None,
+                           task      = task,
+                           model_idx = None,
+                           generator = generator,
+                           arrays    = _worker['arrays'])
+        instance.HyperDeploy(best='eval_error')
+        val_loss = instance.h.data['val_loss'].astype(float).min()
+        with _worker['best'].get_lock():
+            _worker['best'].value = min(_worker['best'].value,val_loss)
+        return task, True, val_loss, prune is not None and prune.pruned, ''
+    except Exception as e:
+        traceback.print_exc()
+        return task, False, None, False, '%s : %s'%(e.__class__.__name__,str(e))
+
+def LocalScan(name, data, list_inputs, list_outputs, n_jobs, generator=False, resume=True):
+    """
+    Runs the scan on a pool of n_jobs local processes instead of slurm jobs, one permutation of parameters.p per task
+        - the permutations are split with DictSplit as for the slurm submission (path_out/split/dict_<i>.pkl)
+        - the training data is split once and memory-mapped read-only by all the workers
+        - each worker uses parameters.local_threads tensorflow threads (0 : cores shared equally)
+        - each permutation writes its csv and zip in path_out/slurm/output as soon as it is done,
+          the merged csv (path_out/model/<name>.csv, see ConcatenateCSV) is updated after each of them
+        - resume : the permutations already done are skipped, the failed ones are run again
+        - pruning : a permutation worse than the best of the scan is stopped early (parameters.prune_*)
+    return : list of the tasks that failed
+    """
+    from concatenate_csv import ConcatenateCSV
+    logging.info(' Starting local scan '.center(80,'-'))
+    if not os.path.isdir(OutputDir()):
+        os.makedirs(OutputDir())
+
+    # One permutation per task #
+    DictSplit(1,name)
+    tasks = sorted((os.path.basename(f) for f in glob.glob(os.path.join(parameters.path_out,'split','*.pkl'))),
+                   key = lambda t : int(t.replace('dict_','').replace('.pkl','')))
+    todo  = [t for t in tasks if not (resume and IsDone(name,t))]
+    logging.info('%d permutations, %d already done, %d to run on %d workers'%(len(tasks),len(tasks)-len(todo),len(todo),n_jobs))
+    if len(todo) == 0:
+        return []
+
+    if not generator:
+        SaveArrays(data,list_outputs)
+    n_threads = parameters.local_threads or max(os.cpu_count()//n_jobs,1)
+    logging.info('Each worker uses %d threads'%n_threads)
+
+    # fresh interpreters rather than forks of a process where tensorflow is already loaded #
+    ctx  = multiprocessing.get_context('spawn')
+    best = ctx.Value('d',np.inf)
+    failed   = []
+    finished = 0
+    start    = time.time()
+    with ctx.Pool(processes=n_jobs, initializer=_initWorker, initargs=(n_threads,best,generator)) as pool:
+        for task, success, val_loss, pruned, error in pool.imap_unordered(_runTask,[(name,t,list_inputs,list_outputs,generator) for t in todo]):
+            finished += 1
+            if success:
+                logging.info('[%d/%d] %s done : val_loss = %0.5f%s (best = %0.5f)'%(finished,len(todo),task,val_loss,' [pruned]' if pruned else '',best.value))
+                try:
+                    ConcatenateCSV(parameters.path_out)
+                except Exception as e:
+                    logging.warning('Could not update the merged csv : %s'%e)
+            else:
+                failed.append(task)
+                logging.error('[%d/%d] %s failed : %s'%(finished,len(todo),task,error))
+            sys.stdout.flush()
+
+    logging.info('Local scan done in %0.0fs'%(time.time()-start))
+    if len(failed) > 0:
+        logging.error('%d permutations failed, run again to retry only those : %s'%(len(failed),', '.join(failed)))
+    return failed
@@ -2,6 +2,7 @@ import os
 import logging
 import pickle
 import glob
+import multiprocessing
 import enlighten
 import numpy as np
 import pandas as pd
@@ -13,8 +14,108 @@ from root_numpy import tree2array, rec2array
 
 import parameters
 
-def MakeScaler(data=None, list_inputs=[], TTree=[], generator=False, batch=5000, list_samples=None, additional_columns={}):
-    
+def ChunkMoments(x, w=None):
+    """
+    Moments of each column of x (N,n) : (sum of weights, mean, sum of the squared deviations to the mean)
+    w : event weights (None : all events count as 1)
+    """
+    x = np.asarray(x,dtype=np.float64)
+    if x.shape[0] == 0:
+        return 0., np.zeros(x.shape[1]), np.zeros(x.shape[1])
+    if w is None:
+        n    = float(x.shape[0])
+        mean = x.mean(axis=0)
+        M2   = np.square(x-mean).sum(axis=0)
+    else:
+        w    = np.asarray(w,dtype=np.float64)
+        n    = w.sum()
+        if n == 0.:
+            return 0., np.zeros(x.shape[1]), np.zeros(x.shape[1])
+        mean = (w[:,np.newaxis]*x).sum(axis=0)/n
+        M2   = (w[:,np.newaxis]*np.square(x-mean)).sum(axis=0)
+    return n, mean, M2
+
+def MergeMoments(a, b):
+    """ Merge the moments of two sets of events (Chan et al. parallel algorithm), numerically stable """
+    na, mean_a, M2_a = a
+    nb, mean_b, M2_b = b
+    n = na+nb
+    if n == 0.:
+        return a
+    delta = mean_b-mean_a
+    return n, mean_a+delta*nb/n, M2_a+M2_b+np.square(delta)*na*nb/n
+
+def FileMoments(task):
+    """ Moments of the inputs over all the TTrees of one file, read by chunks of batch events (one pool task) """
+    f, list_inputs, TTree, batch, weight, additional_columns = task
+    columns = [inp.replace('$','') for inp in list_inputs]
+    moments = (0., np.zeros(len(columns)), np.zeros(len(columns)))
+    if not os.path.exists(f):
+        return moments
+    file_handle = TFile.Open(f)
+    for key in TTree:
+        ttree = file_handle.Get(key)
+        if not ttree:
+            logging.debug(f"Could not find {key} TTree in sample: {f}")
+            continue
+        N = ttree.GetEntries()
+        logging.debug("Opening file %s (%d entries)"%(f,N))
+        # Loop over batches #
+        for i in range(0, N, batch):
+            df = Tree2Pandas(f, 
+                             variables           = list_inputs, 
+                             era                 = None,
+                             weight              = weight, 
+                             cut                 = None, 
+                             xsec                = None, 
+                             event_weight_sum    = None, 
+                             luminosity          = None, 
+                             paramFun            = None, 
+                             tree_name           = parameters.tree_name, 
+                             t                   = key, 
+                             start               = i, 
+                             stop                = i+batch, 
+                             additional_columns  = additional_columns)
+            if df is None:
+                continue
+            moments = MergeMoments(moments,ChunkMoments(df[columns].values,df[weight].values if weight is not None else None))
+    file_handle.Close()
+    return moments
+
+def EraScalerPath(era):
+    """ Path of the scaler of one era, next to parameters.scaler_path """
+    return parameters.scaler_path.replace('.pkl',f'_{era}.pkl')
+
+def _setScaler(scaler, moments):
+    """ Fill the StandardScaler attributes from the merged moments, as StandardScaler.fit would """
+    n, mean, M2 = moments
+    scaler.n_samples_seen_ = n
+    scaler.n_features_in_  = mean.shape[0]
+    scaler.mean_           = mean
+    scaler.scale_          = np.sqrt(M2/n) if n > 0 else np.ones(mean.shape[0])
+    return scaler
+
+def _safeScaler(scaler):
+    # Disable preprocess on onehot variables #
+    scaler.mean_[parameters.mask_op]  = 0.
+    scaler.scale_[parameters.mask_op] = 1.
+
+    # Safe checks #
+    scaler.mean_[np.isnan(scaler.mean_)]   = 0.
+    scaler.scale_[np.isnan(scaler.scale_)] = 1.
+    scaler.scale_[scaler.scale_ == 0.]     = 1.
+    scaler.var_ =  scaler.scale_**2
+    return scaler
+
+def MakeScaler(data=None, list_inputs=[], TTree=[], generator=False, batch=5000, list_samples=None, additional_columns={}, weight=None, eras=None, n_jobs=None):
+    """
+    Compute the StandardScaler of the inputs and save it in parameters.scaler_path (imported if it already exists)
+    data     : DF of the events (not generator)
+    generator: compute it from the files of list_samples in one pass, the files are read in parallel on n_jobs
+               processes (None : all cores) by chunks of batch events and their moments merged
+    weight   : branch of the event weights (generator only, None : unweighted)
+    eras     : era of each sample of list_samples, to save also one scaler per era (see EraScalerPath)
+    """
     # Generate scaler #
     logging.info('Starting computation for the scaler')
     scaler      = preprocessing.StandardScaler()
@@ -27,64 +128,33 @@ def MakeScaler(data=None, list_inputs=[], TTree=[], generator=False, batch=5000,
         if generator:
             if list_samples is None:
                 raise RuntimeError("Generator mask asked, you need to provide a sample list")
+            if eras is not None and len(eras) != len(list_samples):
+                raise RuntimeError("Eras list does not match the list samples")
             
             logging.info("Computing mean and std")
-            mean = np.zeros(len(list_inputs))
-            std  = np.zeros(len(list_inputs))
-            Ntot = 0
-            pbar_mean = enlighten.Counter(total=len(list_samples), desc='Mean', unit='File')
-            pbar_std  = enlighten.Counter(total=len(list_samples), desc='Std', unit='File')
-            for f in list_samples:
-                pbar_mean.update()
-                pbar_std.update()
-                if not os.path.exists(f):
-                    continue
-                file_handle = TFile.Open(f)
-                for key in TTree:
-                    ttree = file_handle.Get(key)
-                    if not ttree:
-                        logging.debug(f"Could not find {key} TTree in sample: {f}")
-                        continue
-                    tree = ttree.Get(parameters.tree_name)
-                    N = tree.GetEntries()
-                    Ntot += N
-                    logging.debug("Opening file %s (%d entries)"%(f,N))
-                    # Loop over batches #
-                    for i in range(0, N, batch):
-                        array = Tree2Pandas(ttree, 
-                                            variables = list_inputs, 
-                                            era                 = None,
-                                            weight              = None, 
-                                            cut                 = None, 
-                                            xsec                = None, 
-                                            event_weight_sum    = None, 
-                                            luminosity          = None, 
-                                            paramFun            = None, 
-                                            tree_name           = parameters.tree_name, 
-                                            t                   = key, 
-                                            start               = i, 
-                                            stop                = i+batch, 
-                                            additional_columns  = additional_columns)[[inp.replace('$','') for inp in list_inputs]].astype(np.float32).values
-                        mean += np.sum(array,axis=0)
-                        std  += np.sum(np.square(array-mean),axis=0)
-                file_handle.Close()
-            
-            mean /= Ntot
-            std = np.sqrt(std/Ntot)
+            tasks   = [(f, list_inputs, TTree, batch, weight, additional_columns) for f in list_samples]
+            moments = (0., np.zeros(len(list_inputs)), np.zeros(len(list_inputs)))
+            era_moments = {}
+            pbar = enlighten.Counter(total=len(list_samples), desc='Mean and std', unit='File')
+            with multiprocessing.Pool(processes=n_jobs) as pool:
+                for i, file_moments in enumerate(pool.imap(FileMoments, tasks)): # in order, the merge does not depend on the number of processes
+                    pbar.update()
+                    moments = MergeMoments(moments,file_moments)
+                    if eras is not None:
+                        era = eras[i]
+                        era_moments[era] = file_moments if era not in era_moments else MergeMoments(era_moments[era],file_moments)
             
             # Set manually #
-            scaler.mean_ = mean
-            scaler.scale_ = std
+            _setScaler(scaler,moments)
 
-        # Disable preprocess on onehot variables #
-        scaler.mean_[parameters.mask_op]  = 0.
-        scaler.scale_[parameters.mask_op] = 1.
+            # One scaler per era #
+            for era, m in era_moments.items():
+                era_scaler = _safeScaler(_setScaler(preprocessing.StandardScaler(),m))
+                with open(EraScalerPath(era), 'wb') as handle:
+                    pickle.dump(era_scaler, handle)
+                logging.info(f'{EraScalerPath(era)} has been created')
 
-        # Safe checks #
-        scaler.mean_[np.isnan(scaler.mean_)]   = 0.
-        scaler.scale_[np.isnan(scaler.scale_)] = 1.
-        scaler.scale_[scaler.scale_ == 0.]     = 1.
-        scaler.var_ =  scaler.scale_**2
+        _safeScaler(scaler)
 
         # Save #
         with open(parameters.scaler_path, 'wb') as handle:
@@ -7,10 +7,20 @@ import copy
 
 import pandas as pd
 import numpy as np
+import tensorflow as tf
 
 import parameters
 
+def GetMasses():
+    """ Mass points (mH, mA) of the HToZA weights in the inputs """
+    list_signal = [s for s in parameters.inputs if s.find('HToZA')!=-1] # Only take the HtoZA weights (not background)
+    return np.asarray([(float(re.findall(r'\d+',s)[1]),float(re.findall(r'\d+',s)[2])) for s in list_signal]) # mAmH
+
 def ParametrizeClassifier(data,name):
+    """
+    Signal events get the weight of their generated mass point, the background is repeated at each mass point
+    (one copy of the background per mass point, see LazyParametrization to avoid it)
+    """
     logging.info('Starting the parameterization of the classifier')
     # Add new column : parametric weight HToZA #
     new_col = pd.DataFrame(np.zeros(data.shape[0]),index=data.index,columns=[name])
@@ -23,8 +33,7 @@ def ParametrizeClassifier(data,name):
     data_back = data[idx_back]
    
     # Get the masses #
-    list_signal = [s for s in parameters.inputs if s.find('HToZA')!=-1] # Only take the HtoZA weights (not background)
-    masses = np.asarray([(float(re.findall(r'\d+',s)[1]),float(re.findall(r'\d+',s)[2])) for s in list_signal]) # mAmH
+    masses = GetMasses()
 
     # Signal case #
     logging.info('\tParameterizing the signal')
@@ -55,3 +64,73 @@ def ParametrizeClassifier(data,name):
     data = pd.concat((new_sig_data,new_back_data),axis=0).reset_index(drop=True)
 
     return data
+
+
+class LazyParametrization(tf.keras.utils.Sequence):
+    """
+    Batches of the parameterized classifier without building the cross product of ParametrizeClassifier
+    At each epoch, every background event gets one mass point drawn at random (the signal keeps its generated one)
+    and the batches are gathered by index from the original DF.
+    ParametrizeClassifier presents a background event at all the M mass points with learning_weight/M, here it is
+    presented once per epoch with its learning_weight at a mass point drawn with probability 1/M : the expected
+    weight of each (event, mass point) pair is the same, and over the epochs the background sees all the mass points.
+    Used by NeuralNetModel when parameters.parametrize is set (see HyperModel.HyperScan)
+    shuffle : new order and mass points at each epoch (False for the validation set, drawn once)
+    """
+    def __init__(self,data,name,batch_size,inputs=None,outputs=None,shuffle=True,seed=None):
+        self.data       = data
+        self.name       = name
+        self.batch_size = batch_size
+        self.inputs     = [inp.replace('$','') for inp in (parameters.inputs if inputs is None else inputs)]
+        self.outputs    = parameters.outputs if outputs is None else outputs
+        self.shuffle    = shuffle
+        self.rng        = np.random.default_rng(seed)
+        self.masses     = GetMasses()
+
+        # Weights of each event at all the mass points (N, M) #
+        self.weights    = data[[(name.replace('HToZA','HToZA_mH_%d_mA_%d'))%(mH,mA) for mH,mA in self.masses]].to_numpy()
+
+        # Split in signal and background samples #
+        idx_sig         = (data['tag']=='HToZA').to_numpy()
+        self.idx_sig    = np.where(idx_sig)[0]
+        self.idx_back   = np.where(np.invert(idx_sig))[0]
+        lookup          = {(mH,mA):i for i,(mH,mA) in enumerate(self.masses)}
+        gen_masses      = data[['mH_gen','mA_gen']].to_numpy()[self.idx_sig]
+        try:
+            self.mass_sig = np.asarray([lookup[(mH,mA)] for mH,mA in gen_masses],dtype=np.int64)
+        except KeyError as e:
+            raise RuntimeError(f'Signal mass point {e} not in the HToZA weights of the inputs')
+        self._draw()
+
+    def _draw(self):
+        """ New order of the events and new mass points for the background """
+        N = self.data.shape[0]
+        self.mass_idx = np.empty(N,dtype=np.int64)
+        self.mass_idx[self.idx_sig]  = self.mass_sig
+        self.mass_idx[self.idx_back] = self.rng.integers(self.masses.shape[0],size=self.idx_back.shape[0])
+        self.order    = self.rng.permutation(N)
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self._draw()
+
+    def __len__(self):
+        return int(np.ceil(self.data.shape[0]/self.batch_size))
+
+    def batch(self,index):
+        """ DF of the events of the batch with their mass point (mH_gen, mA_gen) and its weight in the name column """
+        rows  = self.order[index*self.batch_size:(index+1)*self.batch_size]
+        m     = self.mass_idx[rows]
+        batch = self.data.iloc[rows].reset_index(drop=True)
+        batch['mH_gen']  = self.masses[m,0]
+        batch['mA_gen']  = self.masses[m,1]
+        batch[self.name] = self.weights[rows,m]
+        return batch
+
+    def __getitem__(self,index):
+        """ (inputs, targets, weights) of the batch, inputs split per column as in NeuralNetModel """
+        batch = self.batch(index)
+        x = batch[self.inputs].values.astype(np.float32)
+        y = batch[self.outputs].values.astype(np.float32)
+        w = batch['learning_weight'].values.astype(np.float32)
+        return np.hsplit(x,x.shape[1]),y,w
@@ -96,6 +96,13 @@ else:
     time      = '2-59:00:00'  # days-hh:mm:ss
     mem       = '9000'        # ram in MB
     tasks     = '1'           # Number of threads(as a string) (not parallel training for classic mode)
+
+#==============================================
+# Local scan (--local N, see local_scan.py) #
+#==============================================
+local_threads   = 0     # tensorflow threads per worker (0 : cores shared equally between the workers)
+prune_threshold = 0.2   # a permutation is stopped if its val_loss is worse than the best of the scan by this fraction ...
+prune_warmup    = 10    # ... after this number of epochs (None : no pruning)
     
 ######################################  Names  ########################################
                         # Model name important only for scans 
@@ -104,6 +111,11 @@ else:
 model  = 'NeuralNetModel'           # Classic mode
 #model = 'NeuralNetGeneratorModel'  # Generator mode
 
+# Parameterized classifier (classic mode) : name of the signal weight, the weight of each mass point is the column
+# name.replace('HToZA','HToZA_mH_%d_mA_%d'), mH_gen and mA_gen must be in the inputs.
+# The background gets one mass point drawn per epoch (see parameterize_classifier.LazyParametrization)
+parametrize = None
+
 # scaler and mask names #
 suffix = 'ZA_catagories' 
 
@@ -114,6 +126,14 @@ path_mask   = path_out  #mask_name -> 'mask_{suffix}_{node}.npy'
 train_cache = os.path.join(path_out,f'train_cache_{suffix}_run2Ulegacy.pkl')
 test_cache  = os.path.join(path_out,f'test_cache_{suffix}_run2Ulegacy.pkl')
 
+# Generator : number of batches read in advance (0 : read when requested) #
+generator_prefetch = 2
+
+# Compiled dataset : weighted, shuffled and split events in memory-mappable shards (see shards.py) #
+shards_path      = os.path.join(path_out,f'shards_{suffix}_run2Ulegacy')
+shard_size       = 500000   # events per shard
+generator_shards = False    # generator reads the batches from the compiled dataset instead of the ROOT files
+
 # Meta config info #
 xsec_json = os.path.join("{json_path}",'data/ulegacy{era}_xsec.json')
 event_weight_sum_json = os.path.join("{json_path}",'data/ulegacy{era}_event_weight_sum.json')
@@ -123,7 +143,12 @@ resume_model = ''
 
 # Output #
 output_batch_size = 512
+inference_backend = 'keras' # 'keras' or 'onnx' (model exported once with tf2onnx and run with onnxruntime on CPU)
+inference_threads = 0       # CPU threads for the inference (0 : all cores)
 split_name = 'tag' # 'sample' or 'tag' : criterion for output file splitting
+output_chunk_size = 100000   # entries converted and written at a time in the output files
+output_threads    = 4        # output files written concurrently
+output_mode       = 'branches' # 'branches' : outputs next to the inputs, 'friend' : outputs in <name>_friend.root
 
 ##############################  Evaluation criterion   ################################
 #######################################################################################
@@ -4,23 +4,104 @@ import sys
 import logging
 import numpy as np
 import pandas as pd
+import ROOT
+from concurrent.futures import ThreadPoolExecutor
 from root_numpy import array2root
 
 import parameters
-from NeuralNet import HyperModel
+from inference import InferenceEngine
 from import_tree import Tree2Pandas
 from generate_mask import GenerateSliceIndices, GenerateSliceMask
 from data_generator import DataGenerator
 
 
+class RootWriter:
+    """
+    Writes DF in ROOT files chunk by chunk : parameters.output_chunk_size entries are converted and appended
+    to the tree at a time, so the memory used does not grow with the size of the sample,
+    and different files are written concurrently on parameters.output_threads threads
+    mode (parameters.output_mode) :
+        'branches' : the outputs are written as branches next to the other columns
+        'friend'   : the outputs are written in <name>_friend.root, with the same entries as <name>.root
+                     (tree.AddFriend('tree','<name>_friend.root'))
+    """
+    def __init__(self,chunk_size=None,mode=None,n_threads=None):
+        self.chunk_size = chunk_size if chunk_size is not None else parameters.output_chunk_size
+        self.mode       = mode if mode is not None else parameters.output_mode
+        if self.mode not in ['branches','friend']:
+            raise RuntimeError(f"Output mode *{self.mode}* not supported, available options :[branches, friend]")
+        self.n_threads  = n_threads if n_threads is not None else parameters.output_threads
+        self.pool       = None
+        self.futures    = []
+
+    @staticmethod
+    def friendPath(path):
+        return path.replace('.root','_friend.root')
+
+    @staticmethod
+    def _records(df):
+        # From df to numpy array with dtype #
+        arr = df.to_records(index=False,column_dtypes='float64')
+        arr.dtype.names = parameters.make_dtype(arr.dtype.names) # because ( ) and . are an issue for root_numpy
+        return arr
+
+    def writeChunk(self,path,data,output_df=None,first=False):
+        """ Append the entries of data (and output_df) to the tree of path, the file is recreated if first """
+        mode = 'recreate' if first else 'update' # update appends the entries to the existing tree
+        if output_df is not None and self.mode == 'friend':
+            array2root(self._records(data),path,mode=mode)
+            array2root(self._records(output_df),self.friendPath(path),mode=mode)
+        else:
+            if output_df is not None:
+                data = pd.concat([data,output_df],axis=1)
+            array2root(self._records(data),path,mode=mode)
+
+    def _write(self,path,data,output_df):
+        for start in range(0,max(data.shape[0],1),self.chunk_size):
+            self.writeChunk(path,
+                            data.iloc[start:start+self.chunk_size],
+                            output_df.iloc[start:start+self.chunk_size] if output_df is not None else None,
+                            first = start==0)
+        logging.info('Output saved as : '+path)
+
+    def submit(self,path,data,output_df=None):
+        """ Write data (and output_df, same index) in path on the thread pool """
+        if self.pool is None:
+            ROOT.EnableThreadSafety()
+            self.pool = ThreadPoolExecutor(max_workers=self.n_threads)
+        self.futures.append(self.pool.submit(self._write,path,data,output_df))
+
+    def wait(self):
+        """ Wait for all the files to be written, raise the first error """
+        futures, self.futures = self.futures, []
+        try:
+            for future in futures:
+                future.result()
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+
 class ProduceOutput:
-    def __init__(self,model,generator=False,list_inputs=None):
+    def __init__(self,model,generator=False,list_inputs=None,backend=None):
         self.model       = model            # name of the best model you get 
         self.list_inputs = list_inputs
         self.generator   = generator
+        self.backend     = backend          # inference backend (None : parameters.inference_backend)
+        self.engines     = {}               # models loaded once
         if self.list_inputs is None:
             self.list_inputs = copy.deepcopy(parameters.inputs) 
 
+    def Engine(self,model):
+        """ InferenceEngine of the model, loaded on first use """
+        if model not in self.engines:
+            self.engines[model] = InferenceEngine(model,backend=self.backend)
+        return self.engines[model]
+
+    def Predict(self,model,inputs):
+        """ Outputs of the model for the inputs DF """
+        return self.Engine(model).predict(inputs[[param.replace('$','') for param in parameters.inputs]].values)
+
     def OutputFromTraining(self,data,path_output,output_name=None,crossval_use_training=False):
         """
             Get the output of the model from the test set
@@ -31,14 +112,12 @@ class ProduceOutput:
         if not self.generator:
             inputs = data[self.list_inputs]
             if len(self.model) == 1: # classic training
-                instance  = HyperModel(self.model[0])
-                output    = instance.HyperRestore(inputs,verbose=1)
+                output    = self.Predict(self.model[0],inputs)
                 output_df = pd.DataFrame(output,columns=[('output_%s'%o).replace('$','') for o in parameters.outputs],index=data.index)
             else:   # cross validation
                 output_df = pd.DataFrame(np.zeros((data.shape[0],len(parameters.outputs))),columns=[('output_%s'%o).replace('$','') for o in parameters.outputs],index=data.index)
                 used_train_idx = [] # for train output
                 for model_idx,model in enumerate(self.model):
-                    instance = HyperModel(model)
                     apply_idx,eval_idx,train_idx = GenerateSliceIndices(model_idx)
                     if crossval_use_training:
                         for i in range(model_idx,model_idx+len(train_idx)):
@@ -50,11 +129,10 @@ class ProduceOutput:
                         apply_mask = GenerateSliceMask(train_idx,data['mask']) 
                     else:
                         apply_mask = GenerateSliceMask(apply_idx,data['mask']) 
-                    model_out = instance.HyperRestore(inputs[apply_mask])
+                    model_out = self.Predict(model,inputs[apply_mask])
                     output_df[apply_mask] = model_out
             assert not (output_df.max(1)==0).any()
-            full_df = pd.concat([data,output_df],axis=1)
-            self.SaveToRoot(full_df,path_output,output_name)
+            self.SaveToRoot(data,path_output,output_name,output_df=output_df)
         else:
             if len(self.model) == 1: # classic training
                 output_generator = DataGenerator(path       = parameters.sampleList_full,
@@ -66,18 +144,15 @@ class ProduceOutput:
                                                  weight     = parameters.weight,
                                                  batch_size = parameters.output_batch_size,
                                                  state_set  = 'output')
-                instance = HyperModel(self.model[0])
                 for i in range(len(output_generator)):
                     data      = output_generator.__getitem__(i,True)
-                    output    = instance.HyperRestore(data[self.list_inputs])
+                    output    = self.Predict(self.model[0],data[self.list_inputs])
                     output_df = pd.DataFrame(output,columns=[('output_%s'%o).replace('$','') for o in parameters.outputs],index=data.index)
-                    full_df   = pd.concat([data,output_df],axis=1)
-                    self.SaveToRoot(full_df,path_output,output_name,out_idx='_slice%d'%i)
+                    self.SaveToRoot(data,path_output,output_name,out_idx='_slice%d'%i,output_df=output_df)
             else:   # cross validation
                 output=None
                 for model_idx,model in enumerate(self.model):
                     logging.info('Starting generator for model %d'%model_idx)
-                    instance = HyperModel(model)
                     output_generator = DataGenerator(path       = parameters.sampleList_full,
                                                      TTree      = parameters.TTree,
                                                      inputs     = parameters.inputs,
@@ -90,42 +165,57 @@ class ProduceOutput:
                                                      model_idx  = model_idx)
                     for i in range(len(output_generator)):
                         data      = output_generator.__getitem__(i,True)
-                        output    = instance.HyperRestore(data[self.list_inputs])
+                        output    = self.Predict(model,data[self.list_inputs])
                         output_df = pd.DataFrame(output,columns=[('output_%s'%o).replace('$','') for o in parameters.outputs],index=data.index)
-                        full_df   = pd.concat([data,output_df],axis=1)
-                        self.SaveToRoot(full_df,path_output,output_name,out_idx='_model%d_slice%d'%(model_idx,i))
+                        self.SaveToRoot(data,path_output,output_name,out_idx='_model%d_slice%d'%(model_idx,i),output_df=output_df)
+        for model in self.model:
+            self.Engine(model).report()
 
  
-    def SaveToRoot(self,df,path_output,output_name=None,out_idx=''):
+    def OutputGrid(self,data,masses,path_output,output_name,mass_names=('mH_gen','mA_gen')):
+        """
+            Output of the parametric model for each event of data at each mass point (mH, mA) of masses
+            The events are evaluated by batches at all the mass points and written chunk by chunk in output_name,
+            one entry per event with the columns of data and output_<node>_mH_<mH>_mA_<mA>
+            mass_names : inputs of the model replaced by the mass point (the ones of the parameterized classifier)
+        """
+        inputs      = [param.replace('$','') for param in parameters.inputs]
+        mass_inputs = [inputs.index(m) for m in mass_names]
+        nodes       = [('output_%s'%o).replace('$','') for o in parameters.outputs]
+        columns     = [f'{node}_mH_%d_mA_%d'%(mH,mA) for mH,mA in masses for node in nodes] # same order as the (M, nodes) outputs
+        data        = data.drop([c for c in ['tag','sample'] if c in data.columns],axis=1)
+        output_path = os.path.join(path_output,output_name)
+        writer      = RootWriter()
+        for start,stop,output in self.Engine(self.model[0]).iterGrid(data[inputs].values,masses,mass_inputs):
+            output_df = pd.DataFrame(output.reshape(stop-start,-1),columns=columns,index=data.index[start:stop])
+            writer.writeChunk(output_path,data.iloc[start:stop],output_df,first=start==0)
+        logging.info('Output saved as : '+output_path)
+
+    def SaveToRoot(self,df,path_output,output_name=None,out_idx='',output_df=None):
+        """
+            Write df (and the outputs output_df, same index) in ROOT files, one per sample (split_name) or in output_name
+            The files are written concurrently and chunk by chunk (see RootWriter)
+        """
+        writer = RootWriter()
         # Get the unique samples as a list #
         if output_name is None:
             sample_list = list(df[parameters.split_name].unique())
 
             # Loop over samples #
             for sample in sample_list:
-                sample_df = df.loc[df[parameters.split_name]==sample] # We select the rows corresponding to this sample
+                selection = df[parameters.split_name]==sample # We select the rows corresponding to this sample
 
                 # Remove tag and sample name (info in target as bool) #
-                sample_df = sample_df.drop('tag',axis=1)
-                sample_df = sample_df.drop('sample',axis=1)
-
-                # From df to numpy array with dtype #
-                sample_output = sample_df.to_records(index=False,column_dtypes='float64')
-                sample_output.dtype.names = parameters.make_dtype(sample_output.dtype.names)# because ( ) and . are an issue for root_numpy
+                sample_df = df.loc[selection].drop(['tag','sample'],axis=1,errors='ignore')
                 sample_output_name = os.path.join(path_output,sample+out_idx+'.root')
 
                 # Save as root file #
-                array2root(sample_output,sample_output_name,mode='recreate')
-                logging.info('Output saved as : '+sample_output_name)
+                writer.submit(sample_output_name,sample_df,output_df.loc[selection] if output_df is not None else None)
         else:
-            # From df to numpy array with dtype #
-            full_output = df.to_records(index=False,column_dtypes='float64')
-            full_output.dtype.names = parameters.make_dtype(full_output.dtype.names)# because ( ) and . are an issue for root_numpy
             full_output_name = os.path.join(path_output,output_name)
-            array2root(full_output,full_output_name,mode='recreate')
-            logging.info('Output saved as : '+full_output_name)
+            writer.submit(full_output_name,df,output_df)
+        writer.wait()
 
-         
     def OutputNewData(self,input_dir,list_sample,path_output,variables=None):
         """
             Given a model, produce the output 
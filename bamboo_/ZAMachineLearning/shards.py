@@ -0,0 +1,165 @@
+import os
+import json
+import shutil
+import logging
+import datetime
+
+import numpy as np
+import pandas as pd
+
+import parameters
+
+SPLITS = ['training', 'validation', 'evaluation', 'output']  # same names as the DataGenerator states
+
+
+def SourceFiles():
+    """ ROOT files the dataset is imported from (same loop as the tree importation in ZAMachineLearning.py) """
+    files = []
+    for node in parameters.nodes:
+        for era in parameters.eras:
+            for sample in parameters.samples_dict_run2UL[era][f"combined_{node}_nodes"]:
+                files.append(os.path.join(parameters.samples_path[era], sample))
+    return files
+
+
+def _stamp(path):
+    if not os.path.exists(path):
+        return None
+    st = os.stat(path)
+    return {'size': st.st_size, 'mtime': st.st_mtime}
+
+
+def SplitTrainingSet(train_all):
+    """
+    Split the (already shuffled) training DF the same way as the masks of the generator :
+        training + validation : training_ratio part, one event out of ten goes to the validation
+        evaluation            : evaluation_ratio part
+    """
+    size       = parameters.training_ratio/(parameters.training_ratio+parameters.evaluation_ratio)
+    n_train    = int(size*train_all.shape[0])
+    idx        = np.arange(n_train)
+    training   = train_all.iloc[:n_train]
+    return {'training'   : training.iloc[idx%10!=0],
+            'validation' : training.iloc[idx%10==0],
+            'evaluation' : train_all.iloc[n_train:]}
+
+
+def CompileDataset(path, splits, shard_size=None, sources=None):
+    """
+    Write the dataset in path, as shards of at most shard_size events :
+        <split>/<shard>/<column>.npy : one array per column, memory-mappable (np.load(..., mmap_mode='r'))
+        manifest.json                : columns and dtypes, number of events per shard and split, the source
+                                       files (size/mtime) and the parameters used to produce the dataset
+    splits  : dict split name -> DF (already weighted and shuffled)
+    sources : files the DF were produced from, recorded to detect a stale dataset
+    The dataset is written in a temporary directory first, it is never left half-written
+    """
+    shard_size = shard_size or parameters.shard_size
+    sources    = sources if sources is not None else SourceFiles()
+    tmp = path.rstrip('/') + '.tmp'
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+
+    manifest = {'created'    : datetime.datetime.now().isoformat(),
+                'shard_size' : shard_size,
+                'columns'    : {},
+                'splits'     : {},
+                'sources'    : {f: _stamp(f) for f in sources},
+                'parameters' : {'inputs': parameters.inputs, 'outputs': parameters.outputs, 'cut': parameters.cut,
+                                'weights': parameters.weights, 'suffix': parameters.suffix}}
+    for split, df in splits.items():
+        shards = []
+        for i, start in enumerate(range(0, max(df.shape[0], 1), shard_size)):
+            chunk = df.iloc[start:start+shard_size]
+            shard_dir = os.path.join(tmp, split, '%04d'%i)
+            os.makedirs(shard_dir)
+            for col in chunk.columns:
+                arr = chunk[col].to_numpy()
+                if arr.dtype == object: # strings (tag, era, ...) as fixed width to be memory-mappable
+                    arr = arr.astype(str)
+                np.save(os.path.join(shard_dir, f'{col}.npy'), np.ascontiguousarray(arr))
+                manifest['columns'].setdefault(col, arr.dtype.str)
+            shards.append(chunk.shape[0])
+        manifest['splits'][split] = shards
+        logging.info('... %-10s : %10d events in %d shards'%(split, df.shape[0], len(shards)))
+    with open(os.path.join(tmp, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.rename(tmp, path)
+    logging.info('Dataset compiled in %s'%path)
+
+
+class ShardDataset:
+    """
+    Read access to a dataset written by CompileDataset
+    The columns are memory-mapped : a slice inside a shard is a read-only view on the file (no copy),
+    only the pages actually read are loaded, and the mapped files are shared between processes
+    """
+    def __init__(self, path):
+        self.path = path
+        manifest_path = os.path.join(path, 'manifest.json')
+        if not os.path.exists(manifest_path):
+            raise RuntimeError(f'No compiled dataset in {path}, produce it with --compile')
+        with open(manifest_path) as f:
+            self.manifest = json.load(f)
+        self.columns = list(self.manifest['columns'].keys())
+        self._arrays = {}
+
+    def __getstate__(self):
+        # do not pickle the mapped arrays (would copy their content), they are mapped again when needed
+        state = self.__dict__.copy()
+        state['_arrays'] = {}
+        return state
+
+    def isUpToDate(self, sources=None):
+        """ Check that the source files did not change since the dataset was compiled """
+        sources = sources if sources is not None else SourceFiles()
+        return all(self.manifest['sources'].get(f) == _stamp(f) for f in sources)
+
+    def size(self, split):
+        return sum(self.manifest['splits'][split])
+
+    def _array(self, split, shard, col):
+        key = (split, shard, col)
+        if key not in self._arrays:
+            self._arrays[key] = np.load(os.path.join(self.path, split, '%04d'%shard, f'{col}.npy'), mmap_mode='r')
+        return self._arrays[key]
+
+    def slice(self, split, start, stop, columns=None):
+        """
+        Events [start,stop) of the split, as a dict column -> array
+        Views on the files when the slice lies inside a single shard, concatenated otherwise
+        """
+        columns = columns if columns is not None else self.columns
+        parts   = []
+        offset  = 0
+        for shard, n in enumerate(self.manifest['splits'][split]):
+            lo, hi = max(start-offset, 0), min(stop-offset, n)
+            if lo < hi:
+                parts.append((shard, lo, hi))
+            offset += n
+            if offset >= stop:
+                break
+        out = {}
+        for col in columns:
+            arrays = [self._array(split, shard, col)[lo:hi] for shard, lo, hi in parts]
+            if len(arrays) == 1:
+                out[col] = arrays[0]
+            elif len(arrays) == 0:
+                out[col] = np.zeros(0, dtype=np.dtype(self.manifest['columns'][col]))
+            else:
+                out[col] = np.concatenate(arrays)
+        return out
+
+    def dataframe(self, splits, columns=None):
+        """
+        DF of the splits (str or list), only the requested columns are read
+        The DF of a single split is built on the read-only mapped arrays, the ones of several splits are concatenated
+        """
+        if isinstance(splits, str):
+            splits = [splits]
+        dfs = [pd.DataFrame(self.slice(split, 0, self.size(split), columns), copy=False) for split in splits]
+        return pd.concat(dfs, ignore_index=True) if len(dfs) > 1 else dfs[0]
@@ -8,6 +8,17 @@ import copy
 
 import parameters
 
+def DecoupledMasses(list_dec,decimals=False):
+    """ Array (n,2) of the mH, mA of each column name of list_dec """
+    mHmA = np.empty((0,2))
+    for ol in list_dec:
+        if decimals:
+            arr = np.array([[float(re.findall(r"\d*\.\d+|\d+", ol)[0]),float(re.findall(r"\d*\.\d+|\d+", ol)[1])]])
+        else:
+            arr = np.array([[int(re.findall(r'_\d+', ol)[0].replace('_','')),int(re.findall(r'_\d+', ol)[1].replace('_',''))]])
+        mHmA = np.append(mHmA,arr,axis=0)
+    return mHmA
+
 def Decoupler(data,decoupled_name,list_to_decouple=None,decimals=False):
     """ 
     Data is a pandas dataFrame
@@ -24,13 +35,7 @@ def Decoupler(data,decoupled_name,list_to_decouple=None,decimals=False):
     # Get the arrays of mH, mA ordered as in the outputs
     list_rest = [i for i in data.columns if i not in list_dec] # All but outputs
     n_weights = len(list_dec)
-    mHmA = np.empty((0,2))
-    for ol in list_dec:
-        if decimals:
-            arr = np.array([[float(re.findall(r"\d*\.\d+|\d+", ol)[0]),float(re.findall(r"\d*\.\d+|\d+", ol)[1])]])
-        else:
-            arr = np.array([[int(re.findall(r'_\d+', ol)[0].replace('_','')),int(re.findall(r'_\d+', ol)[1].replace('_',''))]])
-        mHmA = np.append(mHmA,arr,axis=0)
+    mHmA = DecoupledMasses(list_dec,decimals)
     # Get the numpy arrays #
     decouple = data[list_dec].values
     repeat = data[list_rest].values
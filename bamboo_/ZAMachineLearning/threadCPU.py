@@ -0,0 +1,135 @@
+import os
+import csv
+import time
+import logging
+import traceback
+
+import psutil
+from time import sleep
+from threading import Thread
+
+def probeCPU(process):
+    """ Utilization of each core (%) since the last call """
+    per_core = psutil.cpu_percent(percpu=True)
+    record   = {'cpu_%d'%i:u for i,u in enumerate(per_core)}
+    record['cpu'] = sum(per_core)/max(len(per_core),1)
+    return record
+
+def _processes(process):
+    # main process and its children (keras workers, pools) #
+    try:
+        return [process]+process.children(recursive=True)
+    except psutil.Error:
+        return [process]
+
+def probeMemory(process):
+    """ Resident memory of the process and its children (MB) """
+    rss = 0
+    for p in _processes(process):
+        try:
+            rss += p.memory_info().rss
+        except psutil.Error: # process ended in between
+            pass
+    return {'rss_MB':rss/1024**2}
+
+def probeIO(process):
+    """ Bytes read from disk by the process and its children since the start (MB) """
+    read = 0
+    for p in _processes(process):
+        try:
+            read += p.io_counters().read_bytes
+        except (psutil.Error, AttributeError): # not available on all platforms
+            pass
+    return {'read_MB':read/1024**2}
+
+class utilizationCPU(Thread):
+    """
+    Class generating a parallel thread to monitor the CPU, memory and I/O usage, same usage as threadGPU.utilizationGPU
+    Initialize with :
+        thread = utilizationCPU(print_time = int      # Frequency of printing the average usage
+                                time_step = float     # Time step for sampling
+                                probes = list)        # Additional probes : functions of the psutil.Process returning
+                                                      # a dict {name: value}, eg data_generator.generator_stats.probe
+    Start thread with:
+        thread.start()
+    Every time step, one record with all the probes is added to the time series (thread.records)
+        cpu_<i>, cpu : utilization per core and average (%)
+        rss_MB       : resident memory of the process and its children
+        read_MB/s    : disk read throughput
+        + the additional probes
+    Stop the thread with
+        thread.stopLoop() # Important ! : Otherwise the loop will not be stopped properly
+        thread.join()     # Classic
+    And save the time series with thread.save(path) (csv)
+    """
+    def __init__(self,print_time=60,time_step=1.,probes=[]):
+        # Call the Thread class's init function
+        super(utilizationCPU,self).__init__()
+        self.print_time = print_time
+        self.time_step  = time_step
+        self.probes     = [probeCPU,probeMemory,probeIO]+list(probes)
+        self.records    = []
+        self.running    = True
+        self.process    = psutil.Process(os.getpid())
+        logging.info("[CPU] Monitoring %d cores, will print usage every %d seconds"%(psutil.cpu_count(),self.print_time))
+
+    def sample(self):
+        """ One record of all the probes """
+        record = {'time':time.time()}
+        for probe in self.probes:
+            try:
+                record.update(probe(self.process))
+            except Exception as e:
+                logging.error("[CPU] *** Caught exception in probe %s: %s : %s"%(probe.__name__,str(e.__class__),str(e)))
+                traceback.print_exc()
+        # Throughput from the previous record #
+        if len(self.records) > 0 and 'read_MB' in record:
+            previous = self.records[-1]
+            record['read_MB/s'] = (record['read_MB']-previous['read_MB'])/max(record['time']-previous['time'],1e-9)
+        else:
+            record['read_MB/s'] = 0.
+        return record
+
+    def summary(self,records):
+        """ Averages over the records """
+        keys = ['cpu','rss_MB','read_MB/s','batch_wait_s','queue_depth']
+        return {k:sum(r[k] for r in records)/len(records) for k in keys if len(records) > 0 and all(k in r for r in records)}
+
+    def _print(self,records,period):
+        avg = self.summary(records)
+        s = "[CPU] Average %s : "%period
+        s += ', '.join('%s = %0.2f'%(k,v) for k,v in avg.items())
+        logging.info(s)
+
+    # Override the run function of Thread class
+    def run(self):
+        probeCPU(self.process) # first call of cpu_percent is meaningless
+        last_print = time.time()
+        n_print    = 0
+        while(self.running):
+            sleep(self.time_step)
+            self.records.append(self.sample())
+            n_print += 1
+            if time.time()-last_print >= self.print_time:
+                self._print(self.records[-n_print:],'over the last %d seconds'%self.print_time)
+                last_print = time.time()
+                n_print    = 0
+        if len(self.records) > 0:
+            self._print(self.records,'over whole period')
+
+    def stopLoop(self):
+        self.running = False
+
+    def save(self,path):
+        """ Save the time series as csv, one row per record """
+        if len(self.records) == 0:
+            logging.warning("[CPU] No record to save")
+            return
+        columns = []
+        for r in self.records:
+            columns += [k for k in r.keys() if k not in columns]
+        with open(path,'w') as f:
+            writer = csv.DictWriter(f,fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(self.records)
+        logging.info("[CPU] Resource usage saved in %s"%path)
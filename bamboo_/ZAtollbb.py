@@ -71,6 +71,7 @@ class NanoHtoZABase(NanoAODModule):
 
         self.doSysts          = self.args.systematic
         self.doEvaluate       = self.args.DNN_Evaluation
+        self.doDNNGrid        = self.args.DNN_grid
         self.doSplitJER       = self.args.splitJER
         self.doJES            = self.args.jes
         self.doHLT            = self.args.hlt
@@ -93,6 +94,8 @@ class NanoHtoZABase(NanoAODModule):
         self.dotthDY_reweighting    = False       # tth weights eraly beginning on noSel
         self.doTop_reweighting      = True
         self.doProduceParquet       = False       # df for skim 
+        self.postProcessWorkers     = 8           # local processes running the postProcess stages 
+        self.parquetRowGroupSize    = 100000      # entries per chunk read from the skims and per parquet row group 
         self.doProduceSummedPlots   = False
         self.doSaveQCDVars          = False
         self.normalizeForCombine    = False
@@ -115,6 +118,8 @@ class NanoHtoZABase(NanoAODModule):
                 help=" add Yields Histograms: not recomended if you turn off the systematics, jobs may run out of memory")
         parser.add_argument("-dnn", "--DNN_Evaluation", action="store_true", 
                 help="Pass TensorFlow model and evaluate DNN output")
+        parser.add_argument("--DNN_grid", action="store_true", default= False, 
+                help="Evaluate the DNN once per event for all the signal mass points (model exported with Keras2TensorFlow2Onnx.py --grid)")
         parser.add_argument("--chunk", type=int, default=None, choices=np.arange(10).tolist(), 
                 help="For DNN evaluation you can split the signal on a 10 chunk")
         parser.add_argument("--splitJER", action="store_true", default= True, 
@@ -1029,6 +1034,25 @@ class NanoHtoZA(NanoHtoZABase, HistogramsModule):
                 #===============================================================================
             except Exception as ex:
                 raise RuntimeError(f'-- {ex} -- when op.mvaEvaluator model: {ZAmodel_path}.')
+            
+            if self.doDNNGrid:
+                # same model evaluated at all the mass points of the grid in one call : inputs without mA, mH 
+                # and the score of the node j at the mass point i in output[i*nodes+j]
+                ext = os.path.splitext(ZAmodel_path)[1]
+                ZAgrid_path = ZAmodel_path.replace(ext, f'_grid{ext}')
+                if not os.path.exists(ZAgrid_path):
+                    raise RuntimeError(f'Could not find grid model: {ZAgrid_path}, export it with ML-Tools/Keras2TensorFlow2Onnx.py --grid')
+                with open(ZAgrid_path.replace(ext, '.json')) as f:
+                    ZAgrid    = json.load(f)
+                ZAgrid_index = { tuple(m): i for i, m in enumerate(ZAgrid['masses']) }
+                ZAgrid_nodes = ZAgrid['nodes']
+                try:
+                    if tf__version:
+                        ZA_gridEvaluator = op.mvaEvaluator(ZAgrid_path, mvaType='Tensorflow', otherArgs=([i for i in inputs if i not in ['mA', 'mH']], outputs), nameHint='tf_ZAGridModel')
+                    elif onnx__version:
+                        ZA_gridEvaluator = op.mvaEvaluator(ZAgrid_path, mvaType='ONNXRuntime', otherArgs=("out"), nameHint='ONNX_ZAGridModel')
+                except Exception as ex:
+                    raise RuntimeError(f'-- {ex} -- when op.mvaEvaluator model: {ZAgrid_path}.')
 
             bayesian_blocks = "/home/ucl/cp3/kjaffel/bamboodev/ZA_FullAnalysis/ZAStatAnalysis/ul__combinedlimits/preapproval__6/rebinned_edges_bayesian_all.json"
             if not os.path.exists(bayesian_blocks):
@@ -1527,6 +1551,26 @@ class NanoHtoZA(NanoHtoZABase, HistogramsModule):
                                     llbb_M   = lljj_p4.M()
                                     # FIXME in the next itertaion of the new skim 
                                     process_ = 'ggH' if reco=='nb2' else 'bbH'
+                                    
+                                    # the same for all the mass points 
+                                    inputsEvent  = {'l1_pdgId'        : dilepton[0].pdgId,
+                                                    'myera'           : op.c_int(int(era_)),
+                                                    'bb_M'            : jj_p4.M(),
+                                                    'llbb_M'          : lljj_p4.M(),
+                                                    'bb_M_squared'    : op.pow(bb_M, 2),
+                                                    'llbb_M_squared'  : op.pow(llbb_M, 2),
+                                                    'bb_M_x_llbb_M'   : op.product(bb_M, llbb_M),
+                                                    }
+                                    inputsCateg  = {'isResolved'      : op.c_bool(region == 'resolved'),
+                                                    'isBoosted'       : op.c_bool(region == 'boosted'),
+                                                    # FIXME
+                                                    'isggH'           : op.c_bool(process_ == 'ggH'),
+                                                    'isbbH'           : op.c_bool(process_ == 'bbH'),
+                                                    }
+                                    if self.doDNNGrid:
+                                        # one call for all the mass points, each plot takes its score in the output
+                                        DNN_GridInputs = [op.array("float",val) for val in inputStaticCast({**inputsEvent, **inputsCateg},"float")]
+                                        DNN_GridOutput = ZA_gridEvaluator(*DNN_GridInputs) # [DY, TT, ZA or ZH] x mass points
                                    
                                     for mode in [ 'HToZA', 'AToZH']:
                                         Heavy  = mode[0]
@@ -1547,34 +1591,29 @@ class NanoHtoZA(NanoHtoZABase, HistogramsModule):
                                                 mLight = parameters[1]
                                                 histNm = f"DNNOutput_{nm}node_{channel}_{reco}_{region}_{tag_plus_wp}_METCut_M{Heavy}_{mass_to_str(mHeavy)}_M{Light}_{mass_to_str(mLight)}"
                                                 
-                                                inputsCommon = {'l1_pdgId'        : dilepton[0].pdgId,
-                                                                'myera'           : op.c_int(int(era_)),
-                                                                'bb_M'            : jj_p4.M(),
-                                                                'llbb_M'          : lljj_p4.M(),
-                                                                'bb_M_squared'    : op.pow(bb_M, 2),
-                                                                'llbb_M_squared'  : op.pow(llbb_M, 2),
-                                                                'bb_M_x_llbb_M'   : op.product(bb_M, llbb_M),
-                                                                #f'm{Light}'      : op.c_float(mLight),  
-                                                                #f'm{Heavy}'      : op.c_float(mHeavy),
-                                                                'mA'              : op.c_float(mLight),  
-                                                                'mH'              : op.c_float(mHeavy),
-                                                                'isResolved'      : op.c_bool(region == 'resolved'),
-                                                                'isBoosted'       : op.c_bool(region == 'boosted'),
-                                                                # FIXME
-                                                                'isggH'           : op.c_bool(process_ == 'ggH'),
-                                                                'isbbH'           : op.c_bool(process_ == 'bbH'),
-                                                                }
-                                                
                                                 if self.rebin == 'uniform':
                                                     binning = EqB(50, 0., 1.)
+                                                
+                                                if self.doDNNGrid:
+                                                    if not (float(mHeavy), float(mLight)) in ZAgrid_index:
+                                                        raise RuntimeError(f'Mass point {(mHeavy, mLight)} not in the grid of {ZAgrid_path}, export it again with this point')
+                                                    DNN_Score = DNN_GridOutput[ZAgrid_index[(float(mHeavy), float(mLight))]*ZAgrid_nodes+2]
+                                                else:
+                                                    inputsCommon = {**inputsEvent,
+                                                                    #f'm{Light}'      : op.c_float(mLight),  
+                                                                    #f'm{Heavy}'      : op.c_float(mHeavy),
+                                                                    'mA'              : op.c_float(mLight),  
+                                                                    'mH'              : op.c_float(mHeavy),
+                                                                    **inputsCateg}
     
-                                                DNN_Inputs   = [op.array("float",val) for val in inputStaticCast(inputsCommon,"float")]
-                                                DNN_Output   = ZA_mvaEvaluator(*DNN_Inputs) # [DY, TT, ZA or ZH]
+                                                    DNN_Inputs   = [op.array("float",val) for val in inputStaticCast(inputsCommon,"float")]
+                                                    DNN_Output   = ZA_mvaEvaluator(*DNN_Inputs) # [DY, TT, ZA or ZH]
+                                                    DNN_Score    = DNN_Output[2]
                                                 
                                                 # some crap , ignore !! 
                                                 #find_idx_maxProb = op.rng_max_element_index(DNN_Output)
                                                 #sel= sel.refine(f'{histNm}_sel', cut=[find_idx_maxProb == op.c_int(2)])                
-                                                pltToSum_OSSFLepFlav = Plot.make1D(histNm, DNN_Output[2], sel, binning, title=f'DNN_Output {nm}', plotopts=plotOptions)
+                                                pltToSum_OSSFLepFlav = Plot.make1D(histNm, DNN_Score, sel, binning, title=f'DNN_Output {nm}', plotopts=plotOptions)
                                                 plots += [pltToSum_OSSFLepFlav]
                                                 
                                                 if not channel in ['MuEl', 'ElMu']:
@@ -1665,7 +1704,6 @@ class NanoHtoZA(NanoHtoZABase, HistogramsModule):
 
         import json 
         import bambooToOls
-        import pandas as pd
         
         from bamboo.root import gbl
         from bamboo.plots import CutFlowReport, DerivedPlot, Skim
@@ -1682,12 +1720,27 @@ class NanoHtoZA(NanoHtoZABase, HistogramsModule):
         if not self.plotList:
             self.plotList = self.getPlotList(resultsdir=resultsdir, config=config)
         
+        # The stages below run as a task graph on a local pool of processes : the counters of each results file are
+        # read once and shared by the stages that need them, the independent stages ( normalization, 2D plots, skims )
+        # run at the same time and each stage is split in one unit per sample where possible
+        from postProcessTasks import PostProcessGraph, CachedCounters, readFileCounters
+        graph = PostProcessGraph(self.postProcessWorkers)
+
+        pdfTasks = []
         if self.doSysts:
             for task in taskList:
                 if self.isMC(task.name) and "syst" not in task.config:
                     if self.pdfVarMode == "full" and task.config.get("pdf_full", False):
-                        utils.producePDFEnvelopes(self.plotList, task, resultsdir)
+                        pdfTasks.append(task)
+        graph.add("pdfEnvelopes", { task.name: (utils.producePDFEnvelopes, (self.plotList, task, resultsdir)) for task in pdfTasks })
+        
+        mcFiles = { smpNm: os.path.join(resultsdir, f"{smpNm}.root") for smpNm, smpCfg in config["samples"].items()
+                        if 'data' not in smpCfg.values() and os.path.exists(os.path.join(resultsdir, f"{smpNm}.root")) }
+        # after the PDF envelopes, that are written in the same files
+        graph.add("counters", { smpNm: (readFileCounters, (path, self.readCounters)) for smpNm, path in mcFiles.items() },
+                    deps=("pdfEnvelopes",))
         
+        normTasks = []
         if self.normalizeForCombine:
             plotstoNormalized = []
             for plots in self.plotList:
@@ -1697,54 +1750,62 @@ class NanoHtoZA(NanoHtoZABase, HistogramsModule):
                 os.makedirs(os.path.join(resultsdir,"normalizedForCombined"))
     
             if plotstoNormalized:
-                utils.normalizeAndMergeSamplesForCombined(plotstoNormalized, self.readCounters, config, resultsdir, os.path.join(resultsdir, "normalizedForCombined"))
+                normTasks = utils.normalizeForCombinedTasks(plotstoNormalized, config, resultsdir, os.path.join(resultsdir, "normalizedForCombined"))
+        
+        def filesCounters(counters):
+            # the counters stage results are per sample, CachedCounters looks them up by file
+            return CachedCounters({ mcFiles[smpNm]: c for smpNm, c in counters.items() if c is not None }, self.readCounters)
+        
+        def normalizeSample(task, counters):
+            return utils.normalizeSampleForCombined(task, filesCounters(counters))
+        # the PDF envelopes are written in the results files before they are normalized
+        graph.add("normalizeForCombined", { task[0]: (normalizeSample, (task,)) for task in normTasks }, 
+                    deps=("counters", "pdfEnvelopes"), inputs=("counters",))
         
         # save generated-events for each samples--- > mainly needed for the DNN
         plotList_cutflowreport = [ ap for ap in self.plotList if isinstance(ap, CutFlowReport) ]
         #bambooToOls.SaveCutFlowReports(config, plotList_cutflowreport, resultsdir, self.readCounters)
         
-        prepostVFP_xsec = dict()
-        prepostVFP_sumw = dict()
-        for era in config["eras"]:
-            xsec = dict()
-            sumw = dict()
-            for smpNm, smpCfg in config["samples"].items():
-                outName = f"{smpNm}.root"
-                if 'data' in smpCfg.values(): 
-                    continue
-                if smpCfg["era"] != era:
-                    continue
-                if not os.path.exists(os.path.join(resultsdir, outName)):
-                    continue
-                
-                f = gbl.TFile.Open(os.path.join(resultsdir, outName))
-                xsec[outName]  = smpCfg["cross-section"]
-                sumw[outName]  = self.readCounters(f)[smpCfg["generated-events"]]
-                if 'VFP' in smpNm:
-                    prepostVFP_xsec[outName]  = smpCfg["cross-section"]
-                    prepostVFP_sumw[outName]  = self.readCounters(f)[smpCfg["generated-events"]]
-
+        def saveXsecSumw(counters):
+            prepostVFP_xsec = dict()
+            prepostVFP_sumw = dict()
             xsecSumw_dir = os.path.join(resultsdir, "data")
             if not os.path.isdir(xsecSumw_dir):
                 os.makedirs(xsecSumw_dir)
-            
-            with open(os.path.join(xsecSumw_dir, f"ulegacy{era}_xsec.json"), "w") as normF:
-                json.dump(xsec, normF, indent=4)
-            with open(os.path.join(xsecSumw_dir, f"ulegacy{era}_event_weight_sum.json"), "w") as normF:
-                json.dump(sumw, normF, indent=4)
+            for era in config["eras"]:
+                xsec = dict()
+                sumw = dict()
+                for smpNm, smpCfg in config["samples"].items():
+                    outName = f"{smpNm}.root"
+                    if smpNm not in mcFiles or counters.get(smpNm) is None:
+                        continue
+                    if smpCfg["era"] != era:
+                        continue
+                    
+                    xsec[outName]  = smpCfg["cross-section"]
+                    sumw[outName]  = counters[smpNm][smpCfg["generated-events"]]
+                    if 'VFP' in smpNm:
+                        prepostVFP_xsec[outName]  = smpCfg["cross-section"]
+                        prepostVFP_sumw[outName]  = counters[smpNm][smpCfg["generated-events"]]
 
-        with open(os.path.join(xsecSumw_dir, f"ulegacy2016_xsec.json"), "w") as normF:
-            json.dump(prepostVFP_xsec, normF, indent=4)
-        with open(os.path.join(xsecSumw_dir, f"ulegacy2016_event_weight_sum.json"), "w") as normF:
-            json.dump(prepostVFP_sumw, normF, indent=4)
+                with open(os.path.join(xsecSumw_dir, f"ulegacy{era}_xsec.json"), "w") as normF:
+                    json.dump(xsec, normF, indent=4)
+                with open(os.path.join(xsecSumw_dir, f"ulegacy{era}_event_weight_sum.json"), "w") as normF:
+                    json.dump(sumw, normF, indent=4)
 
+            with open(os.path.join(xsecSumw_dir, f"ulegacy2016_xsec.json"), "w") as normF:
+                json.dump(prepostVFP_xsec, normF, indent=4)
+            with open(os.path.join(xsecSumw_dir, f"ulegacy2016_event_weight_sum.json"), "w") as normF:
+                json.dump(prepostVFP_sumw, normF, indent=4)
+        
+        graph.add("xsecSumw", { "json": (saveXsecSumw, ()) }, deps=("counters",), local=True, inputs=("counters",))
         
         plotList_2D = [ ap for ap in self.plotList if ( isinstance(ap, Plot) or isinstance(ap, DerivedPlot) ) and len(ap.binnings) == 2 ]
         logger.debug("Found {0:d} plots to save".format(len(plotList_2D)))
         
-        if plotList_2D:
+        def savePlots2D(counters):
             # FIXME  era here causeing issue, when bamboo in run on 1 single era but the yml contains other eras !
-            p_config, samples, plots_2D, systematics, legend = loadPlotIt(config, plotList_2D, eras=None, workdir=workdir, resultsdir=resultsdir, readCounters=self.readCounters, vetoFileAttributes=self.__class__.CustomSampleAttributes, plotDefaults=self.plotDefaults)
+            p_config, samples, plots_2D, systematics, legend = loadPlotIt(config, plotList_2D, eras=None, workdir=workdir, resultsdir=resultsdir, readCounters=filesCounters(counters), vetoFileAttributes=self.__class__.CustomSampleAttributes, plotDefaults=self.plotDefaults)
         
             for plot in plots_2D:
                 if ('_2j_jet_pt_eta_') in plot.name  or plot.name.startswith('pair_lept_2j_jet_pt_vs_eta_'):
@@ -1768,33 +1829,32 @@ class NanoHtoZA(NanoHtoZABase, HistogramsModule):
                         obsStack.obj.Draw("COLZ0")
                     cv.Update()
                     cv.SaveAs(os.path.join(resultsdir, f"{plot.name}.png"))
-            
-        if self.doProduceParquet:
-            skims = [ap for ap in self.plotList if isinstance(ap, Skim)]
-            if self.doSkim and skims:
-                try:
-                    for skim in skims:
-                        frames = []
-                        for smp in samples:
-                            for cb in (smp.files if hasattr(smp, "files") else [smp]):  # could be a helper in plotit
-                                # Take specific columns
-                                tree = cb.tFile.Get(skim.treeName)
-                                if not tree:
-                                    print( f"KEY TTree {skim.treeName} does not exist, we are gonna skip this {smp}\n")
-                                else:
-                                    N = tree.GetEntries()
-                                    # https://indico.cern.ch/event/775679/contributions/3244724/attachments/1767054/2869505/RDataFrame.AsNumpy.pdf
-                                    # https://stackoverflow.com/questions/33813815/how-to-read-a-parquet-file-into-pandas-dataframe
-                                    #print (f"Entries in {smp} // KEY TTree {skim.treeName}: {N}")
-                                    cols = gbl.ROOT.RDataFrame(cb.tFile.Get(skim.treeName)).AsNumpy()
-                                    cols["total_weight"] *= cb.scale
-                                    cols["process"] = [smp.name]*len(cols["total_weight"])
-                                    frames.append(pd.DataFrame(cols))
-                        df = pd.concat(frames)
-                        df["process"] = pd.Categorical(df["process"], categories=pd.unique(df["process"]), ordered=False)
-                        pqoutname = os.path.join(resultsdir, f"{skim.name}.parquet")
-                        df.to_parquet(pqoutname)
-                        logger.info(f"Dataframe for skim {skim.name} saved to {pqoutname}")
-                except ImportError as ex:
-                    logger.error("Could not import pandas, no dataframes will be saved")
         
+        graph.add("plots2D", { "2D": (savePlots2D, ()) } if plotList_2D else {}, 
+                    deps=("counters", "pdfEnvelopes"), inputs=("counters",))
+            
+        # skims : one unit per skim and sample, each converted in chunks into a partitioned parquet dataset
+        from skimToParquet import sampleScale, processName, eraYear, exportSkimFile
+        skims = [ap for ap in self.plotList if isinstance(ap, Skim)] if self.doProduceParquet and self.doSkim else []
+        skimFiles = { smpNm: os.path.join(resultsdir, f"{smpNm}.root") for smpNm in config["samples"] 
+                        if os.path.exists(os.path.join(resultsdir, f"{smpNm}.root")) }
+        for skim in skims:
+            pqoutname = os.path.join(resultsdir, f"{skim.name}.parquet")
+            if os.path.isdir(pqoutname):
+                shutil.rmtree(pqoutname)
+            elif os.path.exists(pqoutname): # single file written by the previous versions
+                os.remove(pqoutname)
+        
+        def saveSkim(skim, smpNm, counters):
+            smpCfg = config["samples"][smpNm]
+            scale  = sampleScale(smpCfg, config["eras"][smpCfg["era"]]["luminosity"], counters.get(smpNm))
+            return exportSkimFile(skimFiles[smpNm], skim.treeName, os.path.join(resultsdir, f"{skim.name}.parquet"), 
+                                    processName(smpNm, smpCfg), eraYear(smpCfg["era"]), scale=scale, rowGroupSize=self.parquetRowGroupSize)
+        
+        graph.add("parquet", { f"{skim.name}/{smpNm}": (saveSkim, (skim, smpNm)) for skim in skims for smpNm in skimFiles }, 
+                    deps=("counters",), inputs=("counters",))
+        
+        results = graph.run()
+        for skim in skims:
+            nRows = sum(n or 0 for unit, n in results["parquet"].items() if unit.startswith(f"{skim.name}/"))
+            logger.info(f"Dataframe for skim {skim.name} ({nRows} entries) saved to {os.path.join(resultsdir, f'{skim.name}.parquet')}")
@@ -18,14 +18,8 @@ class Plot(bamboo.plots.Plot):
             elif len(hVar_qcdScale) < 2:
                 logger.error("At least two variations histograms must be provided")
             else: ## make an envelope from maximum deviations
-                import numpy as np
-                vars_cont = np.array([ [ hv.GetBinContent(i) for i in range(hv.GetNcells()) ] for hv in hVar_qcdScale ])
-                hVar_up   = hNom.Clone(f"{prefix}up")
-                hVar_down = hNom.Clone(f"{prefix}down")
-                from itertools import count
-                for i,vl,vh in zip(count(), np.amin(vars_cont, axis=0), np.amax(vars_cont, axis=0)):
-                    hVar_down.SetBinContent(i, vl)
-                    hVar_up.SetBinContent(i, vh)
+                import HistogramTools as HT
+                hVar_up, hVar_down = HT.getEnvelopeHistogramsFromArrays(hNom, hVar_qcdScale, "minmax", names=(f"{prefix}up", f"{prefix}down"))
                 return bareResults + [ hVar_up, hVar_down ]
         return bareResults
 
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# Benchmark of the QCD scale / PDF envelopes : per-cell python loops (as before) against HistogramTools.envelopeArrays
+# on a 100-replica PDF set, run it in the bamboo environment (needs ROOT)
+# usage : python benchmark_envelopes.py [--bins 50 500 5000] [--replicas 100] [--plots 20]
+import argparse
+import timeit
+import numpy as np
+
+import HistogramTools as HT
+from bamboo.root import gbl as ROOT
+
+
+def make_histograms(nBins, nReplicas, seed=42):
+    rng = np.random.default_rng(seed)
+    nominal = ROOT.TH1D(f"nominal_{nBins}", "", nBins, 0., 1.)
+    nominal.SetDirectory(ROOT.nullptr)
+    nom = rng.exponential(100., size=nBins+2)
+    nominal.SetContent(nom)
+    replicas = []
+    for i in range(nReplicas):
+        h = nominal.Clone(f"nominal_{nBins}__pdf{i}")
+        h.SetDirectory(ROOT.nullptr)
+        h.SetContent(nom*rng.normal(1., 0.05, size=nBins+2))
+        replicas.append(h)
+    return nominal, replicas
+
+
+def legacy_minmax(nominal, variations):
+    """ Former HistogramTools.getEnvelopeHistograms : loop over the cells and the variations """
+    up = nominal.Clone()
+    up.SetDirectory(ROOT.nullptr)
+    up.Reset()
+    down = nominal.Clone()
+    down.SetDirectory(ROOT.nullptr)
+    down.Reset()
+    for i in range(0, nominal.GetNcells()):
+        minimum = float("inf")
+        maximum = float("-inf")
+        for v in variations:
+            c = v.GetBinContent(i)
+            minimum = min(minimum, c)
+            maximum = max(maximum, c)
+        up.SetBinContent(i, maximum)
+        down.SetBinContent(i, minimum)
+    return up, down
+
+
+def legacy_hessian(nominal, variations):
+    """ Former utils.producePDFEnvelopes : np.array of each histogram and SetBinContent per cell """
+    replica_values = np.vstack([ np.array([ h.GetBinContent(i) for i in range(h.GetNcells()) ]) for h in variations ])
+    nom_values = np.array([ nominal.GetBinContent(i) for i in range(nominal.GetNcells()) ])
+    sigma = np.sqrt(((replica_values - nom_values)**2).sum(axis=0))
+    up = nominal.Clone("up")
+    down = nominal.Clone("down")
+    for i, (u, d) in enumerate(zip(nom_values + sigma, np.clip(nom_values - sigma, 0., None))):
+        up.SetBinContent(i, u)
+        down.SetBinContent(i, d)
+    return up, down
+
+
+def numpy_envelope(nominal, variations, method):
+    nom, stacked = HT.stackHistArrays(nominal, variations)
+    up, down = HT.envelopeArrays(nom, stacked, method)
+    return HT.histFromArray(nominal, up, "up"), HT.histFromArray(nominal, down, "down")
+
+
+def contents(h):
+    return HT.getHistArrays(h)[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the QCD scale and PDF envelopes')
+    parser.add_argument('--bins', nargs='+', type=int, default=[50, 500, 5000], help='number of bins of the histograms')
+    parser.add_argument('--replicas', type=int, default=100, help='number of PDF replicas')
+    parser.add_argument('--plots', type=int, default=20, help='number of plots per measurement')
+    args = parser.parse_args()
+
+    print(f"{args.replicas} replicas, time for {args.plots} plots")
+    print(f"{'bins':>6} {'method':>8} {'legacy [s]':>12} {'numpy [s]':>12} {'speed-up':>10}")
+    for nBins in args.bins:
+        nominal, replicas = make_histograms(nBins, args.replicas)
+        for method, legacy in [("minmax", legacy_minmax), ("hessian", legacy_hessian)]:
+            # Same envelopes from both #
+            ref, new = legacy(nominal, replicas), numpy_envelope(nominal, replicas, method)
+            assert all(np.allclose(contents(r), contents(n)) for r, n in zip(ref, new))
+            t_legacy = timeit.timeit(lambda: legacy(nominal, replicas), number=args.plots)
+            t_numpy  = timeit.timeit(lambda: numpy_envelope(nominal, replicas, method), number=args.plots)
+            print(f"{nBins:>6} {method:>8} {t_legacy:>12.3f} {t_numpy:>12.3f} {t_legacy/t_numpy:>10.1f}")
+        # array part only : one pass over the (n_var x n_cells) array #
+        nom, stacked = HT.stackHistArrays(nominal, replicas)
+        t_mc = timeit.timeit(lambda: HT.envelopeArrays(nom, stacked, "mc"), number=args.plots)
+        print(f"{nBins:>6} {'mc':>8} {'':>12} {t_mc:>12.5f}   (arrays only)")
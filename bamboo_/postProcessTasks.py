@@ -0,0 +1,137 @@
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import HistogramTools as HT
+import utils as utils
+logger = utils.ZAlogger(__name__)
+
+# Functions of the work units : registered before the pool is forked, so that the workers inherit them
+# ( bound methods of the analysis module, plot lists ... are not pickled, only the unit keys and their results )
+_units = {}
+
+
+def _runUnit(key, inputs):
+    fn, args = _units[key]
+    start = time.time()
+    return fn(*args, **inputs), time.time() - start
+
+
+def readFileCounters(path, readCounters):
+    """ Counters of one results file, as a dict of floats ( the file is opened only here ) """
+    tf = HT.openFileAndGet(path)
+    counters = { k: float(v) for k, v in readCounters(tf).items() }
+    tf.Close()
+    return counters
+
+
+class CachedCounters:
+    """
+    readCounters replacement reading the counters cached by the "counters" stage instead of the files,
+    falls back to readCounters for the files that are not in the cache
+    """
+    def __init__(self, counters, readCounters=None):
+        self.counters     = { os.path.abspath(p): c for p, c in counters.items() }
+        self.readCounters = readCounters
+
+    def __call__(self, tf):
+        path = os.path.abspath(tf.GetName())
+        if path in self.counters:
+            return self.counters[path]
+        return self.readCounters(tf)
+
+
+class PostProcessGraph:
+    """
+    Stages of the post-processing run on a local pool of nWorkers forked processes
+        graph = PostProcessGraph(nWorkers)
+        graph.add(stage, units, deps=(), local=False)
+    units : { unit name : (fn, args) }, the units of a stage are independent of each other and run in parallel,
+            a stage starts when all the stages in deps are done; fn receives the results of the dependencies as
+            keyword arguments ( dep stage name -> { unit name : result } ) when it accepts them (see add(inputs=...))
+    local : run the units in the driver process ( cheap stages or stages that need the driver objects )
+    graph.run() returns { stage : { unit : result } } and logs the time spent in each stage,
+    when a unit fails the units not started yet are cancelled and run() raises a RuntimeError
+    """
+    def __init__(self, nWorkers=None):
+        self.nWorkers = nWorkers or os.cpu_count()
+        self.stages   = {}
+
+    def add(self, stage, units, deps=(), local=False, inputs=()):
+        """ inputs : stages among deps whose results are passed to the units """
+        for dep in deps:
+            if dep not in self.stages:
+                raise KeyError(f"Stage {stage} depends on {dep} which is not defined (yet)")
+        for unit, (fn, args) in units.items():
+            _units[(stage, unit)] = (fn, args)
+        self.stages[stage] = { 'units': list(units.keys()), 'deps': tuple(deps), 'local': local, 'inputs': tuple(inputs) }
+
+    def _inputs(self, stage, results):
+        return { dep: results[dep] for dep in self.stages[stage]['inputs'] }
+
+    def run(self):
+        results  = { stage: {} for stage in self.stages }
+        pending  = { stage: len(cfg['units']) for stage, cfg in self.stages.items() }
+        started  = {}
+        done     = set(stage for stage, n in pending.items() if n == 0)
+        running  = {}
+        failed   = []
+        start    = time.time()
+
+        def finish(stage):
+            done.add(stage)
+            busy = sum(t for t, _ in results[stage].values()) if results[stage] else 0.
+            logger.info(f"[postProcess] {stage:<22} : {len(self.stages[stage]['units'])} units done in {time.time()-started.get(stage, time.time()):.1f}s (summed time of the units {busy:.1f}s)")
+            results[stage] = { unit: res for unit, (_, res) in results[stage].items() }
+
+        with ProcessPoolExecutor(max_workers=self.nWorkers, mp_context=multiprocessing.get_context("fork")) as pool:
+            while len(done) < len(self.stages) and not failed:
+                for stage, cfg in self.stages.items():
+                    if failed:
+                        break
+                    if stage in done or stage in started or not all(d in done for d in cfg['deps']):
+                        continue
+                    started[stage] = time.time()
+                    inputs = self._inputs(stage, results)
+                    if cfg['local']:
+                        for unit in cfg['units']:
+                            try:
+                                res, t = _runUnit((stage, unit), inputs)
+                            except Exception as ex:
+                                logger.error(f"[postProcess] {stage} / {unit} failed : {ex}")
+                                failed.append((stage, unit, ex))
+                                break
+                            results[stage][unit] = (t, res)
+                        else:
+                            finish(stage)
+                    else:
+                        for unit in cfg['units']:
+                            running[pool.submit(_runUnit, (stage, unit), inputs)] = (stage, unit)
+                if len(done) == len(self.stages) or failed:
+                    break
+                if not running:
+                    # local stages just finished : schedule their dependants
+                    continue
+                finished, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage, unit = running.pop(future)
+                    try:
+                        res, t = future.result()
+                    except Exception as ex:
+                        logger.error(f"[postProcess] {stage} / {unit} failed : {ex}")
+                        failed.append((stage, unit, ex))
+                        continue
+                    results[stage][unit] = (t, res)
+                    pending[stage] -= 1
+                    if pending[stage] == 0:
+                        finish(stage)
+            if failed:
+                # the units already running are waited for when the pool is shut down
+                for future in running:
+                    future.cancel()
+
+        if failed:
+            raise RuntimeError("[postProcess] {0:d} unit(s) failed : {1}".format(len(failed), ", ".join(f"{stage} / {unit}" for stage, unit, _ in failed))) from failed[0][2]
+        logger.info(f"[postProcess] all stages done in {time.time()-start:.1f}s on {self.nWorkers} workers")
+        return results
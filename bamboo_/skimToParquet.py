@@ -0,0 +1,76 @@
+import os
+
+import utils as utils
+logger = utils.ZAlogger(__name__)
+
+# Layout of the dataset written for each skim, read back with pd.read_parquet(path) or pyarrow.dataset :
+#   <resultsdir>/<skim>.parquet/process=<plotIt group>/era=<year>/<sample>.parquet
+# process and era are the partition keys ( categorical columns once read ), they are not stored in the files :
+# process is the plotIt group of the sample ( the sample name when it has none ) and era the year, as in the era
+# column of the skims ( 2016 for both 2016 VFP eras )
+
+
+def sampleScale(smpCfg, lumi, counters):
+    """ Same scale as plotIt : lumi * xsec ( * BR ) / sum of generated weights for MC, 1 for data """
+    if 'data' in smpCfg.values():
+        return 1.
+    scale = lumi * smpCfg["cross-section"] * smpCfg.get("branching-ratio", 1.)
+    genEvts = smpCfg["generated-events"]
+    return scale / (counters[genEvts] if isinstance(genEvts, str) else genEvts)
+
+
+def processName(smpNm, smpCfg):
+    """ Name of the sample in the plots ( plotIt group ), the process partition of the skims """
+    return smpCfg.get("group", smpNm)
+
+
+def eraYear(era):
+    """ Era of the config ( 2016-preVFP, 2017 ... ) as the year of the era column of the skims """
+    return int(era if "VFP" not in era else "2016")
+
+
+def exportSkimFile(path, treeName, outDir, process, era, scale=1., rowGroupSize=100000):
+    """
+    Convert the skim tree treeName of one results file into one file of the partitioned parquet dataset outDir,
+    in the partition process=<process>/era=<era> ( see processName and eraYear ), named as the results file
+    The tree is read in chunks of rowGroupSize entries, each chunk is scaled ( total_weight ) and written as one
+    row group, so the memory used does not depend on the size of the sample. The era column of the skim is
+    dropped, era replaces it as partition key
+    return : number of rows written
+    """
+    import uproot
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    smpNm = os.path.splitext(os.path.basename(path))[0]
+    with uproot.open(path) as resultsFile:
+        if treeName not in resultsFile:
+            logger.warning(f"KEY TTree {treeName} does not exist, we are gonna skip {smpNm}")
+            return 0
+        tree   = resultsFile[treeName]
+        writer = None
+        nRows  = 0
+        try:
+            for chunk in tree.iterate(library="np", step_size=rowGroupSize):
+                chunk.pop("era", None)
+                chunk["total_weight"] *= scale
+                table = pa.table(chunk)
+                if writer is None:
+                    partDir = os.path.join(outDir, f"process={process}", f"era={era}")
+                    os.makedirs(partDir, exist_ok=True)
+                    outName = os.path.join(partDir, f"{smpNm}.parquet")
+                    # written as a hidden file, ignored when reading the dataset, until it is complete
+                    tmpName = os.path.join(partDir, f".{smpNm}.parquet")
+                    writer  = pq.ParquetWriter(tmpName, table.schema)
+                writer.write_table(table, row_group_size=rowGroupSize)
+                nRows += table.num_rows
+        except:
+            if writer is not None:
+                writer.close()
+                os.remove(tmpName)
+            raise
+        if writer is not None:
+            writer.close()
+            os.replace(tmpName, outName)
+    logger.debug(f"{smpNm} ({process}, {era}) : {nRows} entries of {treeName} saved to {outDir}")
+    return nRows
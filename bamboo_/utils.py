@@ -8,7 +8,7 @@ import subprocess
 import numpy as np
 import HistogramTools as HT
 
-from bamboo.plots import Plot, SummedPlot
+from bamboo.plots import Plot, SummedPlot, CutFlowReport
 from bamboo.root import gbl
 from bamboo.root import gbl as ROOT
 from bamboo import treefunctions as op
@@ -463,43 +463,109 @@ def splitTTjetFlavours(cfg, tree, noSel):
     return noSel.refine(subProc, cut=ttJetFlavCuts(subProc, tree))
 
 
-def normalizeAndMergeSamplesForCombined(plots, counterReader, config, inDir, outPath):
+# State shared with the normalization workers : set before the pool is forked, so that
+# readCounters (a method of the analysis module) does not need to be pickled
+_normalizeContext = {}
+
+
+def _selectHists(resultsFile, names=None):
+    """ TH1 keys of resultsFile, only the plots in names and their systematic variations ( name__* ) if names is given """
+    prefixes = tuple(f"{name}__" for name in names) if names is not None else ()
+    for key in resultsFile.GetListOfKeys():
+        name = key.GetName()
+        if names is not None and not (name in names or name.startswith(prefixes)):
+            continue
+        if not ROOT.TClass.GetClass(key.GetClassName()).InheritsFrom("TH1"):
+            continue
+        if key.GetClassName().startswith("TProfile"):
+            logger.warning(f"{name} : profiles are not normalized")
+            continue
+        yield name, key
+
+
+def _normalizeSample(task):
+    """ Worker : read the results file of one sample once, scale all the histograms as arrays and write the normalized file """
+    smp, path, outFile, lumi, smpCfg, names = task
+    resultsFile    = HT.openFileAndGet(path, mode="READ")
+    smpScale       = lumi / _normalizeContext["readCounters"](resultsFile)[smpCfg["generated-events"]]
+    if smpCfg.get("type") == "signal":
+        smpScale *= smpCfg["cross-section"] * smpCfg["branching-ratio"]
+    elif smpCfg.get("type") == "mc":
+        smpScale *= smpCfg["cross-section"]
+    normalizedFile = HT.openFileAndGet(outFile, "recreate")
+    for name, key in _selectHists(resultsFile, names):
+        h = key.ReadObj()
+        contents, sumw2 = HT.getHistArrays(h)
+        HT.setHistArrays(h, contents*smpScale, sumw2*smpScale**2, h.GetEntries())
+        normalizedFile.WriteTObject(h, name)
+    normalizedFile.Close()
+    resultsFile.Close()
+    return smp
+
+
+def _readScaledSample(task):
+    """
+    Worker : read the results file of one process once and return its scaled histograms as arrays
+        { name : [contents, sumw2, entries] } and, if withTemplates, { name : empty histogram } to write them back
+    """
+    proc, path, lumi, smpCfg, withTemplates = task
+    resultsFile = HT.openFileAndGet(path)
+    smpScale    = lumi * smpCfg["cross-section"] / getSumw(resultsFile, smpCfg, _normalizeContext["readCounters"])
+    arrays      = {}
+    templates   = {}
+    for name, key in _selectHists(resultsFile):
+        h = key.ReadObj()
+        contents, sumw2 = HT.getHistArrays(h)
+        arrays[name] = [contents*smpScale, sumw2*smpScale**2, h.GetEntries()]
+        if withTemplates:
+            h.SetDirectory(0)
+            h.Reset()
+            templates[name] = h
+    resultsFile.Close()
+    return proc, arrays, templates
+
+
+def _runNormalizationPool(worker, tasks, readCounters, nWorkers):
+    import multiprocessing
+    _normalizeContext["readCounters"] = readCounters
+    nWorkers = max(1, min(nWorkers or os.cpu_count(), len(tasks)))
+    with multiprocessing.get_context("fork").Pool(nWorkers) as pool:
+        yield from pool.imap_unordered(worker, tasks)
+
+
+def normalizeForCombinedTasks(plots, config, inDir, outPath):
+    """
+    Tasks of normalizeAndMergeSamplesForCombined, one per MC sample ( see normalizeSampleForCombined ),
+    the data files are copied to outPath
+    """
+    names = set(plot.name for plot in plots) if plots is not None else None
+    tasks = []
     for smp, smpCfg in config["samples"].items():
         if smpCfg.get("group") == "data":
             #copy results file to outPath
             shutil.copyfile( os.path.join(inDir, f"{smp}.root"), os.path.join(outPath,f"{smp}.root"))
         else:
-            resultsFile    = HT.openFileAndGet(os.path.join(inDir, f"{smp}.root"), mode="READ")
-            normalizedFile = HT.openFileAndGet(os.path.join(outPath, f"{smp}.root"), "recreate")
-            
             lumi = config["eras"][smpCfg["era"]]["luminosity"]
-            smpScale = lumi / counterReader(resultsFile)[smpCfg["generated-events"]]
-            
-            if smpCfg.get("type") == "signal":
-                smpScale *= smpCfg["cross-section"] * smpCfg["branching-ratio"]
-            elif smpCfg.get("type") == "mc":
-                smpScale *= smpCfg["cross-section"]
-            
-            if plots is None: # do all 
-                for k in resultsFile.GetListOfKeys():
-                    h = resultsFile.Get(k.GetName())
-                    h.Scale(smpScale)
-                    h.Write()
-                normalizedFile.Write()
-                resultsFile.Close()
-            else:
-                for plot in plots:
-                    hNom = resultsFile.Get(plot.name)
-                    hNom.Scale(smpScale)
-                    hNom.Write()
-                    prefix = f"{plot.name}__"
-                    for hk in resultsFile.GetListOfKeys():
-                        if hk.GetName().startswith(prefix):
-                            hV = resultsFile.Get(hk.GetName())
-                            hV.Scale(smpScale)
-                            hV.Write()
-                normalizedFile.Write()
-                resultsFile.Close()
+            tasks.append((smp, os.path.join(inDir, f"{smp}.root"), os.path.join(outPath, f"{smp}.root"), lumi, smpCfg, names))
+    return tasks
+
+
+def normalizeSampleForCombined(task, counterReader):
+    """ Normalize the results file of one sample ( task from normalizeForCombinedTasks ) in this process """
+    _normalizeContext["readCounters"] = counterReader
+    return _normalizeSample(task)
+
+
+def normalizeAndMergeSamplesForCombined(plots, counterReader, config, inDir, outPath, nWorkers=4):
+    """
+    Write in outPath each MC results file of inDir normalized by lumi * xsec ( * BR ) / sum of generated weights,
+    data files are copied. plots : only these plots and their variations are written ( None : all the histograms )
+    Each file is read once and its histograms scaled as arrays, nWorkers files are processed at the same time
+    """
+    tasks = normalizeForCombinedTasks(plots, config, inDir, outPath)
+    if tasks:
+        for smp in _runNormalizationPool(_normalizeSample, tasks, counterReader, nWorkers):
+            logger.debug(f"{smp} normalized")
 
 
 def getSumw(resultsFile, smpCfg, readCounters=None):
@@ -513,45 +579,70 @@ def getSumw(resultsFile, smpCfg, readCounters=None):
     return genEvts
 
 
-def normalizeAndSumSamples(eras, samples, inDir, outPath, readCounters=lambda f: -1.):
+def _addArrays(sums, name, arrays):
+    """ sums[name] += arrays ( [contents, sumw2, entries] ), in place """
+    if name not in sums:
+        sums[name] = [arrays[0].copy(), arrays[1].copy(), arrays[2]]
+    else:
+        sums[name][0] += arrays[0]
+        sums[name][1] += arrays[1]
+        sums[name][2] += arrays[2]
+
+
+def _writeSummedHists(path, sums, templates):
+    mergedFile = HT.openFileAndGet(path, "recreate")
+    for name, (contents, sumw2, entries) in sums.items():
+        hist = HT.setHistArrays(templates[name].Clone(name), contents, sumw2, entries)
+        mergedFile.WriteTObject(hist, name)
+    mergedFile.Close()
+
+
+def normalizeAndSumSamples(eras, samples, inDir, outPath, readCounters=lambda f: -1., nWorkers=4):
     """
     Produce file containing the sum of all the histograms over the processes, 
     after normalizing the processes by their cross section, sum of weights and luminosity.
     Note: The systematics are handled but are expected to be SAME for all processes and eras.
     A separate output file is produced for each era (`outPath_era.root`), as well as a total one (`outPath_run2.root`).
+    Each results file is read once by one of nWorkers processes, the histograms are scaled and summed as arrays
     """
+    tasks = []
     for era in eras:
-        lumi = eras[era]["luminosity"]
-        mergedHists = {}
+        first = True
         for proc, cfg in samples.items():
             if cfg["era"] != era: continue
             if "syst" in cfg: continue
-            xs = cfg["cross-section"]
-            tf = HT.openFileAndGet(os.path.join(inDir, proc + ".root"))
-            sumWgt = getSumw(tf, cfg, readCounters)
-            keyList = tf.GetListOfKeys()
-            for key in keyList:
-                hist = key.ReadObj()
-                if not hist.InheritsFrom("TH1"): continue
-                hist.Scale(lumi * xs / sumWgt)
-                name = hist.GetName()
-                if name not in mergedHists:
-                    mergedHists[name] = hist.Clone()
-                    mergedHists[name].SetDirectory(0)
-                else:
-                    mergedHists[name].Add(hist)
-            tf.Close()
-        mergedFile = HT.openFileAndGet(outPath + "_" + era + ".root", "recreate")
-        for hist in mergedHists.values():
-            hist.Write()
-        mergedFile.Close()
-    os.system("hadd -f " + outPath + "_run2.root " + " ".join([ f"{outPath}_{era}.root" for era in eras ]))
+            tasks.append((proc, os.path.join(inDir, proc + ".root"), eras[era]["luminosity"], cfg, first))
+            first = False
+
+    mergedHists = { era: {} for era in eras }
+    templates   = {}
+    origin      = {}
+    for proc, arrays, procTemplates in _runNormalizationPool(_readScaledSample, tasks, readCounters, nWorkers):
+        merged = mergedHists[samples[proc]["era"]]
+        for name, procArrays in arrays.items():
+            origin.setdefault(name, proc)
+            _addArrays(merged, name, procArrays)
+        for name, h in procTemplates.items():
+            templates.setdefault(name, h)
+    # histograms not in the first file of any era #
+    for name, proc in origin.items():
+        if name not in templates:
+            templates[name] = HT.loadHisto(os.path.join(inDir, proc + ".root"), name)
+            templates[name].Reset()
+
+    run2Hists = {}
+    for era, merged in mergedHists.items():
+        _writeSummedHists(f"{outPath}_{era}.root", merged, templates)
+        for name, eraArrays in merged.items():
+            _addArrays(run2Hists, name, eraArrays)
+    _writeSummedHists(f"{outPath}_run2.root", run2Hists, templates)
 
 
 def produceMEScaleEnvelopes(plots, scaleVariations, path):
-    _tf = HT.openFileAndGet(path, "update")
-    listOfKeys = [ k.GetName() for k in _tf.GetListOfKeys() ]
+    _tf = HT.openFileAndGet(path)
+    listOfKeys = set( k.GetName() for k in _tf.GetListOfKeys() )
 
+    envelopes = {}
     for plot in plots:
         # Compute envelope histograms for QCD scale variations
         nominal = _tf.Get(plot.name)
@@ -563,10 +654,10 @@ def produceMEScaleEnvelopes(plots, scaleVariations, path):
         if len(variations) != len(scaleVariations):
             logger.warning("Did not find {} variations for plot {} in file {}".format(len(scaleVariations), plot.name, path))
             continue
-        up, down = HT.getEnvelopeHistograms(nominal, variations)
-        up.Write(f"{plot.name}__qcdScaleup", ROOT.TObject.kOverwrite)
-        down.Write(f"{plot.name}__qcdScaledown", ROOT.TObject.kOverwrite)
+        envelopes[f"{plot.name}__qcdScaleup"], envelopes[f"{plot.name}__qcdScaledown"] = HT.getEnvelopeHistograms(nominal, variations)
     _tf.Close()
+    # all the envelopes of the file written at once #
+    HT.writeHistograms(path, envelopes)
 
 
 def producePDFEnvelopes(plots, task, resultsdir):
@@ -575,24 +666,13 @@ def producePDFEnvelopes(plots, task, resultsdir):
     path   = os.path.join(resultsdir, task.outputFile)
     logger.info(f"Producing PDF uncertainty envelopes for sample {sample}")
 
-    def sigmaFromReplicasMC(replicas):
-        return np.std(replicas, axis=0, ddof=1)
-
-    def sigmaFromReplicasHessian(residuals):
-        sq = residuals**2
-        return np.sqrt(sq.sum(axis=0))
-
-    def buildTHFromNP(nom_th, values, name):
-        new_th = nom_th.Clone(name)
-        assert(nom_th.GetNcells() == len(values))
-        for i in range(len(values)):
-            new_th.SetBinContent(i, values[i])
-        return new_th
-
-    tf = HT.openFileAndGet(path, "update")
+    tf = HT.openFileAndGet(path)
     listOfKeys = [ k.GetName() for k in tf.GetListOfKeys() ]
     nVar = 0
 
+    # PDF MC set : standard deviation of the replicas, Hessian set : quadratic sum of the deviations from nominal
+    method = "mc" if smpCfg.get("pdf_mc", False) else "hessian"
+    envelopes = {}
     for plot in plots:
         if isinstance(plot, CutFlowReport):
             continue
@@ -608,18 +688,13 @@ def producePDFEnvelopes(plots, task, resultsdir):
             continue
         nVar = len(variations)
 
-        replica_values = np.vstack([ np.array(h) for h in variations ])
-        nom_values = np.array(nominal)
-        if smpCfg.get("pdf_mc", False):
-            # PDF MC set
-            sigma = sigmaFromReplicasMC(replica_values)
-        else:
-            # Hessian MC set
-            sigma = sigmaFromReplicasHessian(replica_values - nom_values)
-        up = buildTHFromNP(nominal, nom_values + sigma, f"{plot.name}__pdfup")
-        down = buildTHFromNP(nominal, np.clip(nom_values - sigma, 0., None), f"{plot.name}__pdfdown")
-        up.Write("", ROOT.TObject.kOverwrite)
-        down.Write("", ROOT.TObject.kOverwrite)
+        # one (n_var x n_cells) array per plot
+        nom_values, replica_values = HT.stackHistArrays(nominal, variations)
+        up, down = HT.envelopeArrays(nom_values, replica_values, method)
+        envelopes[f"{plot.name}__pdfup"]   = HT.histFromArray(nominal, up, f"{plot.name}__pdfup")
+        envelopes[f"{plot.name}__pdfdown"] = HT.histFromArray(nominal, down, f"{plot.name}__pdfdown")
 
     logger.info(f"Found {nVar} PDF variations for sample {sample}")
     tf.Close()
+    # all the envelopes of the file written at once #
+    HT.writeHistograms(path, envelopes)